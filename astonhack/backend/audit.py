@@ -0,0 +1,60 @@
+import argparse
+
+from database import get_firestore
+from item_store import stream_pages
+
+# offline data-quality audit of the lost/found collections: lists documents missing fields
+# the matcher relies on. Only the audited fields are read, a page at a time.
+#
+#   python audit.py                                  # both collections, default fields
+#   python audit.py --collection foundItems --fields imageUrl,name --limit 1000
+REQUIRED_FIELDS = {
+    "foundItems": ["imageUrl", "name", "userId"],
+    "lostItems": ["description", "name", "color", "time", "userId"],
+}
+
+
+def audit_collection(db, collection_name: str, required_fields: list[str], limit: int | None = None,
+                     page_size: int = 500) -> dict:
+    print(f"\n=== AUDIT {collection_name} required={required_fields} ===")
+    total = 0
+    bad = 0
+
+    for page in stream_pages(db, collection_name, required_fields, page_size):
+        for data in page:
+            total += 1
+            missing = [k for k in required_fields if not data.get(k)]
+            if missing:
+                bad += 1
+                print(f"\n[Missing] {collection_name}/{data['id']}")
+                print("  missing:", missing)
+                # show a few suspect values
+                for k in required_fields:
+                    print(f"  {k} =", repr(data.get(k))[:200])
+
+            if limit and total >= limit:
+                break
+        if limit and total >= limit:
+            break
+
+    print(f"\n=== SUMMARY {collection_name}: total={total}, bad={bad} ===")
+    return {"total": total, "bad": bad}
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Report lost/found documents with missing fields.")
+    parser.add_argument("--collection", choices=sorted(REQUIRED_FIELDS), help="default: both")
+    parser.add_argument("--fields", help="comma-separated fields to require (default: per collection)")
+    parser.add_argument("--limit", type=int, help="stop after this many documents per collection")
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+
+    db = get_firestore()
+    collections = [args.collection] if args.collection else list(REQUIRED_FIELDS)
+    for collection in collections:
+        fields = args.fields.split(",") if args.fields else REQUIRED_FIELDS[collection]
+        audit_collection(db, collection, fields, args.limit, args.page_size)
+
+
+if __name__ == "__main__":
+    main_cli()
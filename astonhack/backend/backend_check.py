@@ -0,0 +1,126 @@
+import os
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import clip
+
+import clip_model
+import image_fetcher
+
+# accuracy/speed check of the CLIP CPU backends against the fp32 eager reference.
+# encodes the same images and descriptions with every backend and reports
+#   cosine drift: 1 - cos(reference vector, backend vector), mean and max
+#   top-3 agreement: share of description queries whose top-3 images match the reference's
+#   images/s and texts/s
+# pick the fastest backend whose drift and agreement are acceptable and set CLIP_BACKEND.
+#
+#   python backend_check.py --images ./samples --texts descriptions.txt
+#   python backend_check.py --limit 200          # sample from Firestore instead
+MAX_DRIFT = float(os.getenv("BACKEND_CHECK_MAX_DRIFT", "0.005"))
+MIN_AGREEMENT = float(os.getenv("BACKEND_CHECK_MIN_AGREEMENT", "0.95"))
+
+
+def load_samples(images_dir=None, texts_path=None, limit=200):
+    """Return (list of PIL images, list of descriptions) from local files or Firestore."""
+    if images_dir:
+        paths = sorted(p for p in Path(images_dir).iterdir()
+                       if p.suffix.lower() in (".jpg", ".jpeg", ".png", ".webp"))[:limit]
+        images = [image_fetcher.pil_from_bytes(p.read_bytes()) for p in paths]
+    else:
+        from database import get_firestore
+        db = get_firestore()
+        urls = [(d.to_dict() or {}).get("imageUrl") for d in db.collection("foundItems").select(["imageUrl"]).limit(limit).get()]
+        fetched = image_fetcher.fetch_many([u for u in urls if u])
+        images = [image_fetcher.pil_from_bytes(b) for b in fetched.values() if not isinstance(b, Exception)]
+
+    if texts_path:
+        texts = [line.strip() for line in Path(texts_path).read_text().splitlines() if line.strip()][:limit]
+    else:
+        from database import get_firestore
+        db = get_firestore()
+        texts = [(d.to_dict() or {}).get("description") for d in db.collection("lostItems").select(["description"]).limit(limit).get()]
+        texts = [t for t in texts if t]
+    return images, texts
+
+
+def _run(encoder, image_batch, text_tokens, batch_size):
+    with torch.inference_mode():
+        encoder.encode_image(image_batch[:1])  # warm up lazy init / graph optimisation
+        t0 = time.perf_counter()
+        img = torch.cat([encoder.encode_image(image_batch[i:i + batch_size])
+                         for i in range(0, len(image_batch), batch_size)])
+        image_s = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        txt = torch.cat([encoder.encode_text(text_tokens[i:i + batch_size])
+                         for i in range(0, len(text_tokens), batch_size)])
+        text_s = time.perf_counter() - t0
+    img = img / img.norm(dim=-1, keepdim=True)
+    txt = txt / txt.norm(dim=-1, keepdim=True)
+    return img.numpy(), txt.numpy(), image_s, text_s
+
+
+def _top3(img, txt):
+    k = min(3, img.shape[0])
+    return [set(row) for row in np.argsort(-(txt @ img.T), axis=1)[:, :k]]
+
+
+def check(images, texts, backends=clip_model.BACKENDS, batch_size=32):
+    model, preprocess = clip_model.get_model()
+    image_batch = torch.stack([preprocess(im) for im in images])
+    text_tokens = clip.tokenize(texts, truncate=True)
+    resolution = model.visual.input_resolution
+
+    results = {}
+    ref = None
+    for name in ["eager", *[b for b in backends if b != "eager"]]:
+        t0 = time.perf_counter()
+        encoder = clip_model.Encoder(model, name, resolution)
+        build_s = time.perf_counter() - t0
+        img, txt, image_s, text_s = _run(encoder, image_batch, text_tokens, batch_size)
+        if ref is None:
+            ref = (img, txt, _top3(img, txt))
+        drift_img = 1 - np.sum(img * ref[0], axis=1)
+        drift_txt = 1 - np.sum(txt * ref[1], axis=1)
+        agreement = float(np.mean([a == b for a, b in zip(_top3(img, txt), ref[2])])) if texts else 1.0
+        max_drift = float(max(drift_img.max(initial=0), drift_txt.max(initial=0)))
+        results[name] = {
+            "build_s": round(build_s, 3),
+            "images_per_s": round(len(images) / max(image_s, 1e-9), 2),
+            "texts_per_s": round(len(texts) / max(text_s, 1e-9), 2),
+            "image_drift_mean": float(drift_img.mean()) if len(drift_img) else 0.0,
+            "text_drift_mean": float(drift_txt.mean()) if len(drift_txt) else 0.0,
+            "max_drift": max_drift,
+            "top3_agreement": agreement,
+            "ok": max_drift <= MAX_DRIFT and agreement >= MIN_AGREEMENT,
+        }
+        print(f"[backend] {name}: {results[name]}")
+    return results
+
+
+def recommend(results) -> str:
+    """Fastest backend (by image throughput) that passed the accuracy check."""
+    ok = [name for name, r in results.items() if r["ok"]]
+    return max(ok, key=lambda name: results[name]["images_per_s"]) if ok else "eager"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare CLIP CPU backends against the fp32 reference.")
+    parser.add_argument("--images", help="directory of sample images (default: sample foundItems)")
+    parser.add_argument("--texts", help="file with one description per line (default: sample lostItems)")
+    parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--backends", default=",".join(clip_model.BACKENDS))
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    clip_model.load(warmup=False)
+    images, texts = load_samples(args.images, args.texts, args.limit)
+    print(f"[backend] {len(images)} images, {len(texts)} texts, {torch.get_num_threads()} threads")
+    results = check(images, texts, args.backends.split(","), args.batch_size)
+    print(f"[backend] recommended CLIP_BACKEND={recommend(results)}")
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
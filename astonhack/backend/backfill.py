@@ -0,0 +1,198 @@
+import os
+import argparse
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# offline (re-)embedding of every lost/found item, e.g. after changing CLIP_MODEL or
+# EMBEDDING_VERSION. Documents are streamed page by page, images downloaded in parallel,
+# and encoding runs in fixed-size batches on a process pool with a fixed number of torch
+# threads per worker. Progress is checkpointed per page, so an interrupted run resumes. A batch
+# that fails to encode is redone item by item; only the items whose download or encode failed
+# on their own are kept in the checkpoint and retried at the end of every run until they
+# succeed (or are deleted).
+#
+#   python backfill.py --collection foundItems --workers 4 --threads 2 --version v2
+#
+# deploy with EMBEDDING_VERSION=v2 afterwards and the API picks the new vectors up.
+CHECKPOINT_DIR = Path(os.getenv("BACKFILL_CHECKPOINT_DIR", str(Path(__file__).with_name(".cache") / "backfill")))
+
+
+# --- process pool side (no Firestore here: workers only load CLIP) ---
+
+def _init_worker(threads: int):
+    import torch
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    import clip_model
+    clip_model.load(warmup=False)
+
+
+def _encode_texts(texts):
+    import clip
+    import clip_model
+    return clip_model.encode_text(clip.tokenize(texts, truncate=True))
+
+
+def _encode_images(blobs):
+    import numpy as np
+    import torch
+    import clip_model
+    import image_fetcher
+    _, preprocess = clip_model.get_model()
+    images = [preprocess(image_fetcher.pil_from_bytes(b)) for b in blobs]
+    return clip_model.encode_image(torch.tensor(np.stack(images)))
+
+
+# --- driver ---
+
+def _checkpoint_path(collection, key):
+    return CHECKPOINT_DIR / f"{collection}.{key.replace('/', '_')}.json"
+
+
+def _load_checkpoint(path):
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return _new_state()
+
+
+def _new_state():
+    return {"last_id": None, "done": 0, "skipped": 0, "failed": 0, "retry": []}
+
+
+def _save_checkpoint(path, state):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(state))
+    os.replace(tmp, path)
+
+
+def backfill(collection, workers, threads, batch_size, page_size, version, force=False, reset=False):
+    import clip_model
+    import embedding_store
+    import image_fetcher
+    from database import get_firestore
+    from item_store import stream_pages
+
+    field = {"lostItems": "description", "foundItems": "imageUrl"}[collection]
+    key = f"{clip_model.MODEL_NAME}@{version}" if version else clip_model.MODEL_NAME
+    ckpt_path = _checkpoint_path(collection, key)
+    state = _new_state() if reset else _load_checkpoint(ckpt_path)
+    state.setdefault("retry", [])
+    if state["last_id"]:
+        print(f"[backfill] resuming {collection} after {state['last_id']} ({state['done']} done, "
+              f"{len(state['retry'])} to retry)")
+
+    db = get_firestore()
+    ctx = multiprocessing.get_context("spawn")
+    t0 = time.perf_counter()
+    done_this_run = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                             initializer=_init_worker, initargs=(threads,)) as pool:
+        def run(page):
+            """Encode and store a page of items; returns the ids that failed."""
+            items = [item for item in page if item.get(field)]
+            hashes = {item["id"]: embedding_store.content_hash(item[field]) for item in items}
+            if not force:
+                stored = embedding_store.get_many(collection, key, list(hashes))
+                todo = [item for item in items
+                        if item["id"] not in stored or stored[item["id"]][0] != hashes[item["id"]]]
+            else:
+                todo = items
+            state["skipped"] += len(page) - len(todo)
+
+            failed = []
+            if collection == "foundItems":
+                fetched = image_fetcher.fetch_many([item[field] for item in todo])
+                ok = []
+                for item in todo:
+                    data = fetched[item[field]]
+                    if isinstance(data, Exception):
+                        print(f"[backfill] {item['id']}: download failed: {data}")
+                        failed.append(item["id"])
+                    else:
+                        ok.append((item, data))
+                payloads, encode = ok, _encode_images
+            else:
+                payloads, encode = [(item, item[field]) for item in todo], _encode_texts
+
+            def store(batch, vectors):
+                nonlocal done_this_run
+                embedding_store.put_many(collection, key, [
+                    (item["id"], hashes[item["id"]], vec) for (item, _), vec in zip(batch, vectors)
+                ])
+                state["done"] += len(batch)
+                done_this_run += len(batch)
+
+            batches = [payloads[i:i + batch_size] for i in range(0, len(payloads), batch_size)]
+            futures = [(batch, pool.submit(encode, [p for _, p in batch])) for batch in batches]
+            singles = []
+            for batch, fut in futures:
+                try:
+                    store(batch, fut.result())
+                except Exception as e:
+                    if len(batch) == 1:
+                        print(f"[backfill] {batch[0][0]['id']}: encode failed: {e}")
+                        failed.append(batch[0][0]["id"])
+                        continue
+                    #one bad blob shouldn't sink the rest of its batch: redo it item by item
+                    print(f"[backfill] batch of {len(batch)} failed ({e}), encoding one by one")
+                    singles.extend(([pair], pool.submit(encode, [pair[1]])) for pair in batch)
+            for single, fut in singles:
+                try:
+                    store(single, fut.result())
+                except Exception as e:
+                    print(f"[backfill] {single[0][0]['id']}: encode failed: {e}")
+                    failed.append(single[0][0]["id"])
+            return failed
+
+        def checkpoint():
+            state["failed"] = len(state["retry"])
+            _save_checkpoint(ckpt_path, state)
+            elapsed = time.perf_counter() - t0
+            print(f"[backfill] {collection}: {state['done']} done, {state['skipped']} skipped, "
+                  f"{state['failed']} failed, {done_this_run / elapsed:.1f} items/s")
+
+        #the page moves the checkpoint on only together with the ids it failed on
+        for page in stream_pages(db, collection, [field], page_size, state["last_id"]):
+            state["retry"] = sorted(set(state["retry"]) | set(run(page)))
+            state["last_id"] = page[-1]["id"]
+            checkpoint()
+
+        #earlier failures (this run's and previous runs'), re-read so deleted items drop out
+        pending = state["retry"]
+        for i in range(0, len(pending), page_size):
+            ids = pending[i:i + page_size]
+            refs = [db.collection(collection).document(doc_id) for doc_id in ids]
+            items = [{"id": snap.id, **(snap.to_dict() or {})}
+                     for snap in db.get_all(refs, field_paths=[field]) if snap.exists]
+            still = set(run(items))
+            state["retry"] = sorted((set(state["retry"]) - set(ids)) | still)
+            checkpoint()
+
+    elapsed = time.perf_counter() - t0
+    print(f"[backfill] finished {collection} -> {key}: {done_this_run} encoded in {elapsed:.1f}s "
+          f"({done_this_run / max(elapsed, 1e-9):.1f} items/s)")
+    return state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-embed lost/found items into the embedding store.")
+    parser.add_argument("--collection", choices=["lostItems", "foundItems", "all"], default="all")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--threads", type=int, default=2, help="torch intra-op threads per worker")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--page-size", type=int, default=256)
+    parser.add_argument("--version", default=os.getenv("EMBEDDING_VERSION", ""),
+                        help="embedding version tag to write (matches EMBEDDING_VERSION)")
+    parser.add_argument("--force", action="store_true", help="re-encode even when the stored hash matches")
+    parser.add_argument("--reset", action="store_true", help="ignore the checkpoint and start over")
+    args = parser.parse_args()
+
+    collections = ["lostItems", "foundItems"] if args.collection == "all" else [args.collection]
+    for c in collections:
+        backfill(c, args.workers, args.threads, args.batch_size, args.page_size, args.version,
+                 force=args.force, reset=args.reset)
@@ -0,0 +1,703 @@
+import os
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# offline benchmark of the /match pipeline (main.final_verdict_async and everything under it:
+# clip_input, gate, ocr_agent, the verdict stage) with local stand-ins for the outside world:
+#   - an in-memory Firestore (FakeFirestore) holding a synthetic lost/found dataset
+#   - a local HTTP server rendering the found-item photos
+#   - a stubbed Gemini client with configurable latency; its gate "sees" the printed label
+#     in the uploaded image, so resized/re-encoded uploads are checked against ground truth
+# for every collection size and concurrency level it reports request latency p50/p95,
+# throughput, per-stage p50/p95 (from the metrics spans) and peak RSS, and writes JSON. per
+# size it also times candidate retrieval on its own, with and without the pre-filter (at the
+# app's time window and a narrow one).
+#
+#   python bench.py --sizes 10,1000,100000 --concurrency 1,8,32 --out bench.json
+#
+# at large sizes the collection's embeddings are pre-seeded with random vectors (encoding
+# 100k photos is a backfill job, not part of /match); query items are always encoded for real.
+# --random-weights runs CLIP with untrained weights when the checkpoint can't be downloaded.
+
+COLORS = {"red": (200, 30, 30), "blue": (30, 60, 200), "green": (30, 160, 60), "black": (20, 20, 20),
+          "white": (235, 235, 235), "yellow": (230, 200, 40), "brown": (120, 75, 30), "pink": (230, 120, 170)}
+ITEMS = ["wallet", "phone", "bag", "umbrella", "keys", "water bottle", "headphones", "jacket",
+         "student card", "laptop", "scarf", "glasses case"]
+
+
+# --- Firestore stand-in ---
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data, fields=None, reference=None):
+        self.id = doc_id
+        self.reference = reference
+        self.exists = data is not None
+        if data is not None and fields is not None:
+            data = {k: v for k, v in data.items() if k in fields}
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {})[field]
+
+
+class FakeDocument:
+    def __init__(self, collection, doc_id):
+        self._collection = collection
+        self.parent = collection
+        self.id = doc_id
+
+    def get(self, field_paths=None, *args, **kwargs):
+        with self._collection.lock:
+            data = self._collection.docs.get(self.id)
+            return FakeSnapshot(self.id, dict(data) if data is not None else None,
+                                set(field_paths) if field_paths else None, reference=self)
+
+    def set(self, data, merge=False):
+        with self._collection.lock:
+            if merge and self.id in self._collection.docs:
+                self._collection.docs[self.id].update(data)
+            else:
+                self._collection.docs[self.id] = dict(data)
+
+    def update(self, data):
+        with self._collection.lock:
+            self._collection.docs[self.id].update(data)
+
+    def delete(self):
+        with self._collection.lock:
+            self._collection.docs.pop(self.id, None)
+
+
+class FakeQuery:
+    def __init__(self, collection, fields=None, order=None, limit=None, after=None, filters=()):
+        self._collection = collection
+        self._fields, self._order, self._limit, self._after, self._filters = fields, order, limit, after, filters
+
+    def _copy(self, **changes):
+        args = dict(fields=self._fields, order=self._order, limit=self._limit, after=self._after,
+                    filters=self._filters)
+        args.update(changes)
+        return FakeQuery(self._collection, **args)
+
+    def select(self, fields):
+        return self._copy(fields=set(fields))
+
+    def order_by(self, field, direction=None):
+        return self._copy(order=field)
+
+    def limit(self, n):
+        return self._copy(limit=n)
+
+    def start_after(self, cursor):
+        return self._copy(after=cursor)
+
+    def where(self, *args, filter=None):
+        if filter is not None:
+            field, op, value = filter.field_path, filter.op_string, filter.value
+        else:
+            field, op, value = args
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def stream(self, *args, **kwargs):
+        ops = {"==": lambda a, b: a == b, ">=": lambda a, b: a >= b, ">": lambda a, b: a > b,
+               "<=": lambda a, b: a <= b, "<": lambda a, b: a < b}
+        with self._collection.lock:
+            rows = list(self._collection.docs.items())
+        for field, op, value in self._filters:
+            rows = [(i, d) for i, d in rows if d.get(field) is not None and ops[op](d.get(field), value)]
+        if self._order in (None, "__name__"):
+            rows.sort(key=lambda r: r[0])
+            key = lambda r: r[0]
+        else:
+            rows.sort(key=lambda r: (r[1].get(self._order), r[0]))
+            key = lambda r: r[1].get(self._order)
+        if self._after is not None:
+            after = self._after.get("__name__", self._after.get(self._order)) if isinstance(self._after, dict) \
+                else getattr(self._after, "id", self._after)
+            rows = [r for r in rows if key(r) > after]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        for doc_id, data in rows:
+            yield FakeSnapshot(doc_id, dict(data), self._fields, reference=FakeDocument(self._collection, doc_id))
+
+    def get(self, *args, **kwargs):
+        return list(self.stream())
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, name):
+        self.name = self.id = name
+        self.docs = {}
+        self.lock = threading.Lock()
+        super().__init__(self)
+
+    def document(self, doc_id):
+        return FakeDocument(self, doc_id)
+
+
+class FakeBatch:
+    def __init__(self):
+        self._ops = []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append(lambda: ref.set(data, merge=merge))
+
+    def update(self, ref, data):
+        self._ops.append(lambda: ref.update(data))
+
+    def delete(self, ref):
+        self._ops.append(ref.delete)
+
+    def commit(self):
+        for op in self._ops:
+            op()
+        self._ops = []
+
+
+class FakeFirestore:
+    def __init__(self):
+        self._collections = {}
+
+    def collection(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(name)
+        return self._collections[name]
+
+    def get_all(self, refs, field_paths=None, *args, **kwargs):
+        for ref in refs:
+            yield ref.get(field_paths)
+
+    def batch(self):
+        return FakeBatch()
+
+    def reset(self):
+        self._collections.clear()
+
+
+# --- image host stand-in ---
+
+PHOTO_SIZE = (640, 480)
+
+
+def has_label(seed: int) -> bool:
+    return seed % 3 == 0
+
+
+def _layout(seed: int, size):
+    """(background colour, item box, label box or None); defined at 640x480 and scaled."""
+    rng = random.Random(seed)
+    s = size[0] / 640
+    background = tuple(rng.randint(150, 220) for _ in range(3))
+    box = [round(v * s) for v in (160 + rng.randint(-40, 40), 120 + rng.randint(-30, 30),
+                                  480 + rng.randint(-40, 40), 360 + rng.randint(-30, 30))]
+    label = None
+    if has_label(seed):
+        label = (box[0] + round(20 * s), box[1] + round(20 * s), box[0] + round(220 * s), box[1] + round(80 * s))
+    return background, box, label
+
+
+def _label_text(seed: int, size):
+    """(text, font, (x, y)) printed on the label."""
+    s = size[0] / 640
+    box = _layout(seed, size)[1]
+    try:
+        font = ImageFont.load_default(size=round(24 * s))
+    except TypeError:
+        font = ImageFont.load_default()
+    return f"ID {100000 + seed}", font, (box[0] + round(30 * s), box[1] + round(35 * s))
+
+
+def text_box(seed: int, size=None):
+    """Ground-truth (x0, y0, x1, y1) of the printed text, or None for unlabelled photos."""
+    if not has_label(seed):
+        return None
+    text, font, (x, y) = _label_text(seed, size or PHOTO_SIZE)
+    bx0, by0, bx1, by1 = font.getbbox(text)
+    return x + bx0, y + by0, x + bx1, y + by1
+
+
+def render_photo(seed: int, size=None) -> bytes:
+    """Deterministic synthetic 'photo': an item-coloured shape, sometimes with a printed label."""
+    w, h = size = size or PHOTO_SIZE
+    background, box, label = _layout(seed, size)
+    color = COLORS[list(COLORS)[seed % len(COLORS)]]
+    img = Image.new("RGB", (w, h), background)
+    draw = ImageDraw.Draw(img)
+    (draw.ellipse if seed % 2 else draw.rectangle)(box, fill=color)
+    if label is not None:
+        draw.rectangle(label, fill=(250, 250, 250))
+        text, font, xy = _label_text(seed, size)
+        draw.text(xy, text, fill=(0, 0, 0), font=font)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        try:
+            seed = int(self.path.rsplit("/", 1)[-1].split(".")[0])
+        except ValueError:
+            self.send_error(404)
+            return
+        data = render_photo(seed)
+        etag = '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_image_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ImageHandler)
+    threading.Thread(target=server.serve_forever, name="bench-images", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# --- Gemini stand-in ---
+
+class StubModels:
+    def __init__(self, latency_s, jitter_s, seed=0):
+        self.latency_s, self.jitter_s = latency_s, jitter_s
+        self.calls = 0
+        self.upload_bytes = {}
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+
+    def generate_content(self, model, contents, config=None):
+        from google.genai import types
+        import gate
+        import tools
+        import main
+
+        images = [c.inline_data.data for c in contents
+                  if isinstance(c, types.Part) and c.inline_data is not None]
+        with self._lock:
+            self.calls += 1
+            self.upload_bytes[model] = self.upload_bytes.get(model, 0) + sum(len(b) for b in images)
+            delay = self.latency_s + self._rng.uniform(0, self.jitter_s)
+        time.sleep(delay)
+
+        texts = [c for c in contents if isinstance(c, str)]
+        if any(t == gate.GATE_PROMPT for t in texts):
+            should_ocr = bool(images) and sees_label(images[0])
+            out = json.dumps({"should_ocr": should_ocr, "readability": "high" if should_ocr else "none",
+                              "doc_type": "label" if should_ocr else "none",
+                              "likely_identifiers": ["id_number"] if should_ocr else [], "reason": "stub"})
+        elif any(t == main.VERDICT_PROMPT for t in texts):
+            packet = json.loads(texts[-1])
+            top = (packet.get("candidates") or [{}])[0].get("candidate_id")
+            out = json.dumps({"decision": "needs_review", "given_id": packet["given_id"], "matched_id": top,
+                              "confidence": 0.5, "reasons": ["stub verdict"]})
+        elif any(t == tools.OCR_PROMPT for t in texts):
+            out = "ID 100042"
+        else:
+            out = "{}"
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(parts=[types.Part(text=out)]))],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=300 + 258 * sum(not isinstance(c, str) for c in contents),
+                candidates_token_count=max(1, len(out) // 4)),
+        )
+
+
+def sees_label(data: bytes) -> bool:
+    """The stub gate's eyes: is the near-white printed label visible in the image?"""
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    img.thumbnail((160, 160))
+    px = np.asarray(img)
+    return float(np.mean(px.min(axis=2) > 242)) >= 0.01
+
+
+class StubClient:
+    def __init__(self, models):
+        self.models = models
+
+
+# --- dataset ---
+
+def make_dataset(db, size, image_base, seed=0):
+    """size lost + size found items with overlapping colours/items, times and places."""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    lost, found = db.collection("lostItems"), db.collection("foundItems")
+    for i in range(size):
+        color = list(COLORS)[i % len(COLORS)]
+        item = ITEMS[rng.randrange(len(ITEMS))]
+        created = now - timedelta(days=rng.uniform(0, 60))
+        lost.docs[f"lost{i:06d}"] = {
+            "name": item, "description": f"{color} {item}" + (f", card says ID {100000 + i}" if i % 7 == 0 else ""),
+            "color": color, "location": "library", "createdAt": created, "time": created.isoformat(),
+            "status": "open", "userId": f"user{i % 97}",
+        }
+        found.docs[f"found{i:06d}"] = {
+            "name": item, "imageUrl": f"{image_base}/img/{i}.jpg",
+            "lat": 52.48 + rng.uniform(-0.05, 0.05), "lng": -1.89 + rng.uniform(-0.05, 0.05),
+            "createdAt": created + timedelta(days=rng.uniform(0, 3)), "status": "open", "userId": f"user{i % 89}",
+        }
+
+
+def preseed_embeddings(db, skip=()):
+    """Random unit vectors in the embedding store for every item (except skip)."""
+    import clip_model
+    import embedding_store
+
+    rng = np.random.default_rng(0)
+    dim = clip_model.get_model()[0].text_projection.shape[1]
+    for collection, field in (("lostItems", "description"), ("foundItems", "imageUrl")):
+        docs = db.collection(collection).docs
+        rows = []
+        for doc_id, data in docs.items():
+            if doc_id in skip:
+                continue
+            vec = rng.standard_normal(dim).astype(np.float32)
+            rows.append((doc_id, embedding_store.content_hash(data[field]), vec / np.linalg.norm(vec)))
+            if len(rows) >= 5000:
+                embedding_store.put_many(collection, clip_model.EMBEDDING_KEY, rows)
+                rows = []
+        embedding_store.put_many(collection, clip_model.EMBEDDING_KEY, rows)
+
+
+# --- runner ---
+
+def _percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "n": 0}
+    arr = np.asarray(values)
+    return {"p50": round(float(np.percentile(arr, 50)) * 1000, 2),
+            "p95": round(float(np.percentile(arr, 95)) * 1000, 2), "n": len(values)}
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+async def run_level(item_ids, concurrency):
+    import main
+    import metrics
+
+    slots = asyncio.Semaphore(concurrency)
+    per_request = []
+
+    async def one(item_id):
+        async with slots:
+            timings = metrics.start_request()
+            t0 = time.perf_counter()
+            error = None
+            try:
+                await main.final_verdict_async(item_id, ocr_mode="direct")
+            except Exception as e:
+                error = repr(e)
+            per_request.append((time.perf_counter() - t0, timings, error))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in item_ids])
+    wall = time.perf_counter() - t0
+
+    stages = {}
+    for _, timings, _ in per_request:
+        totals = {}
+        for stage, elapsed in timings:
+            totals[stage] = totals.get(stage, 0.0) + elapsed
+        for stage, elapsed in totals.items():
+            stages.setdefault(stage, []).append(elapsed)
+    errors = [e for _, _, e in per_request if e]
+    return {
+        "concurrency": concurrency,
+        "requests": len(item_ids),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(item_ids) / wall, 2),
+        "latency_ms": _percentiles([lat for lat, _, _ in per_request]),
+        "stages_ms": {stage: _percentiles(v) for stage, v in sorted(stages.items())},
+    }
+
+
+def check_quality(db):
+    """Gate decisions vs the photos' ground truth, and whether OCR crops kept all the printed text."""
+    import item_store
+    import media_prep
+    from image_artifact import ImageArtifact
+
+    item_store.flush()
+    gated, local, correct, labelled, kept = 0, 0, 0, 0, 0
+    for doc_id, data in list(db.collection("foundItems").docs.items()):
+        if "should_ocr" not in data:
+            continue
+        seed = int(doc_id[len("found"):])
+        gated += 1
+        local += str(data.get("gate_version", "")).startswith("local-")
+        correct += bool(data["should_ocr"]) == has_label(seed)
+        if not has_label(seed):
+            continue
+        labelled += 1
+        crop = None
+        if media_prep.ENABLED and media_prep.OCR_CROP:
+            crop = media_prep.text_crop(ImageArtifact(render_photo(seed)).bgr)
+        x0, y0, x1, y1 = text_box(seed)
+        kept += crop is None or (crop[0] <= x0 and crop[1] <= y0 and crop[2] >= x1 and crop[3] >= y1)
+    return {"gated": gated, "gated_locally": local, "gate_accuracy": round(correct / gated, 3) if gated else None,
+            "ocr_text_kept": round(kept / labelled, 3) if labelled else None}
+
+
+#items are spread over 60 days, so this window keeps about a tenth of them
+NARROW_WINDOW_DAYS = 3
+
+
+def check_retrieval(db, k=3, n=50, seed=0):
+    """Per-query candidate retrieval with and without the pre-filter, over the synced indexes.
+
+    Query vectors are rows of the index itself (the search cost doesn't depend on them); the
+    pre-filter queries are items of the other collection, as /match builds them.
+    """
+    import clip_input
+    import prefilter
+
+    rng = random.Random(seed)
+    out = {}
+    for collection, other in (("foundItems", "lostItems"), ("lostItems", "foundItems")):
+        index = clip_input.synced_index(collection)
+        #time the steady state: a graph being built in the background competes for the CPU
+        deadline = time.monotonic() + 600
+        while index._ann_building and time.monotonic() < deadline:
+            time.sleep(0.5)
+        docs = list(db.collection(other).docs.items())
+        if not len(index) or not docs:
+            continue
+        sample = [dict(data, id=doc_id) for doc_id, data in rng.sample(docs, min(n, len(docs)))]
+        queries = np.array(index.matrix[[rng.randrange(len(index)) for _ in sample]])
+        attrs = [prefilter.query_attributes(item) for item in sample]
+        meta = prefilter.get_index(collection)
+        out[collection] = {"items": len(index), "ann": index._ann is not None}
+        #the app's window, and a narrow one: only a selective filter is applied (MAX_KEEP_SHARE)
+        window = prefilter.TIME_WINDOW_DAYS
+        for name, days in (("window", window), ("narrow", NARROW_WINDOW_DAYS)):
+            prefilter.TIME_WINDOW_DAYS = days
+            try:
+                shares = [1.0 if keep is None else float(keep.mean()) for _, keep in map(meta.mask, attrs)]
+                plain, filtered, applied = [], [], 0
+                for query, q in zip(attrs, queries):
+                    t0 = time.perf_counter()
+                    index.search(q, k)
+                    plain.append(time.perf_counter() - t0)
+                    t0 = time.perf_counter()
+                    allowed = prefilter.allowed_rows(collection, query, k)
+                    index.search(q, k, allowed)
+                    filtered.append(time.perf_counter() - t0)
+                    applied += allowed is not None
+                t0 = time.perf_counter()
+                index.search_many(queries, k)
+                batch_plain = time.perf_counter() - t0
+                t0 = time.perf_counter()
+                index.search_many(queries, k, [prefilter.allowed_rows(collection, query, k) for query in attrs])
+                batch_filtered = time.perf_counter() - t0
+            finally:
+                prefilter.TIME_WINDOW_DAYS = window
+            out[collection][name] = {
+                "days": days, "kept_share": round(float(np.mean(shares)), 3),
+                "applied_share": round(applied / len(attrs), 3),
+                "unfiltered_ms": _percentiles(plain), "prefiltered_ms": _percentiles(filtered),
+                "batch_unfiltered_ms": round(batch_plain * 1000, 2), "batch_prefiltered_ms": round(batch_filtered * 1000, 2),
+            }
+    return out
+
+
+def reset_state(workdir):
+    """Fresh embedding store / indexes / caches for the next collection size."""
+    import embedding_store
+    import identifiers
+    import item_store
+    import llm_client
+    import prefilter
+    import text_cache
+    import vector_index
+
+    embedding_store._conn = None
+    embedding_store.DB_PATH = str(workdir / "embeddings.sqlite3")
+    vector_index.INDEX_DIR = workdir / "index"
+    vector_index._indexes.clear()
+    prefilter._indexes.clear()
+    identifiers._indexes.clear()
+    text_cache._lru.clear()
+    llm_client._cache.clear()
+    item_store.reset()
+
+
+def use_random_weights():
+    import clip
+    import clip_model
+    from clip.model import CLIP
+
+    print("[bench] using randomly initialised ViT-B/32 weights (timings only, scores are meaningless)")
+    model = CLIP(512, 224, 12, 768, 32, 77, 49408, 512, 8, 12).eval()
+    clip_model._model, clip_model._preprocess = model, clip.clip._transform(224)
+    clip_model._encoder = clip_model.Encoder(model, clip_model.BACKEND, 224)
+    clip_model._ready.set()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the match pipeline offline.")
+    parser.add_argument("--sizes", default="10,100,1000,10000,100000", help="items per collection")
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--requests", type=int, default=40, help="match requests per concurrency level")
+    parser.add_argument("--llm-latency-ms", type=float, default=400)
+    parser.add_argument("--llm-jitter-ms", type=float, default=200)
+    parser.add_argument("--photo-size", default="640x480", help="found-item photo size, e.g. 4032x3024 for phone photos")
+    parser.add_argument("--no-media-prep", action="store_true", help="upload original images to the LLM (MEDIA_PREP=0)")
+    parser.add_argument("--no-text-pregate", action="store_true", help="send every photo to the LLM gate (TEXT_PREGATE=0)")
+    parser.add_argument("--encode-all", action="store_true", help="encode every item with CLIP instead of pre-seeding")
+    parser.add_argument("--random-weights", action="store_true")
+    parser.add_argument("--workdir", help="where stores/caches go (default: a temp dir)")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--verbose", action="store_true", help="keep the pipeline's own prints")
+    args = parser.parse_args()
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="match-bench-"))
+    #module-level config reads these at import, so set them before importing the pipeline
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    os.environ["EMBEDDING_STORE_PATH"] = str(workdir / "embeddings.sqlite3")
+    os.environ["VECTOR_INDEX_DIR"] = str(workdir / "index")
+    os.environ["IMAGE_CACHE_DIR"] = str(workdir / "images")
+    os.environ["OCR_MODE"] = "direct"
+    if args.no_media_prep:
+        os.environ["MEDIA_PREP"] = "0"
+    if args.no_text_pregate:
+        os.environ["TEXT_PREGATE"] = "0"
+    global PHOTO_SIZE
+    PHOTO_SIZE = tuple(int(v) for v in args.photo_size.lower().split("x"))
+    #the fake has no listeners: snapshot the collections by paged reads instead
+    os.environ["FIRESTORE_CACHE"] = "poll"
+
+    import database
+    fake_db = FakeFirestore()
+    database.get_firestore = lambda: fake_db
+
+    server, image_base = start_image_server()
+    models = StubModels(args.llm_latency_ms / 1000, args.llm_jitter_ms / 1000)
+
+    import clip_model
+    import item_store
+    import llm_client
+    import main  # noqa: F401  (the pipeline modules it imports lazily will see the fake db)
+    llm_client._client = StubClient(models)
+
+    if args.random_weights:
+        use_random_weights()
+    else:
+        try:
+            clip_model.load()
+        except Exception as e:
+            print(f"[bench] could not load {clip_model.MODEL_NAME}: {e}")
+            use_random_weights()
+
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "model": clip_model.MODEL_NAME,
+            "backend": clip_model.BACKEND,
+            "torch_threads": __import__("torch").get_num_threads(),
+            "cpu_count": os.cpu_count(),
+            "llm_latency_ms": args.llm_latency_ms,
+            "llm_jitter_ms": args.llm_jitter_ms,
+            "photo_size": args.photo_size,
+            "media_prep": not args.no_media_prep,
+            "text_pregate": not args.no_text_pregate,
+            "encode_all": args.encode_all,
+        },
+        "runs": [],
+    }
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+
+    for size in [int(s) for s in args.sizes.split(",")]:
+        item_store.flush()
+        fake_db.reset()
+        size_dir = workdir / f"size{size}"
+        reset_state(size_dir)
+        make_dataset(fake_db, size, image_base)
+        rng = random.Random(size)
+        ids = list(fake_db.collection("lostItems").docs) + list(fake_db.collection("foundItems").docs)
+        levels = [int(c) for c in args.concurrency.split(",")]
+        #fresh items per level, so no level is served from caches warmed by the one before
+        queries = {c: [rng.choice(ids) for _ in range(args.requests)] for c in levels}
+        t0 = time.perf_counter()
+        if not args.encode_all:
+            preseed_embeddings(fake_db, skip={i for q in queries.values() for i in q})
+        seed_s = time.perf_counter() - t0
+        print(f"[bench] size={size}: dataset ready ({seed_s:.1f}s seeding)", file=sys.stderr)
+
+        calls_before, uploads_before = models.calls, dict(models.upload_bytes)
+        with quiet:
+            #first requests build the indexes from the store: report them separately
+            cold = asyncio.run(run_level([f"lost{0:06d}", f"found{0:06d}"], 1))
+        run = {"size": size, "seed_s": round(seed_s, 2), "cold": cold, "levels": []}
+        for concurrency in levels:
+            with quiet:
+                level = asyncio.run(run_level(queries[concurrency], concurrency))
+            level["peak_rss_mb"] = _peak_rss_mb()
+            run["levels"].append(level)
+            print(f"[bench] size={size} c={concurrency}: {level['throughput_rps']} req/s, "
+                  f"p50 {level['latency_ms']['p50']}ms p95 {level['latency_ms']['p95']}ms, "
+                  f"errors {level['errors']}, peak RSS {level['peak_rss_mb']}MB", file=sys.stderr)
+        run["llm_calls"] = models.calls - calls_before
+        run["llm_upload_kb"] = {m: round((b - uploads_before.get(m, 0)) / 1024, 1)
+                                for m, b in models.upload_bytes.items()}
+        run["quality"] = check_quality(fake_db)
+        print(f"[bench] size={size}: uploads {run['llm_upload_kb']} KB, quality {run['quality']}", file=sys.stderr)
+        with quiet:
+            run["retrieval"] = check_retrieval(fake_db)
+        for collection, by_window in run["retrieval"].items():
+            for r in (by_window["window"], by_window["narrow"]):
+                print(f"[bench] size={size} {collection} retrieval, {r['days']:g}-day window: p50 "
+                      f"{r['unfiltered_ms']['p50']}ms unfiltered, {r['prefiltered_ms']['p50']}ms pre-filtered "
+                      f"(keeps {r['kept_share']:.0%}, applied to {r['applied_share']:.0%} of queries)", file=sys.stderr)
+        results["runs"].append(run)
+        Path(args.out).write_text(json.dumps(results, indent=2, default=str))
+
+    server.shutdown()
+    print(f"[bench] wrote {args.out}", file=sys.stderr)
+    return results
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,190 +1,283 @@
 import os
+import threading
 import torch
-import matplotlib.pyplot as plt
 from PIL import Image
-from pathlib import Path
-import numpy as np
-import clip
-from io import BytesIO
-import requests
-from database import get_firestore
+import clip_model
+import embedding_store
+import vector_index
+import image_fetcher
+import text_cache
+import inference_scheduler
+import prefilter
+import identifiers
+import item_store
+import metrics
 #import db
 
-def debug_collection_fields(collection_name: str, required_fields: list[str], limit: int | None = None):
-    print(f"\n=== DEBUG {collection_name} required={required_fields} ===")
-    docs = db.collection(collection_name).stream()
-    total = 0
-    bad = 0
-
-    for d in docs:
-        total += 1
-        data = d.to_dict() or {}
-
-        missing = [k for k in required_fields if not data.get(k)]
-        if missing:
-            bad += 1
-            print(f"\n[Missing] {collection_name}/{d.id}")
-            print("  missing:", missing)
-            print("  keys:", sorted(list(data.keys())))
-            # show a few suspect values
-            for k in required_fields:
-                print(f"  {k} =", repr(data.get(k))[:200])
-
-        if limit and total >= limit:
-            break
-
-    print(f"\n=== SUMMARY {collection_name}: total={total}, bad={bad} ===")
-
-
-db = get_firestore()
-
 def pil_from_url(url: str) -> Image.Image:
-    r = requests.get(url, timeout=20)
-    r.raise_for_status()
-    return Image.open(BytesIO(r.content)).convert("RGB")
+    return image_fetcher.fetch_pil(url)
 
 def fetch_lost_items():
-    print('fetching items')
-    docs = db.collection("lostItems").stream()
-    items = []
-    for d in docs:
-        data = d.to_dict()
-        items.append({"id": d.id, **data})
-    return items
+    with metrics.span("firestore_scan", collection="lostItems"):
+        return item_store.items("lostItems")
 
 def fetch_found_items():
-    docs = db.collection("foundItems").stream()
-    items = []
-    for d in docs:
-        data = d.to_dict()
-        items.append({"id": d.id, **data})
-    return items
-
-
-def match_img(image_url):
-    print('Torch version', torch.__version__)
-    print(clip.available_models())
-
-    model, preprocess = clip.load('ViT-B/32')
-    input_resolution = model.visual.input_resolution
-    context_length = model.context_length
-    vocab_size = model.vocab_size
-    
-    print('Model parameters;', f'{np.sum([int(np.prod(p.shape)) for p in model.parameters()]):,}')
-    print('Input resolution', input_resolution)
-    print('Context_length', context_length)
-    print('Vocab_size', vocab_size)
-
-    descriptions = []
-    ids = []
-    lost_items = fetch_lost_items()
-    for item in lost_items:
-        print(item["id"], item.get("description"))
-        ids.append(item["id"])
-        descriptions.append(item.get("description"))
-
-    image = pil_from_url(image_url)
-    img_tensor = preprocess(image).unsqueeze(0)
-    text_tokens = clip.tokenize(descriptions)
-
-    with torch.no_grad():
-        image_features = model.encode_image(img_tensor).float()
-        text_features = model.encode_text(text_tokens).float()
-    
-    #now normalise the vectors
-    image_features /=  image_features.norm(dim = -1, keepdim=True)
-    text_features /=  text_features.norm(dim = -1, keepdim=True)
-
-    similarity = text_features.cpu().numpy() @ image_features.cpu().numpy().T
-
-
-    similarities = []
-
-    for x in range(similarity.shape[0]):
-        similarities.append({
-        "candidate_id": ids[x],          
-        "text": descriptions[x],              
-        "clip_score": float(similarity[x, 0]),
-    })
-
-    print(similarities)
-    sorted_sim = sorted(similarities, key=lambda d: d["clip_score"], reverse=True)[:3]
-    print(sorted_sim)
-    return sorted_sim
-
-
-def match_text(description):
-    print('Torch version', torch.__version__)
-    print(clip.available_models())
-
-    model, preprocess = clip.load('ViT-B/32')
-    input_resolution = model.visual.input_resolution
-    context_length = model.context_length
-    vocab_size = model.vocab_size
-    
-    print('Model parameters;', f'{np.sum([int(np.prod(p.shape)) for p in model.parameters()]):,}')
-    print('Input resolution', input_resolution)
-    print('Context_length', context_length)
-    print('Vocab_size', vocab_size)
-
-    images = []
-    image_names = []
-    ids = []
-
-    images_original = []
-
-    debug_collection_fields("foundItems", ["imageUrl", "name", "userId"])
-    debug_collection_fields("lostItems", ["description", "name", "color", "time", "userId"])
-
-    found_items = fetch_found_items()
-    for item in found_items:
-        print(item["id"], item.get("name"))
-        images.append(preprocess(pil_from_url(item.get('imageUrl'))))
-        ids.append(item["id"])
-        image_names.append(item.get('name'))
-        images_original.append(pil_from_url(item.get('imageUrl')))
-
-    image_input = torch.tensor(np.stack(images))
-    text_tokens = clip.tokenize([description])
-
-    print(image_input.shape)
-    print(text_tokens.shape) 
-
-    with torch.no_grad():
-        image_features = model.encode_image(image_input).float()
-        text_features = model.encode_text(text_tokens).float()
-
-    #the shapes must match
-    print(image_features.shape)
-    print(text_features.shape)
-    
-    #now normalise the vectors
-    image_features /=  image_features.norm(dim = -1, keepdim=True)
-    text_features /=  text_features.norm(dim = -1, keepdim=True)
-
-    similarity = text_features.cpu().numpy() @ image_features.cpu().numpy().T
-
-    #(4,4)
-    print(similarity.shape)
-
-    similarities = []
-
-    for x in range(similarity.shape[1]):
-        similarities.append({
-        "candidate_id": ids[x],          
-        "image_names": image_names[x],              
-        "clip_score": float(similarity[0, x]),
-    })
-
-    print(similarities)
-    sorted_sim = sorted(similarities, key=lambda d: d["clip_score"], reverse=True)[:3]
-    print(sorted_sim)
-    return sorted_sim
-
-    
-
-    
-
-
-
+    with metrics.span("firestore_scan", collection="foundItems"):
+        return item_store.items("foundItems")
+
+
+#missing embeddings are encoded this many at a time, so peak memory doesn't grow with the collection
+ENCODE_BATCH_SIZE = int(os.getenv("CLIP_ENCODE_BATCH_SIZE", "32"))
+
+
+def iter_embeddings(collection, items, field, encode_missing, batch_size=None):
+    """Yield (item, vector) for every item with `field`, encoding only new/changed ones.
+
+    An item is re-encoded when the hash of `field` differs from the stored one
+    (e.g. its description or imageUrl was edited). Missing items are encoded and stored
+    batch_size at a time; nothing but the finished vectors outlives a batch.
+    """
+    batch_size = batch_size or ENCODE_BATCH_SIZE
+    items = [item for item in items if item.get(field)]
+    if not items:
+        return
+
+    hashes = {item["id"]: embedding_store.content_hash(item.get(field)) for item in items}
+    stored = embedding_store.get_many(collection, clip_model.EMBEDDING_KEY, list(hashes))
+
+    missing = []
+    for item in items:
+        hit = stored.get(item["id"])
+        if hit is not None and hit[0] == hashes[item["id"]]:
+            yield item, hit[1]
+        else:
+            missing.append(item)
+    metrics.inc("cache_total", len(items) - len(missing), cache="embedding", result="hit")
+    metrics.inc("cache_total", len(missing), cache="embedding", result="miss")
+
+    if missing:
+        print(f'encoding {len(missing)}/{len(items)} {collection} embeddings')
+    for i in range(0, len(missing), batch_size):
+        chunk = missing[i:i + batch_size]
+        try:
+            encoded = encode_missing([item.get(field) for item in chunk])
+        except Exception:
+            #one bad item (e.g. a dead imageUrl) shouldn't drop the rest of the chunk
+            chunk, encoded = _encode_one_by_one(collection, chunk, field, encode_missing)
+        embedding_store.put_many(collection, clip_model.EMBEDDING_KEY, [
+            (item["id"], hashes[item["id"]], vec) for item, vec in zip(chunk, encoded)
+        ])
+        yield from zip(chunk, encoded)
+
+
+def _encode_one_by_one(collection, chunk, field, encode_missing):
+    ok, encoded = [], []
+    for item in chunk:
+        try:
+            encoded.append(encode_missing([item.get(field)])[0])
+            ok.append(item)
+        except Exception as e:
+            print(f'skipping {collection}/{item["id"]}: {e}')
+    return ok, encoded
+
+
+def _encode_descriptions(descriptions):
+    return text_cache.encode(descriptions)
+
+
+def _encode_image_urls(urls):
+    _, preprocess = clip_model.get_model()
+    #download the chunk in parallel (each url at most once), then decode + preprocess one by one,
+    #dropping the decoded image as soon as its tensor exists
+    fetched = image_fetcher.fetch_many(urls)
+    image_input = None
+    for j, url in enumerate(urls):
+        data = fetched[url]
+        if isinstance(data, Exception):
+            raise data
+        tensor = preprocess(image_fetcher.pil_from_bytes(data))
+        if image_input is None:
+            image_input = torch.empty((len(urls), *tensor.shape), dtype=tensor.dtype)
+        image_input[j] = tensor
+    return inference_scheduler.encode_image(image_input)
+
+
+def upsert_index(collection, items, field, label_field, encode_missing):
+    """Add new/changed items to the collection's vector index and return it.
+
+    Only items whose `field` hash differs from the indexed one go to the embedding
+    store (and to CLIP if the store doesn't have them either).
+    """
+    index = vector_index.get_index(collection)
+    identifiers.update_items(collection, items)
+    items = [item for item in items if item.get(field)]
+    prefilter.get_index(collection).update(items)
+    stale = [item for item in items
+             if index.meta.get(item["id"], {}).get("hash") != embedding_store.content_hash(item.get(field))
+             or index.meta.get(item["id"], {}).get("model") != clip_model.EMBEDDING_KEY]
+    for item, vec in iter_embeddings(collection, stale, field, encode_missing):
+        index.add(item["id"], vec, {
+            "hash": embedding_store.content_hash(item.get(field)),
+            "model": clip_model.EMBEDDING_KEY,
+            "label": item.get(label_field),
+        })
+    return index
+
+
+def sync_index(collection, items, field, label_field, encode_missing):
+    """Bring the collection's vector index in line with `items` (the full collection) and return it."""
+    with metrics.span("index_sync", collection=collection):
+        return _sync_index(collection, items, field, label_field, encode_missing)
+
+
+def _sync_index(collection, items, field, label_field, encode_missing):
+    index = upsert_index(collection, items, field, label_field, encode_missing)
+
+    live = {item["id"] for item in items if item.get(field)}
+    for doc_id in [doc_id for doc_id in index.ids if doc_id not in live]:
+        index.delete(doc_id)
+    prefilter.get_index(collection).retain(live)
+    identifiers.get_index(collection).retain({item["id"] for item in items})
+    prefilter.cluster_by_time(collection)
+
+    index.save_if_due(vector_index.index_path(collection))
+    return index
+
+
+#per collection: (embedded field, label kept in the index, encoder)
+EMBED_SPECS = {
+    "lostItems": ("description", "description", _encode_descriptions),
+    "foundItems": ("imageUrl", "name", _encode_image_urls),
+}
+
+#snapshot version each collection's index was last synced to
+_synced_versions = {}
+_sync_locks = {collection: threading.Lock() for collection in EMBED_SPECS}
+
+
+def apply_changes(collection, changed, removed, field, label_field, encode_missing):
+    """Apply one snapshot delta (changed items, removed ids) to the collection's indexes and return the vector index."""
+    with metrics.span("index_delta", collection=collection):
+        index = upsert_index(collection, changed, field, label_field, encode_missing)
+        #an item whose embedded field was cleared leaves the vector side too
+        for doc_id in set(removed) | {item["id"] for item in changed if not item.get(field)}:
+            index.delete(doc_id)
+            prefilter.get_index(collection).remove(doc_id)
+        for doc_id in removed:
+            identifiers.get_index(collection).remove(doc_id)
+        index.save_if_due(vector_index.index_path(collection))
+        return index
+
+
+def synced_index(collection):
+    """The collection's vector index, synced to the current snapshot unless it already is.
+
+    Only the documents changed since the last sync are applied; the full resync (every item
+    against every index) runs on a cold start, or when the snapshot's change log no longer
+    reaches back to the version synced last.
+    """
+    version = item_store.version(collection)
+    if version is not None and _synced_versions.get(collection) == version:
+        return vector_index.get_index(collection)
+    with _sync_locks[collection]:
+        synced = _synced_versions.get(collection)
+        version = item_store.version(collection)
+        if version is not None and synced == version:
+            return vector_index.get_index(collection)
+        delta = item_store.changes(collection, synced) if synced is not None else None
+        if delta is not None:
+            version, changed, removed = delta
+            index = apply_changes(collection, changed, removed, *EMBED_SPECS[collection])
+        else:
+            items = fetch_lost_items() if collection == "lostItems" else fetch_found_items()
+            index = sync_index(collection, items, *EMBED_SPECS[collection])
+        _synced_versions[collection] = version
+        return index
+
+
+def match_img(image_url, k=3, artifact=None, item=None):
+    _, preprocess = clip_model.get_model()
+
+    index = synced_index("lostItems")
+
+    if artifact is None:
+        img_tensor = preprocess(pil_from_url(image_url)).unsqueeze(0)
+    else:
+        img_tensor = artifact.variant("clip", lambda: preprocess(artifact.pil)).unsqueeze(0)
+
+    #the shared model returns normalised vectors
+    with metrics.span("clip_encode"):
+        image_features = inference_scheduler.encode_image(img_tensor)
+
+    #only lost items plausible for this found item (place, time, colour) are scored
+    allowed = prefilter.allowed_rows("lostItems", prefilter.query_attributes(item, artifact), k)
+    top_k = [{
+        "candidate_id": doc_id,
+        "text": index.meta[doc_id].get("label"),
+        "clip_score": score,
+    } for doc_id, score in index.search(image_features[0], k, allowed)]
+    print(top_k)
+    return top_k
+
+
+def match_text(description, k=3, item=None):
+    index = synced_index("foundItems")
+
+    if not description:
+        return []
+
+    #the shared model returns normalised vectors
+    with metrics.span("clip_encode"):
+        text_features = text_cache.encode([description])
+
+    allowed = prefilter.allowed_rows("foundItems", prefilter.query_attributes(item), k)
+    top_k = [{
+        "candidate_id": doc_id,
+        "image_names": index.meta[doc_id].get("label"),
+        "clip_score": score,
+    } for doc_id, score in index.search(text_features[0], k, allowed)]
+    print(top_k)
+    return top_k
+
+
+def match_imgs(artifacts, k=3, items=None):
+    """match_img for many found-item images: one index sync, one encode, one scoring pass."""
+    _, preprocess = clip_model.get_model()
+
+    index = synced_index("lostItems")
+    if not artifacts:
+        return []
+
+    img_tensor = torch.stack([a.variant("clip", lambda a=a: preprocess(a.pil)) for a in artifacts])
+    image_features = inference_scheduler.encode_image(img_tensor)
+
+    items = items or [None] * len(artifacts)
+    allowed = [prefilter.allowed_rows("lostItems", prefilter.query_attributes(item, a), k)
+               for item, a in zip(items, artifacts)]
+    return [[{
+        "candidate_id": doc_id,
+        "text": index.meta[doc_id].get("label"),
+        "clip_score": score,
+    } for doc_id, score in hits] for hits in index.search_many(image_features, k, allowed)]
+
+
+def match_texts(descriptions, k=3, items=None):
+    """match_text for many lost-item descriptions: one index sync, one encode, one scoring pass."""
+    index = synced_index("foundItems")
+
+    results = [[] for _ in descriptions]
+    rows = [i for i, d in enumerate(descriptions) if d]
+    if not rows:
+        return results
+
+    text_features = text_cache.encode([descriptions[i] for i in rows])
+    items = items or [None] * len(descriptions)
+    allowed = [prefilter.allowed_rows("foundItems", prefilter.query_attributes(items[i]), k) for i in rows]
+    for i, hits in zip(rows, index.search_many(text_features, k, allowed)):
+        results[i] = [{
+            "candidate_id": doc_id,
+            "image_names": index.meta[doc_id].get("label"),
+            "clip_score": score,
+        } for doc_id, score in hits]
+    return results
 
@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+import clip
+from PIL import Image
+
+# process-wide CLIP registry: the model and its preprocess transform are loaded once
+# (at app startup) and shared by every request
+MODEL_NAME = os.getenv("CLIP_MODEL", "ViT-B/32")
+#bump EMBEDDING_VERSION when preprocessing changes; stored embeddings are keyed by EMBEDDING_KEY
+EMBEDDING_VERSION = os.getenv("EMBEDDING_VERSION", "")
+EMBEDDING_KEY = f"{MODEL_NAME}@{EMBEDDING_VERSION}" if EMBEDDING_VERSION else MODEL_NAME
+#CPU inference backend: "eager" (fp32 reference), "int8" (dynamically quantised linear layers)
+#or "jit" (traced + frozen image encoder, fused for CPU). check with `python backend_check.py`
+#before switching; 0 threads leaves torch's default
+BACKEND = os.getenv("CLIP_BACKEND", "eager")
+THREADS = int(os.getenv("CLIP_THREADS", "0"))
+BACKENDS = ("eager", "int8", "jit")
+
+_model = None
+_encoder = None
+_preprocess = None
+_load_lock = threading.Lock()
+_infer_lock = threading.Lock()
+_ready = threading.Event()
+_load_error = None
+
+
+def load(warmup: bool = True):
+    """Load the CLIP model once per process and optionally run a warmup forward pass."""
+    global _model, _preprocess, _encoder, _load_error
+    with _load_lock:
+        if _model is not None:
+            return _model, _preprocess
+        try:
+            if THREADS > 0:
+                torch.set_num_threads(THREADS)
+            t0 = time.perf_counter()
+            model, preprocess = clip.load(MODEL_NAME, device="cpu")
+            model.eval()
+            print('Torch version', torch.__version__)
+            print('Loaded CLIP', MODEL_NAME, f'in {time.perf_counter() - t0:.2f}s')
+            print('Model parameters;', f'{np.sum([int(np.prod(p.shape)) for p in model.parameters()]):,}')
+            print('Input resolution', model.visual.input_resolution)
+            print('Context_length', model.context_length)
+            print('Vocab_size', model.vocab_size)
+            _encoder = Encoder(model, BACKEND, model.visual.input_resolution)
+            print('CLIP backend', BACKEND, f'({torch.get_num_threads()} threads)')
+            _model, _preprocess = model, preprocess
+            if warmup:
+                _warmup()
+            _load_error = None
+            _ready.set()
+        except Exception as e:
+            _load_error = e
+            raise
+    return _model, _preprocess
+
+
+def _warmup():
+    #one dummy image + text pass so the first real request doesn't pay for lazy init
+    t0 = time.perf_counter()
+    size = _model.visual.input_resolution
+    dummy = Image.new("RGB", (size, size))
+    encode_image(_preprocess(dummy).unsqueeze(0))
+    encode_text(clip.tokenize(["warmup"]))
+    print(f'CLIP warmup done in {time.perf_counter() - t0:.2f}s')
+
+
+def get_model():
+    """Return the shared (model, preprocess) pair, loading it on first use."""
+    if _model is None:
+        return load()
+    return _model, _preprocess
+
+
+def is_ready() -> bool:
+    return _ready.is_set()
+
+
+def load_error():
+    return _load_error
+
+
+class Encoder:
+    """CLIP image/text encoders run through one CPU inference backend (see BACKENDS)."""
+
+    def __init__(self, model, backend: str = "eager", input_resolution: int = 224):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown CLIP backend: {backend!r} (expected one of {BACKENDS})")
+        self.backend = backend
+        self.model = model
+        self._image_fn = model.encode_image
+        if backend == "int8":
+            #weights of every nn.Linear (the MLPs, attention out projections) stored as int8,
+            #activations quantised on the fly; the original model is left untouched
+            self.model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            self._image_fn = self.model.encode_image
+        elif backend == "jit":
+            #the image input always has the same shape, so a traced graph is exact for it;
+            #the text side stays eager because trimming (below) makes its shape vary
+            example = torch.zeros(1, 3, input_resolution, input_resolution)
+            with torch.inference_mode():
+                traced = torch.jit.trace(_ImageEncoder(model), example, check_trace=False)
+                self._image_fn = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+    def encode_image(self, image_input: torch.Tensor) -> torch.Tensor:
+        return self._image_fn(image_input).float()
+
+    def encode_text(self, text_tokens: torch.Tensor, trim: bool = True) -> torch.Tensor:
+        model = self.model
+        if trim and hasattr(getattr(model, "transformer", None), "resblocks"):
+            return _encode_text_trimmed(model, text_tokens).float()
+        return model.encode_text(text_tokens).float()
+
+
+class _ImageEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image):
+        return self.model.encode_image(image)
+
+
+def get_encoder() -> Encoder:
+    if _encoder is None:
+        load()
+    return _encoder
+
+
+def encode_image(image_input: torch.Tensor) -> np.ndarray:
+    """Encode a batch of preprocessed images into L2-normalised float32 vectors."""
+    encoder = get_encoder()
+    with _infer_lock, torch.inference_mode():
+        features = encoder.encode_image(image_input)
+        features /= features.norm(dim=-1, keepdim=True)
+    return features.cpu().numpy().astype(np.float32)
+
+
+def encode_text(text_tokens: torch.Tensor, trim: bool = True) -> np.ndarray:
+    """Encode a batch of tokenised texts into L2-normalised float32 vectors.
+
+    With trim, the padding after the longest sequence in the batch is not run through the
+    text transformer (see _encode_text_trimmed); the result is the same.
+    """
+    encoder = get_encoder()
+    with _infer_lock, torch.inference_mode():
+        features = encoder.encode_text(text_tokens, trim=trim)
+        features /= features.norm(dim=-1, keepdim=True)
+    return features.cpu().numpy().astype(np.float32)
+
+
+def _encode_text_trimmed(model, text_tokens: torch.Tensor) -> torch.Tensor:
+    #same computation as CLIP.encode_text, but only over the first `length` positions.
+    #the text transformer is causal, so positions after the last EOT never influence the EOT
+    #feature that is read out; cutting them off leaves the output unchanged
+    length = int(text_tokens.argmax(dim=-1).max()) + 1
+    tokens = text_tokens[:, :length]
+    x = model.token_embedding(tokens).type(model.dtype)
+    x = x + model.positional_embedding[:length].type(model.dtype)
+    x = x.permute(1, 0, 2)  # NLD -> LND
+    for block in model.transformer.resblocks:
+        mask = block.attn_mask[:length, :length].to(dtype=x.dtype, device=x.device)
+        h = block.ln_1(x)
+        x = x + block.attn(h, h, h, need_weights=False, attn_mask=mask)[0]
+        x = x + block.mlp(block.ln_2(x))
+    x = x.permute(1, 0, 2)  # LND -> NLD
+    x = model.ln_final(x).type(model.dtype)
+    return x[torch.arange(x.shape[0]), tokens.argmax(dim=-1)] @ model.text_projection
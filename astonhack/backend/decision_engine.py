@@ -0,0 +1,111 @@
+import os
+import re
+import threading
+import time
+from collections import Counter, deque
+
+import identifiers
+import metrics
+
+# local verdict rules, mirroring the hard rules in main.VERDICT_PROMPT.
+# when they fix the outcome a MatchResponse is built here and the Gemini call is skipped;
+# ambiguous margins and OCR text that needs reading still go to the LLM.
+STRONG_MARGIN = float(os.getenv("VERDICT_STRONG_MARGIN", "0.05"))
+NO_MATCH_MARGIN = float(os.getenv("VERDICT_NO_MATCH_MARGIN", "0.01"))
+
+#OCR output like "Made in China" is not identifying (see the verdict prompt)
+_GENERIC_OCR = re.compile(r"^\s*(made in [\w\s.]+|[\W_]*)\s*$", re.IGNORECASE)
+
+path_counts = Counter()
+recent_paths = deque(maxlen=200)
+_lock = threading.Lock()
+
+
+def has_ocr_evidence(ocr_text) -> bool:
+    return bool(ocr_text) and not _GENERIC_OCR.match(ocr_text)
+
+
+def decide(item_id, candidates, margin, ocr_text="", identifier_hits=None):
+    """Return (verdict, path). verdict is None when the case has to go to the LLM."""
+    #an exact email/phone/long ID shared with exactly one document beats any CLIP score;
+    #names and short IDs only go to the LLM as evidence (see identifiers.is_strong)
+    strong = {doc_id: [t for t in toks if identifiers.is_strong(t)]
+              for doc_id, toks in (identifier_hits or {}).items()}
+    strong = {doc_id: toks for doc_id, toks in strong.items() if toks}
+    if len(strong) == 1:
+        (doc_id, toks), = strong.items()
+        return _verdict(item_id, "match", doc_id, 0.97,
+                        [f"Exact identifier match: {', '.join(toks)}."]), "rule:identifier"
+    if len(strong) > 1:
+        return None, "llm:identifier_conflict"
+    if identifier_hits:
+        return None, "llm:identifier_evidence"
+
+    if not candidates:
+        return _verdict(item_id, "no_match", None, 0.9,
+                        ["No candidates in the opposite collection."]), "rule:no_candidates"
+
+    if has_ocr_evidence(ocr_text):
+        return None, "llm:ocr_evidence"
+
+    if len(candidates) < 2:
+        return None, "llm:single_candidate"
+
+    top = candidates[0]
+    if margin >= STRONG_MARGIN:
+        confidence = min(0.95, 0.7 + (margin - STRONG_MARGIN) * 5)
+        return _verdict(item_id, "match", top["candidate_id"], confidence, [
+            f"CLIP score margin {margin:.3f} >= {STRONG_MARGIN}: top candidate is strongly separated.",
+            f"Top candidate clip_score {float(top['clip_score']):.3f}.",
+        ]), "rule:strong_margin"
+
+    if margin < NO_MATCH_MARGIN:
+        return _verdict(item_id, "no_match", None, 0.7, [
+            f"CLIP score margin {margin:.3f} < {NO_MATCH_MARGIN}: no candidate stands out.",
+            "No identifying OCR evidence.",
+        ]), "rule:weak_margin"
+
+    return None, "llm:ambiguous_margin"
+
+
+def _verdict(item_id, decision, matched_id, confidence, reasons):
+    return {
+        "decision": decision,
+        "given_id": item_id,
+        "matched_id": matched_id,
+        "confidence": round(float(confidence), 3),
+        "reasons": reasons,
+    }
+
+
+def record(item_id, path):
+    with _lock:
+        path_counts[path] += 1
+        recent_paths.append((time.time(), item_id, path))
+    metrics.inc("match_path_total", path=path)
+    print(f"[verdict] {item_id} -> {path}")
+
+
+def stats() -> dict:
+    with _lock:
+        return dict(path_counts)
+
+
+if __name__ == "__main__":
+    #regression check: generic sizes/model/room numbers must not decide a match locally
+    for text in ("Blue 500ml water bottle", "EVIAN 500ml natural mineral water", "256GB", "A2338", "MB2045"):
+        assert not [t for t in identifiers.extract(text) if identifiers.is_strong(t)], text
+    assert identifiers.is_strong("id:AB1234567") and identifiers.is_strong("phone:07700900123")
+    assert not identifiers.is_strong("id:1234567") and not identifiers.is_strong("name:john smith")
+    candidates = [{"candidate_id": "bottle", "clip_score": 0.301}, {"candidate_id": "other", "clip_score": 0.300}]
+    found = identifiers.IdentifierIndex()
+    found.update("bottle", "EVIAN 500ml natural mineral water")
+    hits = found.lookup(identifiers.extract("Blue 500ml water bottle"))
+    verdict, path = decide("lost1", candidates, 0.001, "", identifier_hits=hits)
+    assert verdict["decision"] == "no_match" and path == "rule:weak_margin", (verdict, path)
+    #a lost item's "name" is the item's name, and a brand printed on many found items is no evidence
+    assert not identifiers.extract(identifiers.item_text("lostItems", {"name": "Samsung Galaxy", "description": "black phone"}))
+    for i in range(identifiers.MAX_WEAK_DOCS + 1):
+        found.update(f"phone{i}", "Samsung Galaxy")
+    assert not found.lookup(identifiers.extract("my Samsung Galaxy phone, cracked screen"))
+    print("decision_engine checks passed")
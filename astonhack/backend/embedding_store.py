@@ -0,0 +1,143 @@
+import os
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+# durable cache of normalised CLIP embeddings, one row per (collection, doc id, model).
+# content_hash is a hash of the field that was encoded (description / imageUrl),
+# so a row is only reused while that field is unchanged.
+DB_PATH = os.getenv(
+    "EMBEDDING_STORE_PATH",
+    str(Path(__file__).with_name(".cache") / "embeddings.sqlite3"),
+)
+
+_conn = None
+_lock = threading.Lock()
+
+
+def _connect():
+    global _conn
+    if _conn is None:
+        Path(DB_PATH).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                collection   TEXT NOT NULL,
+                doc_id       TEXT NOT NULL,
+                model        TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                dim          INTEGER NOT NULL,
+                vector       BLOB NOT NULL,
+                updated_at   REAL NOT NULL,
+                PRIMARY KEY (collection, doc_id, model)
+            )
+        """)
+        #text embeddings keyed by normalised text rather than document (see text_cache)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS text_embeddings (
+                model     TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                dim       INTEGER NOT NULL,
+                vector    BLOB NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+        """)
+        conn.commit()
+        _conn = conn
+    return _conn
+
+
+def content_hash(value) -> str:
+    """Stable hash of the field an embedding was computed from."""
+    text = "" if value is None else str(value)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def get_many(collection: str, model: str, doc_ids) -> dict:
+    """Return {doc_id: (content_hash, vector)} for the ids that have a stored embedding."""
+    doc_ids = list(doc_ids)
+    out = {}
+    if not doc_ids:
+        return out
+    with _lock:
+        conn = _connect()
+        #sqlite caps the number of bound parameters, so look ids up in chunks
+        for i in range(0, len(doc_ids), 500):
+            chunk = doc_ids[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT doc_id, content_hash, dim, vector FROM embeddings "
+                f"WHERE collection = ? AND model = ? AND doc_id IN ({marks})",
+                [collection, model, *chunk],
+            ).fetchall()
+            for doc_id, h, dim, blob in rows:
+                out[doc_id] = (h, np.frombuffer(blob, dtype=np.float32, count=dim))
+    return out
+
+
+def put_many(collection: str, model: str, rows) -> None:
+    """Upsert (doc_id, content_hash, vector) rows."""
+    now = time.time()
+    params = []
+    for doc_id, h, vec in rows:
+        vec = np.ascontiguousarray(vec, dtype=np.float32).ravel()
+        params.append((collection, doc_id, model, h, int(vec.shape[0]), vec.tobytes(), now))
+    if not params:
+        return
+    with _lock:
+        conn = _connect()
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings "
+            "(collection, doc_id, model, content_hash, dim, vector, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            params,
+        )
+        conn.commit()
+
+
+def delete(collection: str, doc_id: str) -> None:
+    with _lock:
+        conn = _connect()
+        conn.execute("DELETE FROM embeddings WHERE collection = ? AND doc_id = ?", (collection, doc_id))
+        conn.commit()
+
+
+def get_texts(model: str, text_hashes) -> dict:
+    """Return {text_hash: vector} for the hashes that have a stored text embedding."""
+    text_hashes = list(text_hashes)
+    out = {}
+    with _lock:
+        conn = _connect()
+        for i in range(0, len(text_hashes), 500):
+            chunk = text_hashes[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT text_hash, dim, vector FROM text_embeddings WHERE model = ? AND text_hash IN ({marks})",
+                [model, *chunk],
+            ).fetchall()
+            for h, dim, blob in rows:
+                out[h] = np.frombuffer(blob, dtype=np.float32, count=dim)
+    return out
+
+
+def put_texts(model: str, rows) -> None:
+    """Upsert (text_hash, vector) rows."""
+    params = []
+    for h, vec in rows:
+        vec = np.ascontiguousarray(vec, dtype=np.float32).ravel()
+        params.append((model, h, int(vec.shape[0]), vec.tobytes()))
+    if not params:
+        return
+    with _lock:
+        conn = _connect()
+        conn.executemany(
+            "INSERT OR REPLACE INTO text_embeddings (model, text_hash, dim, vector) VALUES (?, ?, ?, ?)",
+            params,
+        )
+        conn.commit()
@@ -1,22 +1,19 @@
 import os
 import json
-import requests
-from io import BytesIO
-from PIL import Image
-import mimetypes
+import hashlib
 from pathlib import Path
 from dotenv import load_dotenv
 load_dotenv(Path(__file__).with_name(".env"))
 
-from google import genai
 from google.genai import types
-from database import get_firestore
-
-db = get_firestore()
+import item_store
+import llm_client
+import media_prep
+import metrics
+import text_presence
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 print("API key loaded?", bool(GEMINI_API_KEY))
-client = genai.Client(api_key=GEMINI_API_KEY)
 
 
 GATE_PROMPT = """
@@ -41,25 +38,60 @@ Rules:
 - likely_identifiers items: person_name|pet_name|id_number|phone|email|serial|address|other
 """
 
-def ocr_gate_from_file(url, r, img_id, img_collection) -> dict:
-    mime, _ = mimetypes.guess_type(url)
-    mime = mime or "image/jpeg"
+GATE_MODEL = "gemini-2.0-flash"
+GATE_KEYS = ("should_ocr", "readability", "doc_type", "likely_identifiers", "reason")
+#stored gate results are only reused for the same image and the same prompt/model/upload profile
+_GATE_SPEC = f"{GATE_MODEL}\n{GATE_PROMPT}" + (f"\n{media_prep.fingerprint('gate')}" if media_prep.ENABLED else "")
+GATE_VERSION = hashlib.sha256(_GATE_SPEC.encode("utf-8")).hexdigest()[:12]
+
+
+def stored_gate_result(stored: dict | None, artifact) -> dict | None:
+    """Return the gate result saved on the document if it is still valid for this image."""
+    if not stored:
+        return None
+    if stored.get("gate_image_hash") != artifact.sha256:
+        return None
+    #a "no text" result from the local pre-gate holds until its settings change
+    if stored.get("gate_version") not in (GATE_VERSION, text_presence.VERSION if text_presence.ENABLED else None):
+        return None
+    return {k: stored.get(k) for k in GATE_KEYS if k in stored}
 
-    image_bytes = r.content
-    image_part = types.Part.from_bytes(data=image_bytes, mime_type=mime)
 
-    resp = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=[image_part, GATE_PROMPT],
+def run_gate(image) -> dict:
+    """One gate call on an image as it is uploaded; returns the parsed decision."""
+    resp = llm_client.generate(
+        model=GATE_MODEL,
+        contents=[image, GATE_PROMPT],
         config=types.GenerateContentConfig(
             temperature=0,
             response_mime_type="application/json",
             max_output_tokens=400,
         ),
     )
-
-    item = db.collection(img_collection).document(img_id)
-    item.set(json.loads(resp.text), merge=True)
-
     # resp.text should be JSON because of response_mime_type
     return json.loads(resp.text)
+
+
+def ocr_gate_from_file(artifact, img_id, img_collection, stored: dict | None = None) -> dict:
+    cached = stored_gate_result(stored, artifact)
+    if cached is not None:
+        print("[gate] reusing stored result for", img_id)
+        metrics.inc("cache_total", cache="gate", result="hit")
+        return cached
+    metrics.inc("cache_total", cache="gate", result="miss")
+
+    result = text_presence.gate_result(artifact)
+    if result is not None:
+        print("[gate] no text found locally for", img_id)
+        metrics.inc("gate_total", source="local")
+        version = text_presence.VERSION
+    else:
+        result = run_gate(media_prep.prepare(artifact, "gate"))
+        metrics.inc("gate_total", source="llm")
+        version = GATE_VERSION
+
+    #buffered: goes out in one batched commit with the OCR result for the same document
+    item_store.write(img_collection, img_id,
+                     {**result, "gate_image_hash": artifact.sha256, "gate_version": version})
+
+    return result
@@ -0,0 +1,176 @@
+import os
+import re
+import threading
+
+import embedding_store
+
+# identifier extraction + inverted index (token -> doc ids) per collection.
+# tokens are normalised and typed: "email:..", "phone:..", "id:.." (ID numbers / serials)
+# and "name:..". only emails, phones and long mixed letter/digit IDs are strong enough to
+# decide a match locally (is_strong); other hits go to the LLM as evidence. found items are indexed by their ocr_output, lost items by their
+# description, so a lost description mentioning "07700 900123" finds the wallet whose card
+# OCR'd as "+44 7700 900123" with one dict lookup, no CLIP and no LLM.
+STRONG_TYPES = ("email", "phone", "id")
+#an ID decides a match on its own only from this length, with letters and digits mixed
+STRONG_ID_MIN_LEN = int(os.getenv("IDENTIFIER_STRONG_ID_MIN_LEN", "8"))
+#a weak token (name, short ID) on more documents than this is a brand or a slogan, not evidence
+MAX_WEAK_DOCS = int(os.getenv("IDENTIFIER_MAX_WEAK_DOCS", "3"))
+#identifier hits outside CLIP's top-k added to the verdict's candidates, best first
+MAX_HIT_CANDIDATES = int(os.getenv("IDENTIFIER_MAX_CANDIDATES", "5"))
+
+#per collection: the fields identifiers are read from. a lost item's "name" is the item's
+#name ("Samsung Galaxy"), not its owner's, so only the description is read
+SOURCE_FIELDS = {
+    "foundItems": ("ocr_output",),
+    "lostItems": ("description",),
+}
+
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+_PHONE = re.compile(r"\+?\d[\d\s().-]{7,}\d")
+_ID = re.compile(r"\b[A-Za-z0-9][A-Za-z0-9-]{4,}\b")
+#sizes, capacities and short model/room numbers (500ML, 256GB, A2338, MB2045) are on many
+#unrelated items; they are never identifiers
+_NOT_IDS = re.compile(r"^(?:\d+(?:ML|L|GB|TB|MB|MAH|W|V|MM|CM|M|KG|G|OZ|IN|HZ)|[A-Z]{1,2}\d{3,5}[A-Z]?)$")
+_NAME = re.compile(r"\b(?:[A-Z][a-z]+|[A-Z]{2,})(?:\s+(?:[A-Z][a-z]+|[A-Z]{2,})){1,2}\b")
+#capitalised phrases that aren't names (OCR of labels, sentence starts)
+_NOT_NAMES = {
+    "made", "in", "china", "the", "and", "of", "for", "with", "my", "a", "an", "this", "is",
+    "lost", "found", "please", "return", "to", "if", "call", "contact", "property", "card",
+    "bank", "student", "id", "university", "visa", "debit", "credit", "mastercard", "name",
+}
+
+
+def _phone(raw) -> str | None:
+    digits = re.sub(r"\D", "", raw)
+    if raw.strip().startswith("+44") or (digits.startswith("44") and len(digits) == 12):
+        digits = "0" + digits[2:]
+    return digits if 9 <= len(digits) <= 15 else None
+
+
+def extract(text) -> set:
+    """Typed, normalised identifier tokens found in free text."""
+    if not text:
+        return set()
+    text = str(text)
+    tokens = set()
+
+    for m in _EMAIL.finditer(text):
+        tokens.add("email:" + m.group(0).lower().strip("."))
+    rest = _EMAIL.sub(" ", text)
+
+    for m in _PHONE.finditer(rest):
+        phone = _phone(m.group(0))
+        if phone:
+            tokens.add("phone:" + phone)
+    rest_ids = _PHONE.sub(" ", rest)
+
+    for m in _ID.finditer(rest_ids):
+        tok = m.group(0).replace("-", "").upper()
+        #an ID needs a digit; long all-digit runs were already taken as phones
+        if len(tok) >= 5 and any(c.isdigit() for c in tok) and not _NOT_IDS.match(tok):
+            tokens.add("id:" + tok)
+
+    for m in _NAME.finditer(rest):
+        words = [w.lower() for w in m.group(0).split()]
+        if not any(w in _NOT_NAMES for w in words):
+            tokens.add("name:" + " ".join(words))
+    return tokens
+
+
+def is_strong(token) -> bool:
+    kind, _, value = token.partition(":")
+    if kind not in STRONG_TYPES:
+        return False
+    if kind == "id":
+        return (len(value) >= STRONG_ID_MIN_LEN and any(c.isdigit() for c in value)
+                and any(c.isalpha() for c in value))
+    return True
+
+
+def item_text(collection, item) -> str:
+    return " \n".join(str(item.get(f)) for f in SOURCE_FIELDS[collection] if item.get(f))
+
+
+class IdentifierIndex:
+    def __init__(self):
+        self._postings = {}     # token -> doc ids
+        self._docs = {}         # doc id -> (source hash, tokens)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def update(self, doc_id, text):
+        """(Re)index one document; a no-op when its source text is unchanged."""
+        h = embedding_store.content_hash(text)
+        with self._lock:
+            old = self._docs.get(doc_id)
+            if old is not None and old[0] == h:
+                return
+            tokens = extract(text)
+            self._unlink(doc_id)
+            self._docs[doc_id] = (h, tokens)
+            for tok in tokens:
+                self._postings.setdefault(tok, set()).add(doc_id)
+
+    def remove(self, doc_id):
+        with self._lock:
+            self._unlink(doc_id)
+            self._docs.pop(doc_id, None)
+
+    def retain(self, live_ids):
+        with self._lock:
+            for doc_id in [d for d in self._docs if d not in live_ids]:
+                self._unlink(doc_id)
+                self._docs.pop(doc_id, None)
+
+    def _unlink(self, doc_id):
+        old = self._docs.get(doc_id)
+        if old is None:
+            return
+        for tok in old[1]:
+            ids = self._postings.get(tok)
+            if ids is not None:
+                ids.discard(doc_id)
+                if not ids:
+                    del self._postings[tok]
+
+    def lookup(self, tokens) -> dict:
+        """{doc_id: sorted matching tokens} for documents sharing any of tokens.
+
+        Weak tokens shared by more than MAX_WEAK_DOCS documents are ignored.
+        """
+        hits = {}
+        with self._lock:
+            for tok in tokens:
+                ids = self._postings.get(tok, ())
+                if len(ids) > MAX_WEAK_DOCS and not is_strong(tok):
+                    continue
+                for doc_id in ids:
+                    hits.setdefault(doc_id, set()).add(tok)
+        return {doc_id: sorted(toks) for doc_id, toks in hits.items()}
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(collection: str) -> IdentifierIndex:
+    with _indexes_lock:
+        index = _indexes.get(collection)
+        if index is None:
+            index = _indexes[collection] = IdentifierIndex()
+        return index
+
+
+def update_items(collection, items):
+    index = get_index(collection)
+    for item in items:
+        index.update(item["id"], item_text(collection, item))
+
+
+def find(collection, text, exclude=None) -> dict:
+    """Documents in `collection` sharing an identifier with text: {doc_id: tokens}."""
+    hits = get_index(collection).lookup(extract(text))
+    hits.pop(exclude, None)
+    return hits
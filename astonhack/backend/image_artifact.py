@@ -0,0 +1,86 @@
+import hashlib
+import threading
+import weakref
+from functools import cached_property
+from io import BytesIO
+
+import numpy as np
+import cv2
+from PIL import Image
+
+import image_fetcher
+
+# one ImageArtifact per image per request: raw bytes plus lazily-built, memoised decodes
+# and variants (CLIP tensor, OCR preprocessing, ...), shared by the gate, OCR and verdict
+# stages so nothing is written to temp files or decoded twice.
+# LangGraph tools only pass strings around, so artifacts are also addressable by a
+# handle ("artifact://<sha256>[/variant]") while someone holds a reference to them.
+HANDLE_PREFIX = "artifact://"
+
+_registry = weakref.WeakValueDictionary()
+_registry_lock = threading.Lock()
+
+
+class ImageArtifact:
+    def __init__(self, data: bytes, url: str | None = None, mime: str | None = None, handle: str | None = None):
+        self.data = data
+        self.url = url
+        self._mime = mime
+        self._variants = {}
+        self._variants_lock = threading.Lock()
+        self.handle = handle or HANDLE_PREFIX + self.sha256
+        with _registry_lock:
+            _registry[self.handle] = self
+
+    @classmethod
+    def from_url(cls, url: str) -> "ImageArtifact":
+        return cls(image_fetcher.fetch(url), url=url)
+
+    @classmethod
+    def from_array(cls, bgr: np.ndarray, handle: str | None = None) -> "ImageArtifact":
+        """Wrap an already-decoded BGR array, encoding it to PNG once for upload."""
+        ok, buf = cv2.imencode(".png", bgr)
+        if not ok:
+            raise ValueError("Could not encode image as PNG")
+        artifact = cls(buf.tobytes(), mime="image/png", handle=handle)
+        artifact.__dict__["bgr"] = bgr
+        return artifact
+
+    @cached_property
+    def sha256(self) -> str:
+        return hashlib.sha256(self.data).hexdigest()
+
+    @cached_property
+    def pil(self) -> Image.Image:
+        return Image.open(BytesIO(self.data)).convert("RGB")
+
+    @cached_property
+    def bgr(self) -> np.ndarray:
+        img = cv2.imdecode(np.frombuffer(self.data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError(f"Could not decode image {self.url or self.handle}")
+        return img
+
+    @property
+    def mime(self) -> str:
+        if self._mime is None:
+            fmt = (Image.open(BytesIO(self.data)).format or "jpeg").lower()
+            self._mime = f"image/{fmt}"
+        return self._mime
+
+    def variant(self, key: str, build):
+        """Return the derived value stored under key, building it with build() on first use."""
+        with self._variants_lock:
+            if key in self._variants:
+                return self._variants[key]
+        value = build()
+        with self._variants_lock:
+            return self._variants.setdefault(key, value)
+
+
+def lookup(handle: str) -> ImageArtifact | None:
+    """Resolve an artifact handle (e.g. one passed through an agent tool call)."""
+    if not isinstance(handle, str) or not handle.startswith(HANDLE_PREFIX):
+        return None
+    with _registry_lock:
+        return _registry.get(handle)
@@ -0,0 +1,224 @@
+import os
+import hashlib
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image
+
+import metrics
+
+# shared image downloader: one pooled HTTP session, bounded parallelism, de-duplication
+# of concurrent requests for the same url, and a size-bounded content-addressed disk cache.
+# blobs are stored under their sha256; the url table remembers which blob (and ETag) a url
+# resolved to, so an unchanged image never crosses the network twice.
+CACHE_DIR = Path(os.getenv("IMAGE_CACHE_DIR", str(Path(__file__).with_name(".cache") / "images")))
+CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+#within this window a cached url is served without revalidating it against the server
+CACHE_FRESH_S = float(os.getenv("IMAGE_CACHE_FRESH_S", str(24 * 3600)))
+MAX_WORKERS = int(os.getenv("IMAGE_FETCH_WORKERS", "8"))
+TIMEOUT_S = float(os.getenv("IMAGE_FETCH_TIMEOUT", "20"))
+
+_session = None
+_executor = None
+_init_lock = threading.Lock()
+_inflight = {}
+_inflight_lock = threading.Lock()
+_db = None
+_db_lock = threading.Lock()
+
+
+def _get_session() -> requests.Session:
+    global _session
+    with _init_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=16,
+                pool_maxsize=MAX_WORKERS * 2,
+                max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+                                  allowed_methods=["GET"]),
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+    return _session
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _init_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="image-fetch")
+    return _executor
+
+
+def _conn():
+    global _db
+    if _db is None:
+        (CACHE_DIR / "blobs").mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(str(CACHE_DIR / "cache.sqlite3"), check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS urls (
+                url           TEXT PRIMARY KEY,
+                sha256        TEXT NOT NULL,
+                etag          TEXT,
+                last_modified TEXT,
+                fetched_at    REAL NOT NULL
+            )
+        """)
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256      TEXT PRIMARY KEY,
+                size        INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        db.commit()
+        _db = db
+    return _db
+
+
+def _blob_path(sha: str) -> Path:
+    return CACHE_DIR / "blobs" / sha[:2] / sha
+
+
+def _cached(url: str):
+    with _db_lock:
+        row = _conn().execute(
+            "SELECT sha256, etag, last_modified, fetched_at FROM urls WHERE url = ?", (url,)
+        ).fetchone()
+    if row is None or not _blob_path(row[0]).exists():
+        return None
+    return row
+
+
+def _touch(sha: str):
+    with _db_lock:
+        db = _conn()
+        db.execute("UPDATE blobs SET last_access = ? WHERE sha256 = ?", (time.time(), sha))
+        db.commit()
+
+
+def _store(url: str, data: bytes, etag, last_modified) -> str:
+    sha = hashlib.sha256(data).hexdigest()
+    path = _blob_path(sha)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+    now = time.time()
+    with _db_lock:
+        db = _conn()
+        db.execute("INSERT OR REPLACE INTO blobs (sha256, size, last_access) VALUES (?, ?, ?)",
+                   (sha, len(data), now))
+        db.execute("INSERT OR REPLACE INTO urls (url, sha256, etag, last_modified, fetched_at) "
+                   "VALUES (?, ?, ?, ?, ?)", (url, sha, etag, last_modified, now))
+        db.commit()
+    _evict()
+    return sha
+
+
+def _evict():
+    #drop least-recently-used blobs (and the urls pointing at them) until under budget
+    with _db_lock:
+        db = _conn()
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= CACHE_MAX_BYTES:
+            return
+        for sha, size in db.execute("SELECT sha256, size FROM blobs ORDER BY last_access").fetchall():
+            if total <= CACHE_MAX_BYTES:
+                break
+            db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha,))
+            db.execute("DELETE FROM urls WHERE sha256 = ?", (sha,))
+            try:
+                _blob_path(sha).unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+        db.commit()
+
+
+def _download(url: str) -> bytes:
+    entry = _cached(url)
+    headers = {}
+    if entry is not None:
+        sha, etag, last_modified, fetched_at = entry
+        if time.time() - fetched_at < CACHE_FRESH_S:
+            _touch(sha)
+            metrics.inc("cache_total", cache="image", result="hit")
+            return _blob_path(sha).read_bytes()
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    r = _get_session().get(url, headers=headers, timeout=TIMEOUT_S)
+    if r.status_code == 304 and entry is not None:
+        data = _blob_path(entry[0]).read_bytes()
+        _store(url, data, entry[1], entry[2])
+        metrics.inc("cache_total", cache="image", result="revalidated")
+        return data
+    r.raise_for_status()
+    metrics.inc("cache_total", cache="image", result="miss")
+    data = r.content
+    _store(url, data, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+    return data
+
+
+def fetch(url: str) -> bytes:
+    """Return the bytes at url, from the disk cache when possible.
+
+    Concurrent calls for the same url share a single download.
+    """
+    with _inflight_lock:
+        fut = _inflight.get(url)
+        owner = fut is None
+        if owner:
+            fut = Future()
+            _inflight[url] = fut
+    if not owner:
+        return fut.result()
+
+    try:
+        data = _download(url)
+        fut.set_result(data)
+        return data
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(url, None)
+
+
+def fetch_many(urls) -> dict:
+    """Download urls in parallel (bounded by IMAGE_FETCH_WORKERS).
+
+    Returns {url: bytes}; a url that failed maps to its exception instead.
+    """
+    unique = list(dict.fromkeys(urls))
+    futures = {url: _get_executor().submit(fetch, url) for url in unique}
+    out = {}
+    for url, fut in futures.items():
+        try:
+            out[url] = fut.result()
+        except Exception as e:
+            out[url] = e
+    return out
+
+
+def pil_from_bytes(data: bytes) -> Image.Image:
+    return Image.open(BytesIO(data)).convert("RGB")
+
+
+def fetch_pil(url: str) -> Image.Image:
+    return pil_from_bytes(fetch(url))
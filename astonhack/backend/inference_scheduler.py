@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+import clip_model
+
+# all CLIP encodes in the API process go through one worker thread. concurrent requests
+# queue their (already preprocessed / tokenised) inputs, the worker merges whatever is
+# waiting into one batch of up to MAX_BATCH rows (waiting at most MAX_WAIT_S for more to
+# arrive), runs it once and hands every caller its own rows back. one forward pass at a
+# time means torch's thread pool is never shared between requests.
+MAX_BATCH = int(os.getenv("INFER_MAX_BATCH", "32"))
+MAX_WAIT_S = float(os.getenv("INFER_MAX_WAIT_MS", "5")) / 1000
+
+
+class _Request:
+    __slots__ = ("inputs", "future", "queued_at")
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.future = Future()
+        self.queued_at = time.monotonic()
+
+
+class InferenceScheduler:
+    def __init__(self, max_batch: int = MAX_BATCH, max_wait_s: float = MAX_WAIT_S):
+        self.max_batch = max_batch
+        self.max_wait_s = max_wait_s
+        self._queues = {"image": deque(), "text": deque()}
+        self._cond = threading.Condition()
+        self._stop = False
+        self._stats = {"requests": 0, "rows": 0, "batches": 0, "max_batch_rows": 0,
+                       "queue_wait_s": 0.0, "run_s": 0.0}
+        self._worker = threading.Thread(target=self._run, name="clip-infer", daemon=True)
+        self._worker.start()
+
+    def submit(self, kind: str, inputs: torch.Tensor) -> Future:
+        """Queue a batch of inputs ("image" tensors or "text" tokens); the future yields its vectors."""
+        req = _Request(inputs)
+        with self._cond:
+            if self._stop:
+                raise RuntimeError("inference scheduler is stopped")
+            self._queues[kind].append(req)
+            self._cond.notify()
+        return req.future
+
+    def encode(self, kind: str, inputs: torch.Tensor) -> np.ndarray:
+        return self.submit(kind, inputs).result()
+
+    def _rows(self, queue) -> int:
+        return sum(len(r.inputs) for r in queue)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._stop and not any(self._queues.values()):
+                self._cond.wait()
+            if self._stop:
+                return None, []
+            #serve the kind whose oldest request has waited longest
+            kind = min((k for k, q in self._queues.items() if q), key=lambda k: self._queues[k][0].queued_at)
+            queue = self._queues[kind]
+            deadline = queue[0].queued_at + self.max_wait_s
+            while self._rows(queue) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stop:
+                    break
+                self._cond.wait(remaining)
+            #always take at least one request, even if it alone is bigger than max_batch
+            batch = [queue.popleft()]
+            rows = len(batch[0].inputs)
+            while queue and rows + len(queue[0].inputs) <= self.max_batch:
+                rows += len(queue[0].inputs)
+                batch.append(queue.popleft())
+            return kind, batch
+
+    def _run(self):
+        while True:
+            kind, batch = self._next_batch()
+            if kind is None:
+                return
+            started = time.monotonic()
+            try:
+                inputs = torch.cat([r.inputs for r in batch]) if len(batch) > 1 else batch[0].inputs
+                if kind == "image":
+                    vectors = clip_model.encode_image(inputs)
+                else:
+                    vectors = clip_model.encode_text(inputs)
+            except Exception as e:
+                for r in batch:
+                    r.future.set_exception(e)
+                continue
+            finally:
+                self._record(batch, started)
+            offset = 0
+            for r in batch:
+                r.future.set_result(vectors[offset:offset + len(r.inputs)])
+                offset += len(r.inputs)
+
+    def _record(self, batch, started):
+        rows = sum(len(r.inputs) for r in batch)
+        with self._cond:
+            s = self._stats
+            s["requests"] += len(batch)
+            s["rows"] += rows
+            s["batches"] += 1
+            s["max_batch_rows"] = max(s["max_batch_rows"], rows)
+            s["queue_wait_s"] += sum(started - r.queued_at for r in batch)
+            s["run_s"] += time.monotonic() - started
+
+    def stats(self) -> dict:
+        with self._cond:
+            out = dict(self._stats)
+            out["queued"] = sum(len(q) for q in self._queues.values())
+        out["mean_batch_rows"] = out["rows"] / out["batches"] if out["batches"] else 0.0
+        return out
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            pending = [r for q in self._queues.values() for r in q]
+            for q in self._queues.values():
+                q.clear()
+            self._cond.notify_all()
+        for r in pending:
+            r.future.set_exception(RuntimeError("inference scheduler stopped"))
+        self._worker.join(timeout=5)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> InferenceScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = InferenceScheduler()
+    return _scheduler
+
+
+def encode_image(image_input: torch.Tensor) -> np.ndarray:
+    """Scheduled clip_model.encode_image: may be batched with other callers' images."""
+    return get_scheduler().encode("image", image_input)
+
+
+def encode_text(text_tokens: torch.Tensor) -> np.ndarray:
+    """Scheduled clip_model.encode_text: may be batched with other callers' texts."""
+    return get_scheduler().encode("text", text_tokens)
+
+
+def stats() -> dict:
+    return get_scheduler().stats() if _scheduler is not None else {}
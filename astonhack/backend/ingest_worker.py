@@ -0,0 +1,286 @@
+import os
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+from database import get_firestore
+import clip_input
+import embedding_store
+import prefilter
+import identifiers
+import vector_index
+
+# background ingestion: embeds lost/found items as they are written so /match only has to
+# look vectors up. Changes come from a Firestore listener (adds, edits, deletes) or from
+# polling by TIME_FIELD; either way they are queued and processed in micro-batches.
+# restart-safe: the poll checkpoint is persisted, and a listener replays the whole collection on
+# start, which is cheap because unchanged items hit the embedding store by content hash.
+# poll mode only sees documents whose TIME_FIELD moves past the checkpoint: with the default
+# createdAt that is new documents only, never edits or deletes. The app only adds items today;
+# once documents are edited, point INGEST_TIME_FIELD at an update timestamp the writers set.
+# Deletes are never seen by polling (use listen mode, or the API's own sync drops them).
+COLLECTIONS = ("lostItems", "foundItems")
+TIME_FIELD = os.getenv("INGEST_TIME_FIELD", "createdAt")
+BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "32"))
+BATCH_WAIT_S = float(os.getenv("INGEST_BATCH_WAIT_S", "0.5"))
+QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "1024"))
+GATE_WORKERS = int(os.getenv("INGEST_GATE_WORKERS", "4"))
+POLL_INTERVAL_S = float(os.getenv("INGEST_POLL_INTERVAL_S", "5"))
+POLL_PAGE_SIZE = int(os.getenv("INGEST_POLL_PAGE_SIZE", "200"))
+CHECKPOINT_PATH = Path(os.getenv(
+    "INGEST_CHECKPOINT_PATH",
+    str(Path(__file__).with_name(".cache") / "ingest_checkpoint.json"),
+))
+
+
+class IngestWorker:
+    def __init__(self, run_gate: bool = False):
+        self.db = get_firestore()
+        self.run_gate = run_gate
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._stop = threading.Event()
+        self._threads = []
+        self._watches = []
+        self._gate_pool = ThreadPoolExecutor(max_workers=GATE_WORKERS, thread_name_prefix="ingest-gate")
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "enqueued": 0,
+            "processed": 0,
+            "deleted": 0,
+            "failed": 0,
+            "gated": 0,
+            "batches": 0,
+            "queue_high_water": 0,
+            "enqueue_wait_s": 0.0,   # time producers spent blocked on a full queue
+            "last_batch_s": 0.0,
+            "last_batch_size": 0,
+            "last_lag_s": None,      # now - write time of the newest item in the last batch
+        }
+
+    # --- metrics ---
+
+    def _bump(self, **deltas):
+        with self._stats_lock:
+            for k, v in deltas.items():
+                self._stats[k] += v
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            out = dict(self._stats)
+        out["queue_depth"] = self.queue.qsize()
+        out["queue_capacity"] = QUEUE_SIZE
+        return out
+
+    # --- producers ---
+
+    def enqueue(self, collection, doc_id, data):
+        """Queue one change (data=None means the document was deleted); blocks when the queue is full."""
+        t0 = time.perf_counter()
+        self.queue.put((collection, doc_id, data))
+        waited = time.perf_counter() - t0
+        with self._stats_lock:
+            self._stats["enqueued"] += 1
+            self._stats["enqueue_wait_s"] += waited
+            self._stats["queue_high_water"] = max(self._stats["queue_high_water"], self.queue.qsize())
+
+    def listen(self):
+        for collection in COLLECTIONS:
+            def on_snapshot(col_snapshot, changes, read_time, collection=collection):
+                for change in changes:
+                    doc = change.document
+                    if change.type.name == "REMOVED":
+                        self.enqueue(collection, doc.id, None)
+                    else:
+                        self.enqueue(collection, doc.id, doc.to_dict() or {})
+            self._watches.append(self.db.collection(collection).on_snapshot(on_snapshot))
+
+    def _load_checkpoint(self) -> dict:
+        try:
+            return json.loads(CHECKPOINT_PATH.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_checkpoint(self, checkpoint: dict):
+        CHECKPOINT_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp = CHECKPOINT_PATH.with_suffix(".tmp")
+        tmp.write_text(json.dumps(checkpoint))
+        os.replace(tmp, CHECKPOINT_PATH)
+
+    def poll_once(self) -> int:
+        """Queue documents written since the checkpoint. Returns how many were queued."""
+        checkpoint = self._load_checkpoint()
+        queued = 0
+        for collection in COLLECTIONS:
+            state = checkpoint.get(collection, {})
+            since, last_id = state.get("ts"), state.get("id")
+            #(TIME_FIELD, doc id) is a total order, so a page never stalls on a run of equal timestamps
+            query = self.db.collection(collection).order_by(TIME_FIELD).order_by("__name__")
+            if since and last_id:
+                query = query.start_after({TIME_FIELD: datetime.fromisoformat(since), "__name__": last_id})
+            elif since:
+                #checkpoint from before ids were kept: replay that instant, unchanged items are cheap
+                query = query.start_at({TIME_FIELD: datetime.fromisoformat(since)})
+            for d in query.limit(POLL_PAGE_SIZE).stream():
+                data = d.to_dict() or {}
+                self.enqueue(collection, d.id, data)
+                queued += 1
+                since, last_id = data[TIME_FIELD].isoformat(), d.id
+            checkpoint[collection] = {"ts": since, "id": last_id}
+        #the queue is drained before the checkpoint moves on, so a crash only replays work
+        self.queue.join()
+        self._save_checkpoint(checkpoint)
+        return queued
+
+    def poll_forever(self):
+        while not self._stop.is_set():
+            try:
+                queued = self.poll_once()
+            except Exception as e:
+                print("[ingest] poll failed:", e)
+                queued = 0
+            if queued < POLL_PAGE_SIZE:
+                self._stop.wait(POLL_INTERVAL_S)
+
+    # --- consumer ---
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + BATCH_WAIT_S
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def process_batch(self, batch):
+        t0 = time.perf_counter()
+        #last write wins inside a batch
+        latest = {}
+        for collection, doc_id, data in batch:
+            latest[(collection, doc_id)] = data
+
+        newest = None
+        for collection in COLLECTIONS:
+            field, label_field, encode = clip_input.EMBED_SPECS[collection]
+            index = vector_index.get_index(collection)
+            upserts = []
+            for (c, doc_id), data in latest.items():
+                if c != collection:
+                    continue
+                if data is None:
+                    index.delete(doc_id)
+                    prefilter.get_index(collection).remove(doc_id)
+                    identifiers.get_index(collection).remove(doc_id)
+                    embedding_store.delete(collection, doc_id)
+                    self._bump(deleted=1)
+                    continue
+                upserts.append({"id": doc_id, **data})
+                ts = data.get(TIME_FIELD)
+                if ts is not None and (newest is None or ts > newest):
+                    newest = ts
+            if upserts:
+                try:
+                    clip_input.upsert_index(collection, upserts, field, label_field, encode)
+                    self._bump(processed=len(upserts))
+                except Exception as e:
+                    print(f"[ingest] embedding {len(upserts)} {collection} failed:", e)
+                    self._bump(failed=len(upserts))
+                if self.run_gate and collection == "foundItems":
+                    self._gate(upserts)
+            index.save_if_due(vector_index.index_path(collection))
+
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["last_batch_s"] = time.perf_counter() - t0
+            self._stats["last_batch_size"] = len(batch)
+            if newest is not None:
+                self._stats["last_lag_s"] = (datetime.now(timezone.utc) - newest).total_seconds()
+
+    def _gate(self, items):
+        import gate
+        from image_artifact import ImageArtifact
+
+        def run(item):
+            if not item.get("imageUrl"):
+                return
+            artifact = ImageArtifact.from_url(item["imageUrl"])
+            gate.ocr_gate_from_file(artifact, item["id"], "foundItems", stored=item)
+            self._bump(gated=1)
+
+        for fut in [self._gate_pool.submit(run, item) for item in items]:
+            try:
+                fut.result()
+            except Exception as e:
+                print("[ingest] gate failed:", e)
+                self._bump(failed=1)
+
+    def consume_forever(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                self.process_batch(batch)
+            except Exception as e:
+                print("[ingest] batch failed:", e)
+                self._bump(failed=len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    # --- lifecycle ---
+
+    def start(self, mode: str = "listen"):
+        consumer = threading.Thread(target=self.consume_forever, name="ingest-consumer", daemon=True)
+        consumer.start()
+        self._threads.append(consumer)
+        if mode == "listen":
+            self.listen()
+        elif mode == "poll":
+            poller = threading.Thread(target=self.poll_forever, name="ingest-poller", daemon=True)
+            poller.start()
+            self._threads.append(poller)
+        else:
+            raise ValueError(f"Unknown ingest mode: {mode!r}")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for watch in self._watches:
+            watch.unsubscribe()
+        for t in self._threads:
+            t.join(timeout=5)
+        self._gate_pool.shutdown(wait=False)
+        for collection in COLLECTIONS:
+            index = vector_index.get_index(collection)
+            if index.dirty:
+                index.save(vector_index.index_path(collection))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed lost/found items as they are written.")
+    parser.add_argument("--mode", choices=["listen", "poll"], default="listen")
+    parser.add_argument("--gate", action="store_true", help="also run the OCR gate on found items")
+    parser.add_argument("--stats-every", type=float, default=30.0)
+    args = parser.parse_args()
+
+    worker = IngestWorker(run_gate=args.gate).start(args.mode)
+    print(f"[ingest] running in {args.mode} mode")
+    try:
+        while True:
+            time.sleep(args.stats_every)
+            print("[ingest]", worker.stats())
+    except KeyboardInterrupt:
+        worker.stop()
@@ -0,0 +1,415 @@
+import os
+import atexit
+import itertools
+import threading
+import time
+
+from database import get_firestore
+import metrics
+
+# Firestore access for the lost/found collections.
+#   - reads come from a local snapshot of each collection, projected to FIELDS and kept current
+#     by a listener ("listen", the default), by re-reading it in pages every CACHE_TTL_S ("poll"),
+#     or not kept at all ("off": every read goes to Firestore, still projected and paged)
+#   - writes (gate results, OCR output) are merged per document, applied to the snapshot at once
+#     and committed in batches by a background flusher, so a /match never waits on a write
+# with the snapshot warm a /match makes no Firestore round trip; an id the snapshot hasn't seen
+# yet (the app posts /match right after creating the document) costs one get_all.
+CACHE_MODE = os.getenv("FIRESTORE_CACHE", "listen")
+CACHE_TTL_S = float(os.getenv("FIRESTORE_CACHE_TTL_S", "30"))
+LOAD_TIMEOUT_S = float(os.getenv("FIRESTORE_LOAD_TIMEOUT_S", "30"))
+PAGE_SIZE = int(os.getenv("FIRESTORE_PAGE_SIZE", "500"))
+FLUSH_INTERVAL_S = float(os.getenv("FIRESTORE_FLUSH_INTERVAL_S", "0.5"))
+CHANGE_LOG_SIZE = int(os.getenv("FIRESTORE_CHANGE_LOG_SIZE", "1024"))   # versions kept for changes()
+MAX_BATCH_WRITES = 500  # Firestore's limit per batched write
+
+COLLECTIONS = ("lostItems", "foundItems")
+
+#the fields the matcher reads: query text, prefilter attributes, identifier sources and the
+#stored gate (gate.GATE_KEYS) / OCR results
+FIELDS = {
+    "lostItems": ("name", "description", "color", "location", "time", "createdAt", "lat", "lng",
+                  "status", "userId"),
+    "foundItems": ("name", "imageUrl", "color", "time", "createdAt", "lat", "lng", "status", "userId",
+                   "should_ocr", "readability", "doc_type", "likely_identifiers", "reason",
+                   "gate_image_hash", "gate_version", "ocr_output", "ocr_image_hash", "ocr_version"),
+}
+
+_db = None
+#snapshot versions are unique across caches, so a reset snapshot never looks already synced
+_versions = itertools.count(1)
+
+
+def _client():
+    global _db
+    if _db is None:
+        _db = get_firestore()
+    return _db
+
+
+def stream_pages(db, collection, fields, page_size, start_after=None):
+    """Yield lists of {"id", **fields} dicts ordered by document id, page_size at a time."""
+    last = start_after
+    while True:
+        query = db.collection(collection).select(fields).order_by("__name__").limit(page_size)
+        if last is not None:
+            query = query.start_after({"__name__": last})
+        metrics.inc("firestore_requests_total", op="page", collection=collection)
+        docs = list(query.stream())
+        if not docs:
+            return
+        yield [{"id": d.id, **(d.to_dict() or {})} for d in docs]
+        last = docs[-1].id
+
+
+def _project(collection, doc_id, data):
+    fields = FIELDS[collection]
+    return {"id": doc_id, **{k: v for k, v in (data or {}).items() if k in fields}}
+
+
+class SnapshotCache:
+    """Local copy of one collection; `version` moves whenever its contents change.
+
+    The ids behind each of the last CHANGE_LOG_SIZE versions are kept, so a reader that synced
+    an older version can apply just the difference (changes_since).
+    """
+
+    def __init__(self, collection, mode=CACHE_MODE):
+        self.collection = collection
+        self.mode = mode
+        self.version = 0
+        self._docs = {}
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._loaded_at = 0.0
+        self._refreshing = False
+        self._watch = None
+        self.error = None   # the last failed load, for start-up readiness
+        self._log = []      # (version, ids changed or removed in it), oldest first
+        self._log_base = 0  # oldest version changes_since can start from
+
+    def __len__(self):
+        return len(self._docs)
+
+    @property
+    def loaded(self):
+        return self._loaded.is_set()
+
+    def start(self):
+        if self.mode == "listen":
+            try:
+                self._watch = _client().collection(self.collection).on_snapshot(self._on_snapshot)
+                return self
+            except Exception as e:
+                print(f"[item_store] no listener for {self.collection} ({e}), polling instead")
+                self.error = e
+                self.mode = "poll"
+        if self.mode == "poll":
+            self._refresh_async()
+        return self
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    def _on_snapshot(self, col_snapshot, changes, read_time):
+        with self._lock:
+            changed = set()
+            for change in changes:
+                doc = change.document
+                if change.type.name == "REMOVED":
+                    if self._docs.pop(doc.id, None) is not None:
+                        changed.add(doc.id)
+                    continue
+                new = _overlay_pending(self.collection, _project(self.collection, doc.id, doc.to_dict()))
+                #our own writes come back here once committed; they are already applied
+                if self._docs.get(doc.id) != new:
+                    self._docs[doc.id] = new
+                    changed.add(doc.id)
+            if changed or not self.loaded:
+                self._bump(changed)
+        self._loaded_at = time.monotonic()
+        self._loaded.set()
+
+    def _load(self):
+        t0 = time.perf_counter()
+        docs = {}
+        for page in stream_pages(_client(), self.collection, list(FIELDS[self.collection]), PAGE_SIZE):
+            for item in page:
+                docs[item["id"]] = _overlay_pending(self.collection, item)
+        with self._lock:
+            if docs != self._docs or not self.loaded:
+                old = self._docs
+                changed = {i for i, doc in docs.items() if old.get(i) != doc} | (old.keys() - docs.keys())
+                self._docs = docs
+                self._bump(changed)
+        self._loaded_at = time.monotonic()
+        self._loaded.set()
+        print(f"[item_store] loaded {len(docs)} {self.collection} in {time.perf_counter() - t0:.2f}s")
+
+    def _bump(self, changed):
+        #under self._lock. the first snapshot has no usable history: readers start with a full sync
+        self.version = next(_versions)
+        if not self.loaded:
+            self._log, self._log_base = [], self.version
+            return
+        self._log.append((self.version, changed))
+        if len(self._log) > CHANGE_LOG_SIZE:
+            half = CHANGE_LOG_SIZE // 2
+            self._log_base = self._log[half - 1][0]
+            del self._log[:half]
+
+    def changes_since(self, version):
+        """(version, changed documents, removed ids) since `version`; None when the log doesn't reach back."""
+        self.ensure_loaded()
+        with self._lock:
+            if version is None or version < self._log_base or version > self.version:
+                return None
+            ids = set()
+            for v, changed in self._log:
+                if v > version:
+                    ids |= changed
+            docs = [self._docs[i] for i in ids if i in self._docs]
+            return self.version, docs, ids - self._docs.keys()
+
+    def _refresh_async(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self._load()
+                self.error = None
+            except Exception as e:
+                print(f"[item_store] refreshing {self.collection} failed:", e)
+                self.error = e
+            finally:
+                self._refreshing = False
+        threading.Thread(target=run, name=f"item-store-{self.collection}", daemon=True).start()
+
+    def ensure_loaded(self):
+        if self.loaded:
+            #poll mode serves the current snapshot while a newer one loads
+            if self.mode == "poll" and time.monotonic() - self._loaded_at > CACHE_TTL_S:
+                self._refresh_async()
+            return
+        if (self.mode == "listen" or self._refreshing) and self._loaded.wait(LOAD_TIMEOUT_S):
+            return
+        self._load()
+
+    def items(self) -> list:
+        self.ensure_loaded()
+        with self._lock:
+            return list(self._docs.values())
+
+    def get(self, doc_id):
+        """The cached document (a copy), or None when it isn't in the snapshot."""
+        with self._lock:
+            doc = self._docs.get(doc_id)
+            return dict(doc) if doc is not None else None
+
+    def merge(self, doc_id, data):
+        #no version bump: writes only carry derived fields (gate/OCR), nothing the indexes are built from
+        with self._lock:
+            doc = self._docs.get(doc_id)
+            if doc is not None:
+                self._docs[doc_id] = {**doc, **{k: v for k, v in data.items() if k in FIELDS[self.collection]}}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(collection: str) -> SnapshotCache:
+    with _caches_lock:
+        cache = _caches.get(collection)
+        if cache is None:
+            cache = _caches[collection] = SnapshotCache(collection)
+            if cache.mode != "off":
+                cache.start()
+        return cache
+
+
+def start():
+    """Begin loading both snapshots in the background."""
+    for collection in COLLECTIONS:
+        get_cache(collection)
+
+
+def wait_loaded(timeout: float = LOAD_TIMEOUT_S):
+    """Block until both snapshots hold data; raises if one can't be loaded within timeout.
+
+    In "off" mode there is nothing to wait for, so it only checks Firestore answers.
+    """
+    deadline = time.monotonic() + timeout
+    for collection in COLLECTIONS:
+        cache = get_cache(collection)
+        if cache.mode == "off":
+            metrics.inc("firestore_requests_total", op="page", collection=collection)
+            list(_client().collection(collection).select([]).limit(1).stream())
+            continue
+        while not cache._loaded.wait(0.2):
+            #a failed poll load isn't retried until the next read, so there is nothing to wait for
+            if time.monotonic() >= deadline or (cache.mode == "poll" and cache.error and not cache._refreshing):
+                reason = f": {type(cache.error).__name__}: {cache.error}" if cache.error else ""
+                raise RuntimeError(f"{collection} snapshot not loaded{reason}")
+
+
+def items(collection: str) -> list:
+    """Every document of the collection as {"id", **FIELDS}; treat the dicts as read-only."""
+    cache = get_cache(collection)
+    if cache.mode == "off":
+        return [item for page in stream_pages(_client(), collection, list(FIELDS[collection]), PAGE_SIZE)
+                for item in page]
+    return cache.items()
+
+
+def version(collection: str):
+    """Changes whenever the collection's snapshot does; None when nothing is cached."""
+    cache = get_cache(collection)
+    return None if cache.mode == "off" else cache.version
+
+
+def changes(collection: str, since):
+    """(version, changed documents, removed ids) since snapshot version `since`, or None when
+    they can't be told apart from the log (nothing cached, a reset, or too long ago)."""
+    cache = get_cache(collection)
+    return None if cache.mode == "off" else cache.changes_since(since)
+
+
+def find_many(item_ids) -> dict:
+    """{item_id: (collection, document)} for ids in either collection (lostItems wins a tie).
+
+    Ids found in the snapshots cost nothing; the rest are fetched from both collections in
+    one get_all.
+    """
+    found, missing = {}, []
+    for item_id in item_ids:
+        for collection in COLLECTIONS:
+            cache = get_cache(collection)
+            doc = cache.get(item_id) if cache.loaded else None
+            if doc is not None:
+                found[item_id] = (collection, doc)
+                break
+        else:
+            missing.append(item_id)
+    if not missing:
+        return found
+
+    db = _client()
+    refs = [db.collection(c).document(i) for i in missing for c in COLLECTIONS]
+    metrics.inc("firestore_requests_total", op="get_all", collection="both")
+    fields = sorted({f for c in COLLECTIONS for f in FIELDS[c]})
+    snaps = {}
+    for snap in db.get_all(refs, field_paths=fields):
+        if snap.exists:
+            snaps[(snap.reference.parent.id, snap.id)] = snap
+    for item_id in missing:
+        for collection in COLLECTIONS:
+            snap = snaps.get((collection, item_id))
+            if snap is not None:
+                found[item_id] = (collection, _overlay_pending(collection, _project(collection, item_id, snap.to_dict())))
+                break
+    return found
+
+
+def find(item_id):
+    """(collection, document) for an id in either collection, or (None, None)."""
+    return find_many([item_id]).get(item_id, (None, None))
+
+
+# --- writes ---
+
+_pending = {}           # (collection, doc id) -> fields to merge
+_pending_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_wake = threading.Event()
+_flusher = None
+
+
+def _overlay_pending(collection, doc):
+    #a snapshot arriving before our own write is committed mustn't hide it
+    with _pending_lock:
+        data = _pending.get((collection, doc["id"]))
+    return {**doc, **data} if data else doc
+
+
+def write(collection: str, doc_id: str, data: dict):
+    """Merge `data` into a document: visible to reads now, committed by the next flush."""
+    global _flusher
+    with _pending_lock:
+        key = (collection, doc_id)
+        _pending[key] = {**_pending.get(key, {}), **data}
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name="item-store-flush", daemon=True)
+            _flusher.start()
+    cache = _caches.get(collection)
+    if cache is not None:
+        cache.merge(doc_id, data)
+    _wake.set()
+
+
+def _flush_loop():
+    while True:
+        _wake.wait()
+        #let the writes of the same request (gate, then OCR) land in one commit
+        time.sleep(FLUSH_INTERVAL_S)
+        _wake.clear()
+        flush()
+
+
+def flush() -> int:
+    """Commit every pending write now; returns how many documents were written."""
+    global _pending
+    with _flush_lock:
+        with _pending_lock:
+            pending, _pending = _pending, {}
+        if not pending:
+            return 0
+        db = _client()
+        written = 0
+        todo = list(pending.items())
+        for i in range(0, len(todo), MAX_BATCH_WRITES):
+            chunk = todo[i:i + MAX_BATCH_WRITES]
+            batch = db.batch()
+            for (collection, doc_id), data in chunk:
+                batch.set(db.collection(collection).document(doc_id), data, merge=True)
+            metrics.inc("firestore_requests_total", op="commit", collection="both")
+            try:
+                batch.commit()
+                written += len(chunk)
+            except Exception as e:
+                print(f"[item_store] commit of {len(chunk)} writes failed, retrying later:", e)
+                metrics.inc("firestore_write_errors_total", len(chunk))
+                with _pending_lock:
+                    for key, data in chunk:
+                        #anything written since stays on top
+                        _pending[key] = {**data, **_pending.get(key, {})}
+                _wake.set()
+        return written
+
+
+atexit.register(flush)
+
+
+def stats() -> dict:
+    with _caches_lock:
+        caches = dict(_caches)
+    with _pending_lock:
+        pending = len(_pending)
+    return {
+        "collections": {c: {"mode": cache.mode, "loaded": cache.loaded, "docs": len(cache), "version": cache.version}
+                        for c, cache in caches.items()},
+        "pending_writes": pending,
+    }
+
+
+def reset():
+    """Drop the snapshots (and their listeners); pending writes are kept."""
+    with _caches_lock:
+        for cache in _caches.values():
+            cache.stop()
+        _caches.clear()
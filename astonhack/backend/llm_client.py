@@ -0,0 +1,170 @@
+import os
+import hashlib
+import random
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import httpx
+from dotenv import load_dotenv
+from PIL import Image
+from google import genai
+from google.genai import errors, types
+
+from image_artifact import ImageArtifact
+import metrics
+
+load_dotenv(Path(__file__).with_name(".env"))
+
+# one access layer for every Gemini call (gate, OCR, verdict): a shared client (so the
+# underlying HTTP connections are pooled), a concurrency cap per model, retries with
+# jittered backoff on 429/5xx inside a per-call deadline, and a response cache keyed by
+# model + prompt hash + image content hash.
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+DEADLINE_S = float(os.getenv("LLM_DEADLINE_S", "45"))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+CACHE_TTL_S = float(os.getenv("LLM_CACHE_TTL_S", "3600"))
+
+RETRYABLE = {408, 429, 500, 502, 503, 504}
+
+_client = None
+_client_lock = threading.Lock()
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get_client() -> genai.Client:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = genai.Client(api_key=GEMINI_API_KEY)
+    return _client
+
+
+def _semaphore(model: str) -> threading.BoundedSemaphore:
+    with _semaphores_lock:
+        sem = _semaphores.get(model)
+        if sem is None:
+            sem = _semaphores[model] = threading.BoundedSemaphore(CONCURRENCY)
+        return sem
+
+
+def _to_part(content):
+    #ImageArtifacts are uploaded as their raw bytes; everything else is passed through
+    if isinstance(content, ImageArtifact):
+        return types.Part.from_bytes(data=content.data, mime_type=content.mime)
+    return content
+
+
+def _digest(model: str, contents, config) -> str:
+    h = hashlib.sha256(model.encode("utf-8"))
+    for content in contents:
+        if isinstance(content, ImageArtifact):
+            h.update(b"artifact:" + content.sha256.encode("ascii"))
+        elif isinstance(content, str):
+            h.update(b"text:" + hashlib.sha256(content.encode("utf-8")).digest())
+        elif isinstance(content, bytes):
+            h.update(b"bytes:" + hashlib.sha256(content).digest())
+        elif isinstance(content, Image.Image):
+            h.update(f"pil:{content.mode}:{content.size}".encode("ascii"))
+            h.update(hashlib.sha256(content.tobytes()).digest())
+        elif isinstance(content, types.Part) and content.inline_data is not None:
+            h.update(f"part:{content.inline_data.mime_type}".encode("ascii"))
+            h.update(hashlib.sha256(content.inline_data.data).digest())
+        else:
+            h.update(repr(content).encode("utf-8"))
+    if config is not None:
+        h.update(config.model_dump_json(exclude={"http_options"}, exclude_none=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _cache_get(key):
+    with _cache_lock:
+        hit = _cache.get(key)
+        if hit is None:
+            return None
+        stored_at, resp = hit
+        if time.monotonic() - stored_at > CACHE_TTL_S:
+            del _cache[key]
+            return None
+        _cache.move_to_end(key)
+        return resp
+
+
+def _cache_put(key, resp):
+    with _cache_lock:
+        _cache[key] = (time.monotonic(), resp)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def generate(model: str, contents, config: types.GenerateContentConfig | None = None,
+             deadline_s: float = DEADLINE_S, use_cache: bool = True):
+    """generate_content with caching, a per-model concurrency limit, retries and a deadline.
+
+    Raises TimeoutError when the deadline runs out before a successful response.
+    """
+    contents = list(contents)
+    key = _digest(model, contents, config) if use_cache else None
+    if key is not None:
+        cached = _cache_get(key)
+        if cached is not None:
+            metrics.inc("llm_cache_total", model=model, result="hit")
+            return cached
+        metrics.inc("llm_cache_total", model=model, result="miss")
+
+    parts = [_to_part(c) for c in contents]
+    metrics.inc("llm_upload_bytes_total", sum(len(p.inline_data.data) for p in parts
+                                              if isinstance(p, types.Part) and p.inline_data is not None), model=model)
+    deadline = time.monotonic() + deadline_s
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"LLM call to {model} exceeded its {deadline_s:.0f}s deadline")
+        call_config = (config or types.GenerateContentConfig()).model_copy(
+            update={"http_options": types.HttpOptions(timeout=max(1, int(remaining * 1000)))}
+        )
+        try:
+            with _semaphore(model):
+                t0 = time.perf_counter()
+                try:
+                    resp = get_client().models.generate_content(model=model, contents=parts, config=call_config)
+                finally:
+                    metrics.observe("llm_call_seconds", time.perf_counter() - t0, model=model)
+            break
+        except httpx.TimeoutException as e:
+            metrics.inc("llm_errors_total", model=model, code="timeout")
+            raise TimeoutError(f"LLM call to {model} exceeded its {deadline_s:.0f}s deadline") from e
+        except errors.APIError as e:
+            metrics.inc("llm_errors_total", model=model, code=e.code)
+            attempt += 1
+            if e.code not in RETRYABLE or attempt > MAX_RETRIES:
+                raise
+            #full jitter exponential backoff, capped by what's left of the deadline
+            delay = random.uniform(0, min(8.0, 0.5 * 2 ** attempt))
+            if time.monotonic() + delay >= deadline:
+                raise
+            print(f"[llm] {model} returned {e.code}, retry {attempt}/{MAX_RETRIES} in {delay:.1f}s")
+            time.sleep(delay)
+
+    _count_tokens(model, resp)
+    if key is not None:
+        _cache_put(key, resp)
+    return resp
+
+
+def _count_tokens(model, resp):
+    usage = getattr(resp, "usage_metadata", None)
+    if usage is None:
+        return
+    for kind, value in (("prompt", usage.prompt_token_count), ("output", usage.candidates_token_count),
+                        ("thoughts", getattr(usage, "thoughts_token_count", None))):
+        if value:
+            metrics.inc("llm_tokens_total", value, model=model, kind=kind)
@@ -1,25 +1,27 @@
+import time
+_import_t0 = time.perf_counter()
 import os
-import uvicorn
-from fastapi import FastAPI, HTTPException
+import asyncio
+import functools
+import contextvars
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from database import get_firestore
-import tempfile
-from pathlib import Path
-import mimetypes
-import clip_input
-import gate
+import metrics
+import startup
 import traceback
-import requests
-import ocr_agent
 import json
-from PIL import Image
-from io import BytesIO
-from google import genai
-from google.genai import types
 
 from pydantic import BaseModel, Field
 from typing import List, Optional, Literal
 
+# only light modules are imported above, so a worker answers /health within a fraction of a
+# second. torch/CLIP, Firestore, Gemini and the OCR pipeline are imported and initialised by
+# the lifespan on background threads (see startup.py); /ready reports each one's init time.
+# functions below import what they need locally, which is free once startup has run.
+
 
 class MatchRequest(BaseModel):
     itemId: str
@@ -33,8 +35,68 @@ class MatchResponse(BaseModel):
 
     class Config:
         extra = "forbid"  # ensures you don't accidentally return old keys
+
+class BatchMatchRequest(BaseModel):
+    itemIds: List[str]
+
+class BatchMatchResult(BaseModel):
+    itemId: str
+    result: Optional[MatchResponse] = None
+    error: Optional[str] = None
+
+class BatchMatchResponse(BaseModel):
+    results: List[BatchMatchResult]
         
-app = FastAPI()
+def init_torch():
+    import torch  # noqa: F401
+
+def init_clip():
+    import clip_model
+    clip_model.load()
+
+def init_pipeline():
+    import clip_input, decision_engine, image_artifact  # noqa: F401
+
+def init_store():
+    #start snapshotting lostItems/foundItems so the first /match doesn't pay for the scan, and
+    #only report ready once both are loaded (a failed client or listener fails this step)
+    import item_store
+    item_store.start()
+    item_store.wait_loaded()
+
+def init_llm():
+    import llm_client
+    llm_client.get_client()
+
+def init_ocr():
+    import gate, ocr_agent  # noqa: F401
+
+def init_ingest():
+    #optionally keep this worker's index fresh in-process ("listen" or "poll"); otherwise run
+    #ingest_worker.py as its own process and the index syncs from the shared embedding store
+    global ingest
+    import ingest_worker
+    ingest = ingest_worker.IngestWorker(run_gate=os.getenv("INGEST_GATE") == "1").start(os.getenv("INGEST_MODE"))
+
+@asynccontextmanager
+async def lifespan(app):
+    #CLIP is the long pole: it loads on its own thread while the clients come up on another,
+    #and the Firestore snapshots load on a third
+    groups = [
+        [("torch", init_torch), ("clip", init_clip), ("pipeline", init_pipeline)],
+        [("llm", init_llm, False), ("ocr", init_ocr)],
+        [("store", init_store)],
+    ]
+    if os.getenv("INGEST_MODE"):
+        groups[0].append(("ingest", init_ingest, False))
+    startup.start(groups)
+    yield
+    if ingest is not None:
+        ingest.stop()
+    import item_store
+    item_store.flush()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:5173",
@@ -49,15 +111,99 @@ app.add_middleware(
     allow_headers = ['*'],
 )
 
+ingest = None
+SERVER_TIMING = os.getenv("SERVER_TIMING", "1") != "0"
+
+@app.get("/ingest/stats")
+def ingest_stats():
+    if ingest is None:
+        raise HTTPException(status_code=404, detail="Ingestion is not running in this process")
+    return ingest.stats()
+
+@app.middleware("http")
+async def record_timings(request: Request, call_next):
+    #per-stage durations of this request go out as a Server-Timing header
+    timings = metrics.start_request()
+    t0 = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - t0
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    metrics.observe("http_request_seconds", elapsed, path=route, status=response.status_code)
+    if SERVER_TIMING:
+        timings.append(("total", elapsed))
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/health")
+def health():
+    return {"status": "ok"}
+
+@app.get("/ready")
+def ready(response: Response):
+    #/ready only turns 200 once CLIP is warm and the clients are up
+    if startup.ready():
+        import clip_model, inference_scheduler, item_store
+        return {"ready": True, "model": clip_model.MODEL_NAME, "backend": clip_model.BACKEND,
+                "inference": inference_scheduler.stats(), "store": item_store.stats(),
+                "startup": startup.report()}
+    response.status_code = 503
+    return {"ready": False, "startup": startup.report()}
+
 @app.post("/match", response_model=MatchResponse)
-def run_match(req: MatchRequest):
+async def run_match(req: MatchRequest, request: Request):
+    if not startup.ready():
+        raise HTTPException(status_code=503, detail="Model is still loading")
+    task = asyncio.ensure_future(final_verdict_async(req.itemId))
+    try:
+        return await cancel_on_disconnect(request, task)
+    except HTTPException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/match/batch", response_model=BatchMatchResponse)
+async def run_match_batch(req: BatchMatchRequest, request: Request):
+    if not startup.ready():
+        raise HTTPException(status_code=503, detail="Model is still loading")
+    if len(req.itemIds) > MATCH_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {MATCH_BATCH_MAX_ITEMS} item ids per batch")
+    task = asyncio.ensure_future(match_batch_async(req.itemIds))
     try:
-        result = final_verdict(req.itemId)
-        return result
+        outcomes = await cancel_on_disconnect(request, task)
+    except HTTPException:
+        raise
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+    #partial failures are reported per id instead of failing the whole batch
+    results = []
+    for item_id, outcome in outcomes.items():
+        if isinstance(outcome, Exception):
+            results.append(BatchMatchResult(itemId=item_id, error=str(outcome)))
+            continue
+        try:
+            results.append(BatchMatchResult(itemId=item_id, result=MatchResponse(**outcome)))
+        except Exception as e:
+            results.append(BatchMatchResult(itemId=item_id, error=f"Invalid verdict: {e}"))
+    return BatchMatchResponse(results=results)
+
+async def cancel_on_disconnect(request: Request, task: asyncio.Task, poll_s: float = 0.25):
+    #stop scheduling further stages (and LLM calls) once the client has gone away
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=poll_s)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            task.cancel()
+            print("[match] client disconnected, cancelled pipeline")
+            raise HTTPException(status_code=499, detail="Client disconnected")
+
 def calculate_margin(candidates):
     # candidates: list[dict] sorted by clip_score desc (top first)
     if not candidates or len(candidates) < 2:
@@ -66,97 +212,131 @@ def calculate_margin(candidates):
 
         
 
-def url_to_temp_path(image_url: str) -> str:
-    r = requests.get(image_url, timeout=20)
-    r.raise_for_status()
-
-    # Prefer the server’s content-type; fallback to URL extension; final fallback .jpg
-    content_type = (r.headers.get("Content-Type") or "").split(";")[0].strip().lower()
-    ext = mimetypes.guess_extension(content_type) if content_type else None
-    if not ext:
-        ext = Path(image_url).suffix or ".jpg"
-
-    f = tempfile.NamedTemporaryFile(delete=False, suffix=ext)
-    f.write(r.content)
-    f.close()
-    return f.name
-
-
-db = get_firestore()
-
-def final_verdict(item_id):
-
+#number of CLIP candidates handed to the verdict stage
+MATCH_TOP_K = int(os.getenv("MATCH_TOP_K", "3"))
+
+#CLIP encoding runs here so it doesn't compete with the I/O threads of asyncio.to_thread
+_cpu_pool = ThreadPoolExecutor(max_workers=int(os.getenv("CPU_WORKERS", "2")), thread_name_prefix="cpu")
+
+async def run_cpu(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    #carry the request context over, so spans in the pool land in this request's Server-Timing
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_cpu_pool, functools.partial(ctx.run, fn, *args, **kwargs))
+
+async def timed(stage, awaitable):
+    with metrics.span(stage):
+        return await awaitable
+
+def run_gate_and_ocr(artifact, item_id, data, ocr_mode):
+    """Gate + (optional) OCR for a found item. Returns (should_ocr, text)."""
+    import gate, identifiers, item_store, ocr_agent
+    text = ""
+    #get the json (reused from the document when the image and gate version are unchanged)
+    with metrics.span("gate"):
+        json_file = gate.ocr_gate_from_file(artifact, item_id, 'foundItems', stored=data)
+    should_ocr = bool(json_file.get("should_ocr", False))
+
+    if should_ocr:
+        version = ocr_agent.ocr_version(ocr_mode)
+        if data.get("ocr_image_hash") == artifact.sha256 and data.get("ocr_version") == version:
+            text = data.get("ocr_output") or ""
+            metrics.inc("cache_total", cache="ocr", result="hit")
+        else:
+            metrics.inc("cache_total", cache="ocr", result="miss")
+            with metrics.span("ocr", mode=ocr_mode):
+                text = ocr_agent.run_ocr(artifact, mode=ocr_mode)
+            item_store.write('foundItems', item_id,
+                             {"ocr_output": text, "ocr_image_hash": artifact.sha256, "ocr_version": version})
+            identifiers.get_index('foundItems').update(item_id, text)
+        print(text)
+    return should_ocr, text
+
+def final_verdict(item_id, k=MATCH_TOP_K, ocr_mode=None):
+    """Blocking wrapper around final_verdict_async for scripts."""
+    return asyncio.run(final_verdict_async(item_id, k=k, ocr_mode=ocr_mode))
+
+def lost_query_text(data):
+    #lost items without a description still have a name/colour to search with
+    return data.get('description') or " ".join(filter(None, [data.get('color'), data.get('name')]))
+
+async def final_verdict_async(item_id, k=MATCH_TOP_K, ocr_mode=None):
+    # stage graph:
+    #   lost doc || found doc
+    #     lost  -> CLIP(match_text)                                   -> verdict
+    #     found -> image -> CLIP(match_img) || gate -> OCR            -> verdict
+    import clip_input, item_store, ocr_agent
+    from image_artifact import ImageArtifact
+    ocr_mode = ocr_mode or ocr_agent.OCR_MODE
     text = ""          # default: no OCR output
     should_ocr = False # default: don't OCR
-    img_url = None     # default: no image url yet
-    #First, run the clip model with the image
-    # 1) Try lostItems/{item_id}
-    lost_ref = db.collection("lostItems").document(item_id)
-    lost_snap = lost_ref.get()
-    found_ref = db.collection("foundItems").document(item_id)
-    found_snap = found_ref.get()
-    if lost_snap.exists:
-        data = lost_snap.to_dict() or {}
-        data["_doc_id"] = lost_snap.id
-        collection = 'lostItems'
-        best_three = clip_input.match_text(data.get('description'))
-    elif found_snap.exists:
-        data = found_snap.to_dict() or {}
-        data["_doc_id"] = found_snap.id
-        collection = 'foundItems'
-        best_three = clip_input.match_img(data.get('imageUrl'))
+    artifact = None    # found-item image, shared by CLIP, gate, OCR and verdict
+
+    # 1) look the id up in both collections at once (local snapshot, else one get_all)
+    with metrics.span("firestore_get"):
+        collection, data = await asyncio.to_thread(item_store.find, item_id)
+    if collection == 'lostItems':
+        data["_doc_id"] = item_id
+        with metrics.span("clip_match"):
+            best_three = await run_cpu(clip_input.match_text, lost_query_text(data), k=k, item=data)
+    elif collection == 'foundItems':
+        data["_doc_id"] = item_id
+        img_url = data.get('imageUrl')
+        with metrics.span("image_download"):
+            artifact = await asyncio.to_thread(ImageArtifact.from_url, img_url)
+        # 2) CLIP retrieval and the gate/OCR chain only share the image, so run them together
+        best_three, (should_ocr, text) = await asyncio.gather(
+            timed("clip_match", run_cpu(clip_input.match_img, img_url, k=k, artifact=artifact, item=data)),
+            asyncio.to_thread(run_gate_and_ocr, artifact, item_id, data, ocr_mode),
+        )
     else:
         # 3) Not found
         raise ValueError(f"Item id not found in lostItems or foundItems: {item_id}")
 
-    #now, run the image thorugh the gate
-    best_three_structured = []
-    for rank, cand in enumerate(best_three, start=1):
-        best_three_structured.append({
-            "rank": rank,
-            "candidate_id": cand["candidate_id"],
-            "text": cand.get("text") or cand.get("image_names") or "",
-            "clip_score": float(cand["clip_score"]),
-        })
+    return await verdict_stage(item_id, collection, data, artifact, best_three, should_ocr, text)
+
+def add_identifier_hits(collection, data, best_three, text):
+    """Look identifiers up in the opposite collection and merge the hits into the candidates."""
+    import identifiers, vector_index
+    if collection == 'lostItems':
+        other, label_key = 'foundItems', 'image_names'
+        hits = identifiers.find(other, identifiers.item_text(collection, data))
+    else:
+        other, label_key = 'lostItems', 'text'
+        hits = identifiers.find(other, text)
+    if not hits:
+        return best_three, hits
+    print(f"[identifiers] {data.get('_doc_id')} -> {hits}")
+    merged = [dict(c, identifiers=hits[c["candidate_id"]]) if c["candidate_id"] in hits else c
+              for c in best_three]
+    seen = {c["candidate_id"] for c in best_three}
+    labels = vector_index.get_index(other).meta
+    #strong hits first, then the most shared tokens; the packet only takes the first few
+    extra = sorted((doc_id for doc_id in hits if doc_id not in seen),
+                   key=lambda d: (-sum(map(identifiers.is_strong, hits[d])), -len(hits[d]), d))
+    extra = extra[:identifiers.MAX_HIT_CANDIDATES]
+    for doc_id in extra:
+        #not in CLIP's top-k, so there is no score to report
+        merged.append({"candidate_id": doc_id, label_key: labels.get(doc_id, {}).get("label"),
+                       "clip_score": None, "identifiers": hits[doc_id]})
+    #hits that didn't make the packet don't count as evidence either
+    kept = seen | set(extra)
+    return merged, {doc_id: toks for doc_id, toks in hits.items() if doc_id in kept}
+
+async def verdict_stage(item_id, collection, data, artifact, best_three, should_ocr, text):
+    import decision_engine
     margin = calculate_margin(best_three)
     print(margin)
+    with metrics.span("identifiers"):
+        best_three, hits = add_identifier_hits(collection, data, best_three, text)
 
     if collection == 'foundItems':
-        doc_ref = db.collection(collection).document(item_id)
-
-        snap = doc_ref.get() 
-
-        if not snap.exists:
-            raise ValueError("Document not found")
-
-        data = snap.to_dict()
-        img_url = data.get("imageUrl")   
-
-        r = requests.get(img_url, timeout=20)
-        r.raise_for_status()
-
-        #get the json
-        json_file = gate.ocr_gate_from_file(img_url, r, snap.id, collection)
-        should_ocr = bool(json_file.get("should_ocr", False))
-
-        if should_ocr:
-            tmp_path = url_to_temp_path(img_url)
-            try:
-                text = ocr_agent.run_ocr_agent_on_path(tmp_path)
-                print(text)
-                doc_ref.update({"ocr_output": text})
-            finally:
-                try:
-                    os.remove(tmp_path)
-                except OSError:
-                    pass
-    if collection == 'foundItems':
-        tmp_path = url_to_temp_path(img_url)
-        input_q = Image.open(tmp_path).convert("RGB")
+        import media_prep
+        input_q = media_prep.prepare(artifact, "verdict")
     elif collection == 'lostItems':
-        input_q = data.get('description')
+        #the same colour + name fallback as retrieval; a None or empty part fails the Gemini call
+        input_q = lost_query_text(data) or "(no description given)"
 
-        
     #now, combine everything and give it to the gemini agent to decide on the final verdict
     decision_packet = {
         "given_id": item_id,
@@ -165,11 +345,102 @@ def final_verdict(item_id):
         "should_ocr" : should_ocr,
         "ocr_results" : text,
     }
-    GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-    client = genai.Client(api_key=GEMINI_API_KEY)
-
-
-    PROMPT = """
+    #decide locally when the rules already fix the outcome; Gemini only for the ambiguous band
+    verdict, path = decision_engine.decide(item_id, best_three, margin, text, identifier_hits=hits)
+    decision_engine.record(item_id, path)
+    if verdict is not None:
+        print(verdict)
+        return verdict
+
+    with metrics.span("llm_verdict"):
+        return await asyncio.to_thread(llm_verdict, input_q, decision_packet)
+
+
+#/match/batch: at most this many ids per call, and this many items in gate/OCR/verdict at once
+MATCH_BATCH_MAX_ITEMS = int(os.getenv("MATCH_BATCH_MAX_ITEMS", "500"))
+MATCH_BATCH_CONCURRENCY = int(os.getenv("MATCH_BATCH_CONCURRENCY", "8"))
+
+async def match_batch_async(item_ids, k=MATCH_TOP_K, ocr_mode=None):
+    """Run the /match pipeline for many ids. Returns {item_id: verdict dict or Exception}."""
+    import clip_input, item_store, ocr_agent
+    from image_artifact import ImageArtifact
+    ocr_mode = ocr_mode or ocr_agent.OCR_MODE
+    ids = list(dict.fromkeys(item_ids))
+    results = {}
+    slots = asyncio.Semaphore(MATCH_BATCH_CONCURRENCY)
+
+    # 1) every id from the local snapshots; the ones they don't have yet in one get_all
+    docs = await asyncio.to_thread(item_store.find_many, ids)
+    lost = {i: {**docs[i][1], "_doc_id": i} for i in ids if i in docs and docs[i][0] == "lostItems"}
+    found = {i: {**docs[i][1], "_doc_id": i} for i in ids if i in docs and docs[i][0] == "foundItems"}
+    for i in ids:
+        if i not in lost and i not in found:
+            results[i] = ValueError(f"Item id not found in lostItems or foundItems: {i}")
+
+    async def bounded(item_id, coro_fn):
+        async with slots:
+            try:
+                return await coro_fn()
+            except Exception as e:
+                results[item_id] = e
+                return None
+
+    async def lost_stage():
+        if not lost:
+            return
+        # 2a) every description encoded and scored in one pass
+        try:
+            candidates = await run_cpu(clip_input.match_texts, [lost_query_text(d) for d in lost.values()], k=k,
+                                       items=list(lost.values()))
+        except Exception as e:
+            for i in lost:
+                results[i] = e
+            return
+        verdicts = await asyncio.gather(*[
+            bounded(i, functools.partial(verdict_stage, i, "lostItems", data, None, best, False, ""))
+            for (i, data), best in zip(lost.items(), candidates)
+        ])
+        for i, verdict in zip(lost, verdicts):
+            if verdict is not None:
+                results[i] = verdict
+
+    async def found_stage():
+        if not found:
+            return
+        # 2b) images downloaded concurrently; a failed download only fails that id
+        loaded = await asyncio.gather(*[
+            bounded(i, functools.partial(asyncio.to_thread, ImageArtifact.from_url, data.get("imageUrl")))
+            for i, data in found.items()
+        ])
+        artifacts = {i: a for i, a in zip(found, loaded) if a is not None}
+        if not artifacts:
+            return
+        # 3) one CLIP pass for all images, alongside the per-item gate/OCR chains
+        stage = await asyncio.gather(
+            run_cpu(clip_input.match_imgs, list(artifacts.values()), k=k, items=[found[i] for i in artifacts]),
+            *[bounded(i, functools.partial(asyncio.to_thread, run_gate_and_ocr, a, i, found[i], ocr_mode))
+              for i, a in artifacts.items()],
+            return_exceptions=True,
+        )
+        candidates, ocr = stage[0], dict(zip(artifacts, stage[1:]))
+        if isinstance(candidates, Exception):
+            for i in artifacts:
+                results[i] = candidates
+            return
+        todo = [(i, best) for i, best in zip(artifacts, candidates) if ocr[i] is not None]
+        verdicts = await asyncio.gather(*[
+            bounded(i, functools.partial(verdict_stage, i, "foundItems", found[i], artifacts[i], best, *ocr[i]))
+            for i, best in todo
+        ])
+        for (i, _), verdict in zip(todo, verdicts):
+            if verdict is not None:
+                results[i] = verdict
+
+    await asyncio.gather(lost_stage(), found_stage())
+    return {i: results[i] for i in ids}
+
+
+VERDICT_PROMPT = """
     You are a strict verifier for a lost-and-found matching system.
     You will receive a JSON object with a source item and up to 3 candidate matches.
     Each candidate includes a CLIP similarity score and may include OCR output text.
@@ -221,9 +492,13 @@ def final_verdict(item_id):
     }
     """
 
-    resp = client.models.generate_content(
+
+def llm_verdict(input_q, decision_packet):
+    from google.genai import types
+    import llm_client
+    resp = llm_client.generate(
             model="gemini-2.0-flash",
-            contents=[PROMPT,input_q,json.dumps(decision_packet)],
+            contents=[VERDICT_PROMPT,input_q,json.dumps(decision_packet)],
             config=types.GenerateContentConfig(
                 temperature=0,
                 response_mime_type="application/json",
@@ -250,5 +525,8 @@ def final_verdict(item_id):
     print(structured)
     return structured  # in Flask: return jsonify(structured)
 
+startup.record("import", time.perf_counter() - _import_t0)
+
 if __name__ == '__main__':
-    uvicorn.run(gate, host= "0.0.0.0",port = 8000)
+    import uvicorn
+    uvicorn.run("main:app", host= "0.0.0.0",port = 8000)
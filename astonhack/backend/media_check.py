@@ -0,0 +1,144 @@
+import os
+import argparse
+import difflib
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+import gate
+import identifiers
+import image_fetcher
+import llm_client
+import media_prep
+import tools
+from image_artifact import ImageArtifact
+
+# check of the media_prep profiles against the images they replace. for every sample it reports
+#   bytes: original vs prepared upload per profile (gate, verdict, ocr) and the time to prepare
+# and with --llm (real Gemini calls, response cache off) also
+#   gate agreement: share of images where should_ocr is the same for the original and the gate copy
+#   identifier recall: share of identifiers read from the old OCR input (thresholded full image)
+#                      that are still read from the OCR copy
+#   text similarity and call latency, both ways
+# lower a profile's size only while agreement and recall stay acceptable.
+#
+#   python media_check.py --images ./samples
+#   python media_check.py --limit 50 --llm      # sample foundItems from Firestore
+MIN_GATE_AGREEMENT = float(os.getenv("MEDIA_CHECK_MIN_GATE_AGREEMENT", "0.95"))
+MIN_ID_RECALL = float(os.getenv("MEDIA_CHECK_MIN_ID_RECALL", "0.95"))
+
+
+def load_samples(images_dir=None, limit=50) -> list:
+    """ImageArtifacts from a local directory or from foundItems' imageUrls."""
+    if images_dir:
+        paths = sorted(p for p in Path(images_dir).iterdir()
+                       if p.suffix.lower() in (".jpg", ".jpeg", ".png", ".webp"))[:limit]
+        return [ImageArtifact(p.read_bytes()) for p in paths]
+    from database import get_firestore
+    db = get_firestore()
+    urls = [(d.to_dict() or {}).get("imageUrl") for d in db.collection("foundItems").select(["imageUrl"]).limit(limit).get()]
+    fetched = image_fetcher.fetch_many([u for u in urls if u])
+    return [ImageArtifact(b, url=u) for u, b in fetched.items() if not isinstance(b, Exception)]
+
+
+def _baseline(artifact, profile):
+    #what was uploaded before media_prep: the original, or the thresholded full image for OCR
+    return tools.preprocess_artifact(artifact, "threshold") if profile == "ocr" else artifact
+
+
+def _prepare(artifact, profile):
+    t0 = time.perf_counter()
+    out = media_prep._build(artifact, profile)
+    return out, time.perf_counter() - t0
+
+
+def _timed(fn, image):
+    t0 = time.perf_counter()
+    out = fn(image)
+    return out, time.perf_counter() - t0
+
+
+def _norm(text):
+    return " ".join((text or "").lower().split())
+
+
+def check(artifacts, profiles=("gate", "verdict", "ocr"), llm=False) -> dict:
+    sizes = {p: {"original": 0, "prepared": 0, "prep_s": []} for p in profiles}
+    prepared = []
+    for a in artifacts:
+        copies = {}
+        for p in profiles:
+            out, seconds = _prepare(a, p)
+            copies[p] = out
+            sizes[p]["original"] += len(_baseline(a, p).data)
+            sizes[p]["prepared"] += len(out.data)
+            sizes[p]["prep_s"].append(seconds)
+        prepared.append(copies)
+
+    results = {"images": len(artifacts), "profiles": {}}
+    for p, s in sizes.items():
+        results["profiles"][p] = {
+            "original_kb": round(s["original"] / 1024, 1),
+            "prepared_kb": round(s["prepared"] / 1024, 1),
+            "ratio": round(s["prepared"] / max(s["original"], 1), 3),
+            "prep_ms_p50": round(float(np.median(s["prep_s"])) * 1000, 1) if s["prep_s"] else 0.0,
+        }
+    if not llm:
+        return results
+
+    gate_same, gate_s, recall, similarity, ocr_s = [], ([], []), [], [], ([], [])
+    for a, copies in zip(artifacts, prepared):
+        if "gate" in copies:
+            (before, t_before), (after, t_after) = _timed(gate.run_gate, a), _timed(gate.run_gate, copies["gate"])
+            gate_same.append(bool(before.get("should_ocr")) == bool(after.get("should_ocr")))
+            gate_s[0].append(t_before)
+            gate_s[1].append(t_after)
+        if "ocr" in copies:
+            (before, t_before), (after, t_after) = (_timed(tools.extract_text_from_artifact, _baseline(a, "ocr")),
+                                                    _timed(tools.extract_text_from_artifact, copies["ocr"]))
+            expected = identifiers.extract(before)
+            if expected:
+                recall.append(len(expected & identifiers.extract(after)) / len(expected))
+            similarity.append(difflib.SequenceMatcher(None, _norm(before), _norm(after)).ratio())
+            ocr_s[0].append(t_before)
+            ocr_s[1].append(t_after)
+
+    def p50(xs):
+        return round(float(np.median(xs)) * 1000, 1) if xs else None
+
+    results["gate"] = {
+        "agreement": float(np.mean(gate_same)) if gate_same else 1.0,
+        "ms_p50_original": p50(gate_s[0]),
+        "ms_p50_prepared": p50(gate_s[1]),
+    }
+    results["ocr"] = {
+        "identifier_recall": float(np.mean(recall)) if recall else 1.0,
+        "images_with_identifiers": len(recall),
+        "text_similarity": float(np.mean(similarity)) if similarity else 1.0,
+        "ms_p50_original": p50(ocr_s[0]),
+        "ms_p50_prepared": p50(ocr_s[1]),
+    }
+    results["ok"] = (results["gate"]["agreement"] >= MIN_GATE_AGREEMENT
+                     and results["ocr"]["identifier_recall"] >= MIN_ID_RECALL)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare prepared Gemini uploads with the original images.")
+    parser.add_argument("--images", help="directory of sample images (default: sample foundItems)")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--profiles", default="gate,verdict,ocr")
+    parser.add_argument("--llm", action="store_true", help="also call Gemini to compare gate and OCR results")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    #every call must reach Gemini, or the latencies (and the original/prepared comparison) mean nothing
+    llm_client.CACHE_SIZE = 0
+    artifacts = load_samples(args.images, args.limit)
+    print(f"[media] {len(artifacts)} images")
+    results = check(artifacts, tuple(args.profiles.split(",")), args.llm)
+    print(json.dumps(results, indent=2))
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
@@ -0,0 +1,149 @@
+import os
+import time
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+import metrics
+from image_artifact import ImageArtifact
+
+# per-purpose copies of a found-item photo for the Gemini calls. phone photos are several MB,
+# and upload time and image tokens dominate those calls, yet
+#   gate     only has to tell whether there is readable text  -> small JPEG
+#   verdict  has to see the object                             -> moderate JPEG
+#   ocr      needs the text at reading resolution, nothing else -> crop to the text regions,
+#            scale to OCR_WIDTH, threshold, greyscale PNG
+# each copy is built once per artifact (memoised as a variant) and is an ImageArtifact itself,
+# so the LLM response cache keys on the prepared bytes. MEDIA_PREP=0 sends originals.
+# check byte/latency savings and gate/OCR agreement with `python media_check.py` before
+# changing a profile.
+ENABLED = os.getenv("MEDIA_PREP", "1") != "0"
+PROFILES = {
+    "gate": {"max_side": int(os.getenv("MEDIA_GATE_MAX_SIDE", "768")),
+             "quality": int(os.getenv("MEDIA_GATE_QUALITY", "80"))},
+    "verdict": {"max_side": int(os.getenv("MEDIA_VERDICT_MAX_SIDE", "1024")),
+                "quality": int(os.getenv("MEDIA_VERDICT_QUALITY", "85"))},
+}
+OCR_WIDTH = int(os.getenv("MEDIA_OCR_WIDTH", "1600"))
+OCR_MAX_UPSCALE = float(os.getenv("MEDIA_OCR_MAX_UPSCALE", "4"))
+OCR_CROP = os.getenv("MEDIA_OCR_CROP", "1") != "0"
+#padding around the detected text, as a share of the image's longer side
+OCR_CROP_PAD = float(os.getenv("MEDIA_OCR_CROP_PAD", "0.06"))
+#a crop keeping more than this share of the image isn't worth the risk of cutting text
+OCR_CROP_MAX_AREA = 0.8
+#text detection runs on a copy at most this big
+DETECT_MAX_SIDE = 800
+
+_ORIENTATION = 0x0112
+
+
+def fingerprint(profile: str) -> str:
+    """The settings a profile's output depends on, for result versions (gate/OCR)."""
+    if not ENABLED:
+        return "original"
+    if profile == "ocr":
+        return f"ocr|{OCR_WIDTH}|{OCR_MAX_UPSCALE}|{int(OCR_CROP)}|{OCR_CROP_PAD}"
+    p = PROFILES[profile]
+    return f"{profile}|{p['max_side']}|{p['quality']}"
+
+
+def prepare(artifact, profile: str):
+    """The artifact as it should be uploaded for `profile` ("gate", "verdict" or "ocr")."""
+    if not ENABLED:
+        return artifact
+    return artifact.variant(f"media:{profile}", lambda: _build(artifact, profile))
+
+
+def _build(artifact, profile):
+    t0 = time.perf_counter()
+    out = _ocr(artifact) if profile == "ocr" else _jpeg(artifact, profile, **PROFILES[profile])
+    metrics.observe("media_prep_seconds", time.perf_counter() - t0, profile=profile)
+    metrics.inc("media_bytes_total", len(artifact.data), profile=profile, kind="original")
+    metrics.inc("media_bytes_total", len(out.data), profile=profile, kind="prepared")
+    return out
+
+
+def _jpeg(artifact, profile, max_side, quality):
+    img = Image.open(BytesIO(artifact.data))
+    size = img.size
+    rotated = img.getexif().get(_ORIENTATION, 1) != 1
+    #JPEGs decode straight at a reduced scale (1/2, 1/4, 1/8), much faster than full size
+    img.draft("RGB", (max_side, max_side))
+    #the copy loses its EXIF, so apply the orientation now
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    if max(img.size) > max_side:
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=quality, optimize=True)
+    data = buf.getvalue()
+    if max(size) <= max_side and not rotated and len(data) >= len(artifact.data):
+        #already small: re-encoding would only cost quality
+        return artifact
+    return ImageArtifact(data, mime="image/jpeg", handle=f"{artifact.handle}/media:{profile}")
+
+
+def text_boxes(bgr: np.ndarray) -> list:
+    """Boxes (x, y, w, h) of likely text lines in a BGR image, in its own coordinates.
+
+    Morphological gradient + Otsu, closed horizontally so characters join into lines, then
+    kept when the region is dense and wider than tall. Cheap, and biased to find too much
+    rather than too little.
+    """
+    h, w = bgr.shape[:2]
+    scale = min(1.0, DETECT_MAX_SIDE / max(h, w))
+    small = cv2.resize(bgr, (max(1, round(w * scale)), max(1, round(h * scale))),
+                       interpolation=cv2.INTER_AREA) if scale < 1 else bgr
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    grad = cv2.morphologyEx(gray, cv2.MORPH_GRADIENT, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+    _, bw = cv2.threshold(grad, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    joined = cv2.morphologyEx(bw, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (9, 1)))
+    contours, _ = cv2.findContours(joined, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+
+    sh = gray.shape[0]
+    boxes = []
+    for c in contours:
+        x, y, bw_, bh = cv2.boundingRect(c)
+        if bh < 6 or bw_ < 10 or bh > 0.25 * sh or bw_ < 1.2 * bh:
+            continue
+        if cv2.countNonZero(joined[y:y + bh, x:x + bw_]) / (bw_ * bh) < 0.45:
+            continue
+        boxes.append((round(x / scale), round(y / scale), round(bw_ / scale), round(bh / scale)))
+    return boxes
+
+
+def text_crop(bgr: np.ndarray):
+    """(x0, y0, x1, y1) around every detected text line plus padding, or None to keep the whole image."""
+    boxes = text_boxes(bgr)
+    if not boxes:
+        return None
+    h, w = bgr.shape[:2]
+    pad = round(OCR_CROP_PAD * max(h, w))
+    x0 = max(0, min(x for x, _, _, _ in boxes) - pad)
+    y0 = max(0, min(y for _, y, _, _ in boxes) - pad)
+    x1 = min(w, max(x + bw for x, _, bw, _ in boxes) + pad)
+    y1 = min(h, max(y + bh for _, y, _, bh in boxes) + pad)
+    if (x1 - x0) * (y1 - y0) > OCR_CROP_MAX_AREA * w * h:
+        return None
+    return x0, y0, x1, y1
+
+
+def _ocr(artifact):
+    import tools  # the same threshold as the agent's preprocess_image
+
+    img = artifact.bgr
+    box = text_crop(img) if OCR_CROP else None
+    if box is not None:
+        x0, y0, x1, y1 = box
+        img = img[y0:y1, x0:x1]
+    scale = min(OCR_WIDTH / img.shape[1], OCR_MAX_UPSCALE)
+    if abs(scale - 1) > 0.01:
+        img = cv2.resize(img, (round(img.shape[1] * scale), round(img.shape[0] * scale)),
+                         interpolation=cv2.INTER_CUBIC if scale > 1 else cv2.INTER_AREA)
+    #binary output: one grey channel compresses far better than the 3-channel PNG
+    gray = tools.preprocess_array(img, "threshold", target_width=None)[..., 0]
+    ok, buf = cv2.imencode(".png", gray)
+    if not ok:
+        raise ValueError("Could not encode image as PNG")
+    return ImageArtifact(buf.tobytes(), mime="image/png", handle=f"{artifact.handle}/media:ocr")
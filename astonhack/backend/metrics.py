@@ -0,0 +1,143 @@
+import os
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# in-process metrics: counters and latency histograms rendered in the Prometheus text format
+# (GET /metrics), plus per-request stage timings for the Server-Timing header.
+#
+#   with metrics.span("clip_encode"):      # -> stage_seconds{stage="clip_encode"}
+#       ...
+#   metrics.inc("llm_cache_total", model=m, result="hit")
+#
+# recording is a perf_counter pair, a dict lookup and a lock, so it stays on in production.
+ENABLED = os.getenv("METRICS", "1") != "0"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_counters = {}      # (name, labels) -> value
+_histograms = {}    # (name, labels) -> [bucket counts..., sum, count]
+_help = {}
+
+#stage timings of the current request, read by the Server-Timing middleware
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def describe(name, text):
+    _help[name] = text
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                h[i] += 1
+                break
+        h[-2] += value
+        h[-1] += 1
+
+
+@contextmanager
+def span(stage, **labels):
+    """Time a pipeline stage into stage_seconds and the request's Server-Timing entries."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        observe("stage_seconds", elapsed, stage=stage, **labels)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def start_request():
+    """Start collecting stage timings for the current request (context); returns the list."""
+    timings = []
+    _request_timings.set(timings)
+    return timings
+
+
+def server_timing(timings) -> str:
+    #repeated stages (e.g. one span per retry) are summed
+    totals = {}
+    for stage, elapsed in timings:
+        totals[stage] = totals.get(stage, 0.0) + elapsed
+    return ", ".join(f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in totals.items())
+
+
+def _fmt_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+    lines = []
+    for name in sorted({n for n, _ in counters}):
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} counter")
+        for (n, labels), value in sorted(counters.items()):
+            if n == name:
+                lines.append(f"{name}{_fmt_labels(labels)} {value}")
+    for name in sorted({n for n, _ in histograms}):
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} histogram")
+        for (n, labels), h in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS, h):
+                cumulative += count
+                lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', '+Inf')])} {h[-1]}")
+            lines.append(f"{name}_sum{_fmt_labels(labels)} {h[-2]}")
+            lines.append(f"{name}_count{_fmt_labels(labels)} {h[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+describe("stage_seconds", "Wall time of a match pipeline stage.")
+describe("llm_call_seconds", "Wall time of one LLM generate_content attempt.")
+describe("llm_tokens_total", "Tokens reported by the LLM API.")
+describe("llm_cache_total", "LLM response cache lookups.")
+describe("cache_total", "Cache lookups by cache and result.")
+describe("match_path_total", "Verdicts by decision path.")
+describe("firestore_requests_total", "Firestore round trips by operation.")
+describe("llm_upload_bytes_total", "Inline image bytes sent to the LLM API.")
+describe("media_bytes_total", "Image bytes before/after media preparation, by profile.")
+describe("media_prep_seconds", "Time to build a prepared image for an LLM call.")
+describe("firestore_write_errors_total", "Buffered document writes whose batch commit failed.")
+describe("gate_total", "Gate decisions computed, by source (local text pre-gate or LLM).")
+describe("text_pregate_seconds", "Time to score a photo for text presence locally.")
@@ -3,36 +3,72 @@ from pathlib import Path
 from dotenv import load_dotenv
 load_dotenv(Path(__file__).with_name(".env"))
 
-from typing import TypedDict, Optional, Annotated
+import hashlib
+import threading
 
-from langchain_core.messages import AnyMessage, SystemMessage, HumanMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langgraph.graph import StateGraph, START
-from langgraph.graph.message import add_messages
-from langgraph.prebuilt import ToolNode, tools_condition
+import media_prep
 
 from tools import (
     extract_text,
     preprocess_image,
+    extract_text_from_artifact,
+    preprocess_artifact,
+    OCR_MODEL,
+    OCR_PROMPT,
 )
 
-
-class AgentState(TypedDict, total=False):
-    input_file: Optional[str]
-    messages: Annotated[list[AnyMessage], add_messages]
+# "direct" runs the fixed preprocess -> OCR plan without the ReAct loop (one LLM call);
+# "agent" keeps the LangGraph agent deciding the tool calls
+OCR_MODE = os.getenv("OCR_MODE", "direct")
+AGENT_MODEL = "gemini-2.0-flash"   # or gemini-2.5-pro
 
 tools = [extract_text, preprocess_image]
 
-llm = ChatGoogleGenerativeAI(
-    model="gemini-2.0-flash",   # or gemini-2.5-pro
-    temperature=0,
-    max_output_tokens=800,
-    api_key=os.getenv("GEMINI_API_KEY"),
-)
-llm_with_tools = llm.bind_tools(tools)
-
-
-def assistant(state: AgentState):
+#the agent (LangChain model + compiled LangGraph graph) is only built when first used: direct
+#mode never needs it, and building it at import slowed every worker's start-up
+_graph = None
+_llm_with_tools = None
+_graph_lock = threading.Lock()
+
+
+def get_graph():
+    global _graph, _llm_with_tools
+    with _graph_lock:
+        if _graph is not None:
+            return _graph
+        from typing import TypedDict, Optional, Annotated
+        from langchain_core.messages import AnyMessage
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        from langgraph.graph import StateGraph, START
+        from langgraph.graph.message import add_messages
+        from langgraph.prebuilt import ToolNode, tools_condition
+
+        class AgentState(TypedDict, total=False):
+            input_file: Optional[str]
+            messages: Annotated[list[AnyMessage], add_messages]
+
+        llm = ChatGoogleGenerativeAI(
+            model=AGENT_MODEL,
+            temperature=0,
+            max_output_tokens=800,
+            api_key=os.getenv("GEMINI_API_KEY"),
+        )
+        _llm_with_tools = llm.bind_tools(tools)
+
+        builder = StateGraph(AgentState)
+        builder.add_node("assistant", assistant)
+        builder.add_node("tools", ToolNode(tools))
+
+        builder.add_edge(START, "assistant")
+        builder.add_conditional_edges("assistant", tools_condition)
+        builder.add_edge("tools", "assistant")
+
+        _graph = builder.compile()
+        return _graph
+
+
+def assistant(state):
+    from langchain_core.messages import SystemMessage
     TOOL_DESC = """
     def extract_text(img_path: str) -> str: Extracts text from an image.
     def preprocess_image(img_path: str, op: str = "threshold", target_width: int = 1600) -> str: Preprocesses image for OCR.
@@ -51,26 +87,14 @@ def assistant(state: AgentState):
     ))
 
     return {
-        "messages": [llm_with_tools.invoke([sys_msg] + state.get("messages", []))],
+        "messages": [_llm_with_tools.invoke([sys_msg] + state.get("messages", []))],
         "input_file": image,
     }
 
 
-builder = StateGraph(AgentState)
-builder.add_node("assistant", assistant)
-builder.add_node("tools", ToolNode(tools))
-
-builder.add_edge(START, "assistant")
-builder.add_conditional_edges("assistant", tools_condition)
-builder.add_edge("tools", "assistant")
-
-react_graph = builder.compile()
-
-from pathlib import Path
-from langchain_core.messages import HumanMessage
-
 def run_ocr_agent_on_path(img_path: str) -> str:
     """Run preprocess -> OCR tools via the agent and return extracted text."""
+    from langchain_core.messages import HumanMessage
     p = Path(img_path).expanduser().resolve()
     if not p.is_file():
         raise ValueError(f"Image path not found: {p}")
@@ -79,7 +103,7 @@ def run_ocr_agent_on_path(img_path: str) -> str:
         HumanMessage(content="Preprocess with threshold and extract all readable text. Return only the text.")
     ]
 
-    result = react_graph.invoke({
+    result = get_graph().invoke({
         "messages": start_msgs,
         "input_file": str(p),
     })
@@ -87,7 +111,62 @@ def run_ocr_agent_on_path(img_path: str) -> str:
     return (result["messages"][-1].content or "").strip()
 
 
+def run_ocr_agent_on_artifact(artifact) -> str:
+    """Same as run_ocr_agent_on_path, but the tools work on the in-memory ImageArtifact."""
+    from langchain_core.messages import HumanMessage
+    start_msgs = [
+        HumanMessage(content="Preprocess with threshold and extract all readable text. Return only the text.")
+    ]
+
+    result = get_graph().invoke({
+        "messages": start_msgs,
+        "input_file": artifact.handle,
+    })
+
+    return (result["messages"][-1].content or "").strip()
+
+
+def run_ocr_pipeline(artifact, op: str = "threshold") -> str:
+    """Deterministic OCR: preprocess the artifact, then a single vision OCR call."""
+    if op == "threshold" and media_prep.ENABLED:
+        #thresholded crop of the text regions only
+        prepared = media_prep.prepare(artifact, "ocr")
+    else:
+        prepared = preprocess_artifact(artifact, op)
+    return extract_text_from_artifact(prepared)
+
+
+def ocr_version(mode: str = OCR_MODE) -> str:
+    """Fingerprint of the OCR pipeline; stored next to ocr_output so stale results get recomputed."""
+    if mode == "agent":
+        spec = f"agent|{AGENT_MODEL}|{OCR_MODEL}|{OCR_PROMPT}"
+    elif media_prep.ENABLED:
+        spec = f"direct|{media_prep.fingerprint('ocr')}|{OCR_MODEL}|{OCR_PROMPT}"
+    else:
+        spec = f"direct|threshold|1600|{OCR_MODEL}|{OCR_PROMPT}"
+    return hashlib.sha256(spec.encode("utf-8")).hexdigest()[:12]
+
+
+def run_ocr(artifact, mode: str = OCR_MODE, fallback: bool = True) -> str:
+    """OCR an ImageArtifact with the selected mode.
+
+    In direct mode, an error in the pipeline falls back to the agent when fallback is set.
+    """
+    if mode == "agent":
+        return run_ocr_agent_on_artifact(artifact)
+    if mode != "direct":
+        raise ValueError(f"Unknown OCR mode: {mode!r}")
+    try:
+        return run_ocr_pipeline(artifact)
+    except Exception as e:
+        if not fallback:
+            raise
+        print("[OCR] direct pipeline failed, falling back to agent:", e)
+        return run_ocr_agent_on_artifact(artifact)
+
+
 if __name__ == "__main__":
+    from langchain_core.messages import HumanMessage
     # Build a robust image path relative to this file (repo-root/images/shopping_list.png)
     repo_root = Path(__file__).resolve().parent
     img_path = (repo_root / "images" / "headphones.jpg").resolve()
@@ -98,7 +177,7 @@ if __name__ == "__main__":
     )
     start_msgs = [HumanMessage(content=user_prompt)]
 
-    result = react_graph.invoke({
+    result = get_graph().invoke({
         "messages": start_msgs,
         "input_file": str(img_path),
     })
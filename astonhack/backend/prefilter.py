@@ -0,0 +1,382 @@
+import os
+import math
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+
+import vector_index
+
+# candidate pre-filter in front of the CLIP indexes: per collection, numpy columns of the
+# indexed items' lat/lng, time and colour buckets (a bitmask). a query only keeps candidates
+# that are within GEO_RADIUS_KM of it, reported within TIME_WINDOW_DAYS of it and share a
+# colour bucket; each filter is one vectorised comparison over the columns (allowed_rows). a
+# graph search only checks its own hits against them; an exact scan gets a boolean mask over
+# the vector index's rows. a full sync stores those rows in item-time order (cluster_by_time),
+# so a time window keeps whole blocks of them and a filtered scan only touches the rows it keeps.
+# colours read off a photo are weak evidence (shade, lighting and the table all shift them),
+# so they only filter when one clear hue dominates, and then still keep neighbouring hues
+# and every neutral-coloured item (photo_query_colors).
+# filters are lenient: an item missing an attribute is never excluded by it, a filter the
+# query has no data for is skipped, and if fewer than MIN_CANDIDATES survive the full set is
+# searched instead. so is it when the filters keep MAX_KEEP_SHARE (half) of the items or more:
+# then the unfiltered search (one batched matmul, or the HNSW graph) is cheaper than masking.
+#
+# what the app stores today: found items have lat/lng (map picker) and createdAt; lost items
+# have free-text color/location and createdAt. so the time filter applies both ways, colour
+# applies to found -> lost (the found photo's colours vs the lost item's colour), and the
+# distance filter kicks in wherever both sides carry coordinates.
+GEO_RADIUS_KM = float(os.getenv("PREFILTER_GEO_RADIUS_KM", "5"))
+TIME_WINDOW_DAYS = float(os.getenv("PREFILTER_TIME_WINDOW_DAYS", "30"))
+COLOR_MIN_SHARE = float(os.getenv("PREFILTER_COLOR_MIN_SHARE", "0.15"))
+COLOR_DOMINANT_SHARE = float(os.getenv("PREFILTER_COLOR_DOMINANT_SHARE", "0.4"))
+MIN_CANDIDATES = int(os.getenv("PREFILTER_MIN_CANDIDATES", "3"))
+MAX_KEEP_SHARE = float(os.getenv("PREFILTER_MAX_KEEP_SHARE", "0.5"))
+ENABLED = os.getenv("PREFILTER", "1") != "0"
+
+KM_PER_DEG = 111.32
+
+#free-text colour words -> bucket. neutrals are their own buckets
+COLOR_WORDS = {
+    "red": "red", "maroon": "red", "burgundy": "red", "crimson": "red", "scarlet": "red",
+    "orange": "orange", "amber": "orange", "peach": "orange",
+    "yellow": "yellow", "gold": "yellow", "golden": "yellow", "mustard": "yellow",
+    "green": "green", "olive": "green", "lime": "green", "khaki": "green", "teal": "green",
+    "blue": "blue", "navy": "blue", "turquoise": "blue", "cyan": "blue", "denim": "blue",
+    "purple": "purple", "violet": "purple", "lilac": "purple", "lavender": "purple",
+    "pink": "pink", "magenta": "pink", "rose": "pink",
+    "brown": "brown", "tan": "brown", "beige": "brown", "camel": "brown", "leather": "brown",
+    "black": "black", "white": "white", "cream": "white", "ivory": "white",
+    "grey": "grey", "gray": "grey", "silver": "grey", "charcoal": "grey",
+}
+
+
+#dark, washed-out and brown pixels can be almost any hue in a photo, so these buckets are
+#compatible with every colour
+NEUTRALS = frozenset({"black", "grey", "white", "brown"})
+#hues a photo's colour can drift into under coloured light
+HUE_NEIGHBOURS = {
+    "red": {"orange", "pink"}, "orange": {"red", "yellow"}, "yellow": {"orange", "green"},
+    "green": {"yellow", "blue"}, "blue": {"green", "purple"}, "purple": {"blue", "pink"},
+    "pink": {"purple", "red"},
+}
+
+
+def color_buckets(text) -> frozenset:
+    """Buckets named in a free-text colour ("navy blue" -> {"blue"}); empty when unknown."""
+    words = "".join(c if c.isalpha() else " " for c in str(text or "").lower()).split()
+    return frozenset(COLOR_WORDS[w] for w in words if w in COLOR_WORDS)
+
+
+def image_color_shares(pil) -> dict:
+    """{bucket: share} of the pixels in the centre of a photo."""
+    img = pil.convert("RGB")
+    w, h = img.size
+    #the item is usually in the middle; the edges are mostly table/floor
+    img = img.crop((w // 5, h // 5, w - w // 5, h - h // 5)).resize((24, 24))
+    hsv = np.asarray(img.convert("HSV"), dtype=np.float32) / 255.0
+    hue, sat, val = hsv[..., 0] * 360, hsv[..., 1], hsv[..., 2]
+
+    labels = np.full(hue.shape, "", dtype=object)
+    labels[(sat < 0.2) & (val >= 0.8)] = "white"
+    labels[(sat < 0.2) & (val >= 0.25) & (val < 0.8)] = "grey"
+    labels[val < 0.25] = "black"
+    chroma = (labels == "")
+    for name, lo, hi in (("red", 0, 15), ("orange", 15, 40), ("yellow", 40, 70), ("green", 70, 170),
+                         ("blue", 170, 255), ("purple", 255, 290), ("pink", 290, 340), ("red", 340, 361)):
+        labels[chroma & (hue >= lo) & (hue < hi)] = name
+    #dark oranges read as brown
+    labels[chroma & (hue >= 10) & (hue < 45) & (val < 0.6)] = "brown"
+
+    names, counts = np.unique(labels, return_counts=True)
+    return {str(n): float(c / labels.size) for n, c in zip(names, counts) if n}
+
+
+def photo_query_colors(shares: dict) -> frozenset:
+    """Buckets a photo's colours are compatible with; empty (no colour filter) when unsure.
+
+    Only a photo whose main colour is a clear hue covering COLOR_DOMINANT_SHARE filters at
+    all. It then keeps its hues, their neighbours and every neutral-coloured item.
+    """
+    if not shares:
+        return frozenset()
+    main = max(shares, key=shares.get)
+    if main in NEUTRALS or shares[main] < COLOR_DOMINANT_SHARE:
+        return frozenset()
+    out = set(NEUTRALS)
+    for bucket, share in shares.items():
+        if share >= COLOR_MIN_SHARE and bucket not in NEUTRALS:
+            out |= {bucket} | HUE_NEIGHBOURS.get(bucket, set())
+    return frozenset(out)
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    if isinstance(value, (int, float)):
+        return float(value)
+    return None
+
+
+def _coords(item):
+    lat, lng = item.get("lat"), item.get("lng")
+    if isinstance(lat, (int, float)) and isinstance(lng, (int, float)):
+        return float(lat), float(lng)
+    return None
+
+
+def item_attributes(item) -> dict:
+    """Filterable attributes of a stored lost/found item document."""
+    return {
+        "coords": _coords(item),
+        "ts": _timestamp(item.get("time") or item.get("createdAt")),
+        "colors": color_buckets(item.get("color")),
+    }
+
+
+def query_attributes(item, artifact=None) -> dict:
+    """Attributes of the item being matched; a found item's colours come from its photo."""
+    attrs = item_attributes(item or {})
+    if artifact is not None and not attrs["colors"]:
+        try:
+            attrs["colors"] = photo_query_colors(artifact.variant("colors", lambda: image_color_shares(artifact.pil)))
+        except Exception as e:
+            print("[prefilter] colour extraction failed:", e)
+    return attrs
+
+
+#one bit per colour bucket, so an item's colours are a single integer column
+BUCKET_BITS = {b: 1 << i for i, b in enumerate(sorted(set(COLOR_WORDS.values())))}
+
+
+def color_bits(buckets) -> int:
+    bits = 0
+    for b in buckets:
+        bits |= BUCKET_BITS.get(b, 0)
+    return bits
+
+
+class MetadataIndex:
+    def __init__(self):
+        self.ids = []               # row -> doc id
+        self._rows = {}             # doc id -> row
+        self._attrs = {}            # doc id -> attributes
+        #one column per attribute; NaN / 0 where an item doesn't have it
+        self._lat = np.zeros(0)
+        self._lng = np.zeros(0)
+        self._ts = np.zeros(0)
+        self._colors = np.zeros(0, dtype=np.uint16)
+        self._have = dict.fromkeys(("coords", "ts", "colors"), 0)  # items carrying each attribute
+        self._size = 0
+        self.generation = 0         # bumped whenever rows are added, removed or moved
+        self._moves = []            # (generation, doc id) of recently added/moved/removed rows
+        self._moves_base = 0
+        self._row_map = None        # ((vector index, its generation, ours), vector row -> our row)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def update(self, items):
+        with self._lock:
+            for item in items:
+                attrs = item_attributes(item)
+                if self._attrs.get(item["id"]) != attrs:
+                    self._set(item["id"], attrs)
+
+    def retain(self, live_ids):
+        with self._lock:
+            for doc_id in [d for d in self._attrs if d not in live_ids]:
+                self._remove(doc_id)
+
+    def remove(self, doc_id):
+        with self._lock:
+            self._remove(doc_id)
+
+    def _set(self, doc_id, attrs):
+        row = self._rows.get(doc_id)
+        if row is None:
+            if self._size == len(self._ts):
+                capacity = max(64, 2 * self._size)
+                for name in ("_lat", "_lng", "_ts", "_colors"):
+                    col = getattr(self, name)
+                    grown = np.zeros(capacity, dtype=col.dtype)
+                    grown[:self._size] = col[:self._size]
+                    setattr(self, name, grown)
+            row = self._size
+            self._size += 1
+            self._rows[doc_id] = row
+            self.ids.append(doc_id)
+            self._moved(doc_id)
+        else:
+            self._count(self._attrs[doc_id], -1)
+        self._count(attrs, 1)
+        self._attrs[doc_id] = attrs
+        self._lat[row], self._lng[row] = attrs["coords"] if attrs["coords"] is not None else (np.nan, np.nan)
+        self._ts[row] = attrs["ts"] if attrs["ts"] is not None else np.nan
+        self._colors[row] = color_bits(attrs["colors"])
+
+    def _count(self, attrs, step):
+        for key in self._have:
+            if attrs[key] is not None and attrs[key] != frozenset():
+                self._have[key] += step
+
+    def _remove(self, doc_id):
+        attrs = self._attrs.pop(doc_id, None)
+        if attrs is None:
+            return
+        self._count(attrs, -1)
+        row = self._rows.pop(doc_id)
+        last = self._size - 1
+        #keep the columns dense: move the last row into the hole
+        if row != last:
+            moved = self.ids[last]
+            for col in (self._lat, self._lng, self._ts, self._colors):
+                col[row] = col[last]
+            self.ids[row] = moved
+            self._rows[moved] = row
+        self.ids.pop()
+        self._size -= 1
+        self._moved(doc_id)
+        if row != last:
+            self._moves.append((self.generation, moved))
+
+    def _moved(self, doc_id):
+        self.generation += 1
+        self._moves.append((self.generation, doc_id))
+        if len(self._moves) > vector_index.MOVE_LOG_SIZE:
+            half = vector_index.MOVE_LOG_SIZE // 2
+            self._moves_base = self._moves[half - 1][0]
+            del self._moves[:half]
+
+    def mask(self, query: dict):
+        """(generation, boolean row mask of the items that pass every applicable filter).
+
+        The mask is None when no filter excludes anything.
+        """
+        with self._lock:
+            generation, n = self.generation, self._size
+            #a filter no indexed item has the attribute for can't exclude anything: skip its column
+            query = {key: value for key, value in query.items() if self._have.get(key, 1)}
+            excluded = _excluded(query, self._lat[:n], self._lng[:n], self._ts[:n], self._colors[:n])
+        return generation, (~excluded if excluded.any() else None)
+
+    def passes(self, query: dict, doc_ids) -> np.ndarray:
+        """Whether each of doc_ids passes the filters (ids this index doesn't know do)."""
+        with self._lock:
+            rows = np.array([self._rows.get(doc_id, -1) for doc_id in doc_ids], dtype=np.int64)
+            known = rows >= 0
+            r = rows[known]
+            excluded = _excluded(query, self._lat[r], self._lng[r], self._ts[r], self._colors[r])
+        out = np.ones(len(rows), dtype=bool)
+        out[known] = ~excluded
+        return out
+
+    def row_map(self, index):
+        """This index's row for each row of a vector index (-1 where it has none).
+
+        Kept between calls and patched from both indexes' move logs, so only a cold start or
+        a long gap pays the full O(n) rebuild.
+        """
+        with self._lock:
+            cached = self._row_map
+            if cached is not None and cached[0] == (index, index.generation, self.generation):
+                return cached
+            if cached is not None and cached[0][0] is index and cached[0][2] >= self._moves_base:
+                moved = {doc_id for g, doc_id in self._moves if g > cached[0][2]}
+                delta = index.rows_since(cached[0][1], moved)
+                if delta is not None:
+                    generation, size, rows = delta
+                    old = cached[1]
+                    row_map = np.full(size, -1, dtype=np.int64)
+                    row_map[:min(size, len(old))] = old[:size]
+                    for doc_id, row in rows.items():
+                        if row is not None and row < size:
+                            row_map[row] = self._rows.get(doc_id, -1)
+                    self._row_map = ((index, generation, self.generation), row_map)
+                    return self._row_map
+            generation, ids = index.row_ids()
+            rows = self._rows
+            self._row_map = ((index, generation, self.generation),
+                             np.fromiter((rows.get(d, -1) for d in ids), dtype=np.int64, count=len(ids)))
+            return self._row_map
+
+    def times(self, row_map) -> np.ndarray:
+        """Item time for each entry of a row_map (inf where unknown)."""
+        with self._lock:
+            ts = np.append(self._ts[:self._size], np.inf)
+        out = ts[row_map]      # -1 picks the appended inf
+        out[np.isnan(out)] = np.inf
+        return out
+
+
+def _excluded(query, lat, lng, ts, colors) -> np.ndarray:
+    """Which of the given column entries a query's filters drop."""
+    excluded = np.zeros(len(ts), dtype=bool)
+    #NaN compares False, so an item missing an attribute is never excluded by it
+    if query.get("coords") is not None:
+        qlat, qlng = query["coords"]
+        dy = (lat - qlat) * KM_PER_DEG
+        dx = (lng - qlng) * KM_PER_DEG * max(math.cos(math.radians(qlat)), 0.01)
+        excluded |= dx * dx + dy * dy > GEO_RADIUS_KM ** 2
+    if query.get("ts") is not None:
+        excluded |= np.abs(ts - query["ts"]) > TIME_WINDOW_DAYS * 86400
+    if query.get("colors"):
+        excluded |= (colors != 0) & (colors & color_bits(query["colors"]) == 0)
+    return excluded
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(collection: str) -> MetadataIndex:
+    with _indexes_lock:
+        index = _indexes.get(collection)
+        if index is None:
+            index = _indexes[collection] = MetadataIndex()
+        return index
+
+
+def allowed_rows(collection: str, query: dict, k: int = 3):
+    """A vector_index.RowFilter over `collection`'s vector index for a query, or None to search everything."""
+    if not ENABLED:
+        return None
+    meta = get_index(collection)
+    meta_generation, keep = meta.mask(query)
+    if keep is None:
+        return None
+    kept = int(keep.sum())
+    #a filter that keeps most rows costs more than it saves: a block scan still touches nearly
+    #every block and a graph search has to over-fetch, so only selective filters are applied
+    if kept < max(MIN_CANDIDATES, k) or kept >= MAX_KEEP_SHARE * len(keep):
+        return None
+
+    def rows():
+        (_, generation, map_generation), row_map = meta.row_map(vector_index.get_index(collection))
+        if map_generation != meta_generation:
+            return generation, None     # the items changed between the two reads
+        #rows the metadata index doesn't know (-1) pick the appended True: they are kept
+        return generation, np.append(keep, True)[row_map]
+
+    return vector_index.RowFilter(kept / len(keep), lambda doc_ids: meta.passes(query, doc_ids), rows)
+
+
+def cluster_by_time(collection: str) -> bool:
+    """Store `collection`'s vector rows in item-time order, so a time window keeps whole blocks of them.
+
+    New items are appended, so the order mostly holds until the next full sync.
+    """
+    meta = get_index(collection)
+    index = vector_index.get_index(collection)
+    (_, generation, _), row_map = meta.row_map(index)
+    return index.sort_rows(generation, meta.times(row_map))
@@ -0,0 +1,128 @@
+import os
+import argparse
+import hashlib
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+import image_fetcher
+import item_store
+import text_presence
+
+# offline evaluation of the local text pre-gate (text_presence) against the Gemini gate's
+# stored decisions. scores every sampled foundItem photo and, per threshold, reports
+#   llm_calls_avoided: share of photos the pre-gate would answer itself (score below threshold)
+#   missed: photos the LLM gate sent to OCR that the pre-gate would have skipped
+#   miss_rate: missed over all photos the LLM gate sent to OCR
+# pick the highest threshold whose miss rate is acceptable and set TEXT_PREGATE_SKIP_BELOW.
+# only LLM decisions count as ground truth: results the pre-gate stored itself are left out,
+# as are documents whose image changed after they were gated.
+#
+#   python pregate_check.py --limit 1000
+#   python pregate_check.py --images ./samples   # samples/text/*.jpg and samples/none/*.jpg
+MAX_MISS_RATE = float(os.getenv("PREGATE_CHECK_MAX_MISS_RATE", "0.02"))
+THRESHOLDS = (0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5, 0.6, 0.75, 1.0)
+
+
+def load_samples(images_dir=None, limit=1000) -> list:
+    """[(name, image bytes, should_ocr)] from labelled folders or from gated foundItems."""
+    if images_dir:
+        samples = []
+        for label, should_ocr in (("text", True), ("none", False)):
+            folder = Path(images_dir) / label
+            if not folder.is_dir():
+                continue
+            for p in sorted(folder.iterdir()):
+                if p.suffix.lower() in (".jpg", ".jpeg", ".png", ".webp"):
+                    samples.append((f"{label}/{p.name}", p.read_bytes(), should_ocr))
+        return samples[:limit]
+
+    from database import get_firestore
+    docs, skipped = [], {"local": 0, "changed": 0, "failed": 0}
+    fields = ["imageUrl", "should_ocr", "gate_version", "gate_image_hash"]
+    for page in item_store.stream_pages(get_firestore(), "foundItems", fields, item_store.PAGE_SIZE):
+        for doc in page:
+            if not doc.get("imageUrl") or "should_ocr" not in doc:
+                continue
+            if str(doc.get("gate_version", "")).startswith("local-"):
+                skipped["local"] += 1
+                continue
+            docs.append(doc)
+        if len(docs) >= limit:
+            break
+    docs = docs[:limit]
+
+    fetched = image_fetcher.fetch_many([d["imageUrl"] for d in docs])
+    samples = []
+    for doc in docs:
+        data = fetched.get(doc["imageUrl"])
+        if data is None or isinstance(data, Exception):
+            skipped["failed"] += 1
+            continue
+        if doc.get("gate_image_hash") and doc["gate_image_hash"] != hashlib.sha256(data).hexdigest():
+            skipped["changed"] += 1
+            continue
+        samples.append((doc["id"], data, bool(doc["should_ocr"])))
+    print(f"[pregate] left out: {skipped}")
+    return samples
+
+
+def check(samples, thresholds=THRESHOLDS) -> dict:
+    scores, labels, seconds = [], [], []
+    for name, data, should_ocr in samples:
+        t0 = time.perf_counter()
+        s = text_presence.score_bytes(data)
+        seconds.append(time.perf_counter() - t0)
+        scores.append(s)
+        labels.append(should_ocr)
+    scores, labels = np.array(scores), np.array(labels, dtype=bool)
+    positives = int(labels.sum())
+
+    rows = {}
+    for th in sorted(set(thresholds) | {text_presence.SKIP_BELOW}):
+        skip = scores < th
+        missed = int((skip & labels).sum())
+        rows[f"{th:g}"] = {
+            "llm_calls_avoided": round(float(skip.mean()), 3) if len(scores) else 0.0,
+            "no_text_skipped": round(float(skip[~labels].mean()), 3) if (~labels).any() else None,
+            "missed": missed,
+            "miss_rate": round(missed / positives, 3) if positives else 0.0,
+            "ok": (missed / positives if positives else 0.0) <= MAX_MISS_RATE,
+        }
+        print(f"[pregate] threshold {th:g}: {rows[f'{th:g}']}")
+
+    return {
+        "samples": len(samples),
+        "should_ocr": positives,
+        "score_ms_p50": round(float(np.median(seconds)) * 1000, 1) if seconds else 0.0,
+        "score_ms_max": round(max(seconds) * 1000, 1) if seconds else 0.0,
+        "current": f"{text_presence.SKIP_BELOW:g}",
+        "thresholds": rows,
+    }
+
+
+def recommend(results) -> float:
+    """Highest threshold whose miss rate is acceptable (0: always ask the LLM gate)."""
+    ok = [float(th) for th, r in results["thresholds"].items() if r["ok"]]
+    return max(ok, default=0.0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the local text pre-gate against stored gate decisions.")
+    parser.add_argument("--images", help="directory with text/ and none/ subfolders (default: gated foundItems)")
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--thresholds", help="comma-separated thresholds to report")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    thresholds = tuple(float(t) for t in args.thresholds.split(",")) if args.thresholds else THRESHOLDS
+    samples = load_samples(args.images, args.limit)
+    print(f"[pregate] {len(samples)} images, {sum(s[2] for s in samples)} with should_ocr")
+    results = check(samples, thresholds)
+    best = recommend(results)
+    print(f"[pregate] scoring p50 {results['score_ms_p50']}ms; recommended TEXT_PREGATE_SKIP_BELOW={best:g}"
+          f" ({results['thresholds'][f'{best:g}']['llm_calls_avoided'] if best else 0:.0%} of gate calls avoided)")
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
@@ -0,0 +1,80 @@
+import threading
+import time
+import traceback
+
+# timed start-up of the serving process. main.py imports nothing heavy at import time; its
+# lifespan hands start() the components to initialise (torch + CLIP, the Firestore snapshot,
+# the Gemini client, the OCR pipeline), which run on background threads so /health answers
+# straight away. Each component's wall time and error is kept for /ready.
+#
+#   startup.start([[("torch", init_torch), ("clip", init_clip)], [("store", init_store)]])
+#
+# components in one group run in order on one thread; groups run side by side.
+_lock = threading.Lock()
+_components = {}        # name -> {"required", "state", "seconds", "error"}
+_threads = []
+_t0 = time.perf_counter()
+
+
+def record(name, seconds, required=False):
+    """Record a step timed elsewhere (e.g. importing main itself)."""
+    with _lock:
+        _components[name] = {"required": required, "state": "done", "seconds": round(seconds, 3), "error": None}
+
+
+def _run(name, fn, required):
+    with _lock:
+        _components[name] = {"required": required, "state": "running", "seconds": None, "error": None}
+    t0 = time.perf_counter()
+    try:
+        fn()
+        state, error = "done", None
+    except Exception as e:
+        traceback.print_exc()
+        state, error = "failed", f"{type(e).__name__}: {e}"
+    elapsed = time.perf_counter() - t0
+    with _lock:
+        _components[name].update(state=state, seconds=round(elapsed, 3), error=error)
+    print(f"[startup] {name} {state} in {elapsed:.2f}s")
+    return state == "done"
+
+
+def _run_group(group):
+    for step in group:
+        name, fn = step[0], step[1]
+        required = step[2] if len(step) > 2 else True
+        #later steps in a group build on earlier ones
+        if not _run(name, fn, required) and required:
+            return
+
+
+def start(groups):
+    """Initialise groups of (name, fn[, required]) steps in the background."""
+    with _lock:
+        for group in groups:
+            for step in group:
+                _components.setdefault(step[0], {"required": step[2] if len(step) > 2 else True,
+                                                 "state": "pending", "seconds": None, "error": None})
+    for i, group in enumerate(groups):
+        t = threading.Thread(target=_run_group, args=(group,), name=f"startup-{i}", daemon=True)
+        t.start()
+        _threads.append(t)
+
+
+def ready() -> bool:
+    """True once every required component has initialised."""
+    with _lock:
+        return all(c["state"] == "done" for c in _components.values() if c["required"])
+
+
+def wait(timeout=None) -> bool:
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for t in list(_threads):
+        t.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+    return ready()
+
+
+def report() -> dict:
+    with _lock:
+        components = {name: dict(c) for name, c in _components.items()}
+    return {"uptime_s": round(time.perf_counter() - _t0, 3), "components": components}
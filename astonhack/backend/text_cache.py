@@ -0,0 +1,91 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import clip
+
+import clip_model
+import embedding_store
+import inference_scheduler
+import metrics
+
+# two-tier cache of CLIP text embeddings keyed by (model, normalised text):
+# an in-process LRU in front of the embedding store's text_embeddings table.
+# only texts missing from both are tokenised and encoded, in length-sorted batches
+# so short descriptions aren't padded up to the longest one in the request.
+CACHE_SIZE = int(os.getenv("TEXT_CACHE_SIZE", "20000"))
+BATCH_SIZE = int(os.getenv("TEXT_ENCODE_BATCH_SIZE", "64"))
+
+_lru = OrderedDict()
+_lock = threading.Lock()
+
+
+def normalize(text) -> str:
+    #CLIP's tokenizer lowercases and collapses whitespace itself, so this never changes the embedding
+    return " ".join(str(text or "").split()).lower()
+
+
+def _lru_get(key):
+    with _lock:
+        vec = _lru.get(key)
+        if vec is not None:
+            _lru.move_to_end(key)
+        return vec
+
+
+def _lru_put(key, vec):
+    with _lock:
+        _lru[key] = vec
+        _lru.move_to_end(key)
+        while len(_lru) > CACHE_SIZE:
+            _lru.popitem(last=False)
+
+
+def encode(texts) -> np.ndarray:
+    """Return an (n, dim) float32 matrix of normalised CLIP embeddings for texts, in order."""
+    model = clip_model.EMBEDDING_KEY
+    norm = [normalize(t) for t in texts]
+    vectors = {}
+    for t in dict.fromkeys(norm):
+        vec = _lru_get((model, t))
+        if vec is not None:
+            vectors[t] = vec
+            metrics.inc("cache_total", cache="text", result="hit")
+
+    missing = [t for t in dict.fromkeys(norm) if t not in vectors]
+    if missing:
+        hashes = {t: embedding_store.content_hash(t) for t in missing}
+        stored = embedding_store.get_texts(model, hashes.values())
+        for t in missing:
+            vec = stored.get(hashes[t])
+            if vec is not None:
+                vectors[t] = vec
+                _lru_put((model, t), vec)
+                metrics.inc("cache_total", cache="text", result="store")
+        missing = [t for t in missing if t not in vectors]
+
+    if missing:
+        metrics.inc("cache_total", len(missing), cache="text", result="miss")
+        encoded = _encode_sorted(missing)
+        embedding_store.put_texts(model, [(embedding_store.content_hash(t), encoded[t]) for t in missing])
+        for t in missing:
+            vectors[t] = encoded[t]
+            _lru_put((model, t), encoded[t])
+
+    if not norm:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.stack([vectors[t] for t in norm]).astype(np.float32)
+
+
+def _encode_sorted(texts) -> dict:
+    tokens = clip.tokenize(texts, truncate=True)
+    lengths = tokens.argmax(dim=-1)
+    order = lengths.argsort().tolist()
+    out = {}
+    for i in range(0, len(order), BATCH_SIZE):
+        rows = order[i:i + BATCH_SIZE]
+        feats = inference_scheduler.encode_text(tokens[rows])
+        for r, vec in zip(rows, feats):
+            out[texts[r]] = vec
+    return out
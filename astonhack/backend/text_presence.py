@@ -0,0 +1,144 @@
+import os
+import hashlib
+import time
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import metrics
+
+# local, CPU-only check for text in a found-item photo, run before the Gemini gate. most photos
+# (umbrellas, bottles, keys) have no text at all, and for those the gate call only says so.
+#   1. a copy at most DETECT_MAX_SIDE, binarised with a local threshold, once as it is (dark
+#      print on a label) and once inverted (light print on a dark tag)
+#   2. connected components shaped like glyphs: height, aspect and fill
+#   3. glyphs chained left to right when they share a baseline and a height; a chain of
+#      MIN_LINE_CHARS or more is a text line
+# glyph evidence is glyphs on text lines over CONFIDENT_CHARS, capped at 1. busy photos can
+# hide low-contrast print from the glyph test, so the score is the larger of that and the
+# photo's edge density over EDGE_DENSITY_FULL: "clearly no text" means no glyph lines and
+# little structure at all. a photo scoring below SKIP_BELOW gets a "no text" gate result
+# without the LLM call, stored until the settings change, so a miss sticks. SKIP_BELOW must
+# pass `python pregate_check.py` (miss rate under its MAX_MISS_RATE) on stored gate decisions
+# before it is raised.
+ENABLED = os.getenv("TEXT_PREGATE", "1") != "0"
+SKIP_BELOW = float(os.getenv("TEXT_PREGATE_SKIP_BELOW", "0.1"))
+CONFIDENT_CHARS = int(os.getenv("TEXT_PREGATE_CONFIDENT_CHARS", "12"))
+MIN_LINE_CHARS = int(os.getenv("TEXT_PREGATE_MIN_LINE_CHARS", "3"))
+EDGE_DENSITY_FULL = float(os.getenv("TEXT_PREGATE_EDGE_DENSITY_FULL", "0.04"))
+DETECT_MAX_SIDE = int(os.getenv("TEXT_PREGATE_MAX_SIDE", "1000"))
+#local threshold: neighbourhood size and how far below its mean a pixel must be to count as ink
+BLOCK = 15
+OFFSET = 8
+#glyph heights in pixels at DETECT_MAX_SIDE; anything smaller can't be read anyway
+MIN_CHAR_H = 6
+MAX_CHAR_H = 100
+
+#stored with the "no text" results it produces, so changing a setting re-checks them
+_SPEC = (f"text_presence|{DETECT_MAX_SIDE}|{BLOCK}|{OFFSET}|{SKIP_BELOW}|{CONFIDENT_CHARS}|{MIN_LINE_CHARS}"
+         f"|{EDGE_DENSITY_FULL}")
+VERSION = "local-" + hashlib.sha256(_SPEC.encode("utf-8")).hexdigest()[:12]
+
+
+def glyphs(bw: np.ndarray) -> list:
+    """(x, y, w, h) of the glyph-shaped connected components of a binary image, sorted by x."""
+    _, _, stats, _ = cv2.connectedComponentsWithStats(bw, connectivity=8)
+    out = []
+    for x, y, w, h, area in stats[1:]:
+        if not MIN_CHAR_H <= h <= MAX_CHAR_H:
+            continue
+        if not 0.08 <= w / h <= 1.5 or not 0.1 <= area / (w * h) <= 0.95:
+            continue
+        out.append((int(x), int(y), int(w), int(h)))
+    out.sort()
+    return out
+
+
+def text_lines(boxes: list) -> list:
+    """Chain glyph boxes (sorted by x) into lines; returns the glyph count of each line."""
+    parent = list(range(len(boxes)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, (x, y, w, h) in enumerate(boxes):
+        right, cy = x + w, y + h / 2
+        #link to the nearest glyph to the right on the same line, at most one glyph height away
+        for j in range(i + 1, len(boxes)):
+            x2, y2, w2, h2 = boxes[j]
+            if x2 > right + max(h, h2):
+                break
+            if x2 < x + w / 2:
+                continue
+            if abs(y2 + h2 / 2 - cy) > 0.3 * max(h, h2) or not 0.6 <= h2 / h <= 1 / 0.6:
+                continue
+            parent[root(j)] = root(i)
+            break
+
+    sizes = {}
+    for i in range(len(boxes)):
+        r = root(i)
+        sizes[r] = sizes.get(r, 0) + 1
+    return [n for n in sizes.values() if n >= MIN_LINE_CHARS]
+
+
+def score_array(bgr: np.ndarray) -> float:
+    """Text-presence confidence in [0, 1] for a decoded BGR image."""
+    h, w = bgr.shape[:2]
+    scale = min(1.0, DETECT_MAX_SIDE / max(h, w))
+    if scale < 1:
+        bgr = cv2.resize(bgr, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+    chars = 0
+    #ink is darker than its surroundings; inverted, light print on a dark tag is too
+    for g in (gray, cv2.bitwise_not(gray)):
+        bw = cv2.adaptiveThreshold(g, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, BLOCK, OFFSET)
+        chars += sum(text_lines(glyphs(bw)))
+    edges = cv2.Canny(cv2.GaussianBlur(gray, (3, 3), 0), 50, 150)
+    structure = cv2.countNonZero(edges) / edges.size / EDGE_DENSITY_FULL
+    return min(1.0, max(chars / CONFIDENT_CHARS, structure))
+
+
+_REDUCED = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def score_bytes(data: bytes) -> float:
+    """score_array for encoded image bytes, decoded no larger than detection needs."""
+    w, h = Image.open(BytesIO(data)).size
+    #JPEGs decode straight at 1/8, 1/4 or 1/2 scale, far cheaper than a full phone photo
+    flag = next((f for factor, f in _REDUCED if max(w, h) / factor >= DETECT_MAX_SIDE), cv2.IMREAD_COLOR)
+    bgr = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+    if bgr is None:
+        raise ValueError("Could not decode image")
+    return score_array(bgr)
+
+
+def score(artifact) -> float:
+    """score_bytes for an ImageArtifact, memoised on the artifact."""
+    def build():
+        t0 = time.perf_counter()
+        s = score_bytes(artifact.data)
+        metrics.observe("text_pregate_seconds", time.perf_counter() - t0)
+        return s
+    return artifact.variant("text_presence", build)
+
+
+def gate_result(artifact) -> dict | None:
+    """A gate decision when the photo clearly has no text, else None (ask the LLM gate)."""
+    if not ENABLED:
+        return None
+    s = score(artifact)
+    if s >= SKIP_BELOW:
+        return None
+    return {
+        "should_ocr": False,
+        "readability": "none",
+        "doc_type": "none",
+        "likely_identifiers": [],
+        "reason": f"no text found locally (score {s:.2f})",
+    }
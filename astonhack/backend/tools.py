@@ -1,4 +1,3 @@
-import base64
 import numpy as np
 import tempfile
 import os
@@ -9,19 +8,17 @@ import mimetypes
 import traceback
 
 from langchain_core.tools import tool
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import HumanMessage
+from google.genai import types
 
 from dotenv import load_dotenv
 
+import image_artifact
+import llm_client
+
 load_dotenv(Path(__file__).with_name(".env"))
 
-vision_llm = ChatGoogleGenerativeAI(
-    model="gemini-2.5-flash",          # or "gemini-2.5-pro" for higher accuracy
-    temperature=0,
-    max_output_tokens=1200,
-    api_key=os.getenv("GEMINI_API_KEY"),
-)
+OCR_MODEL = "gemini-2.5-flash"          # or "gemini-2.5-pro" for higher accuracy
+OCR_PROMPT = "Extract all the text from the image. Return ONLY the text, no explanations."
 
 @tool
 def extract_text(img_path: str) -> str:
@@ -39,42 +36,41 @@ def extract_text(img_path: str) -> str:
     
     print("[TOOL] extract_text img_path =", repr(img_path))
     try:
+        artifact = image_artifact.lookup(img_path)
+        if artifact is not None:
+            return extract_text_from_artifact(artifact)
+
         p = Path(img_path).expanduser()
         if not p.is_file():
             raise ValueError(f"Image not found: {p}")
 
-        # read and base64-encode image
-        image_bytes = p.read_bytes()
-        image_b64 = base64.b64encode(image_bytes).decode("utf-8")
-
         # guess MIME for the data URI
         mime, _ = mimetypes.guess_type(p.name)
-        mime = mime or "image/png"
-
-        # IMPORTANT: 'text' must be a single string; 'image_url' must be a string (not a dict)
-        messages = [
-            HumanMessage(
-                content=[
-                    {
-                        "type": "text",
-                        "text": "Extract all the text from the image. Return ONLY the text, no explanations.",
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": f"data:{mime};base64,{image_b64}",
-                    },
-                ]
-            )
-        ]
-
-        resp = vision_llm.invoke(messages)
-        return (resp.content or "").strip()
+        return _vision_ocr(types.Part.from_bytes(data=p.read_bytes(), mime_type=mime or "image/png"))
 
     except Exception as e:
         print("[TOOL] extract_text error:", e)
         traceback.print_exc()
         return ""
 
+
+def extract_text_from_artifact(artifact) -> str:
+    """OCR an in-memory ImageArtifact (no disk round trip)."""
+    return _vision_ocr(artifact)
+
+
+def _vision_ocr(image) -> str:
+    #image is an ImageArtifact or a types.Part; llm_client caches by its content hash
+    resp = llm_client.generate(
+        model=OCR_MODEL,
+        contents=[image, OCR_PROMPT],
+        config=types.GenerateContentConfig(
+            temperature=0,
+            max_output_tokens=1200,
+        ),
+    )
+    return (resp.text or "").strip()
+
 #Well documented program is required so that the llm can know how to use it
 @tool
 def preprocess_image(
@@ -97,10 +93,36 @@ def preprocess_image(
             ValueError: If the image cannot be found at the specified img_path.
         """
     print("[TOOL] preprocess_image img_path =", repr(img_path))
+    artifact = image_artifact.lookup(img_path)
+    if artifact is not None:
+        #in-memory path: returns the handle of a memoised variant, nothing touches disk
+        return preprocess_artifact(artifact, op, target_width).handle
+
     img = cv2.imread(img_path)
     if img is None:
         raise ValueError(f"Could not find image at {img_path}")
-    
+
+    out = preprocess_array(img, op, target_width)
+
+    #Write to a temporary PNG and return the path
+    tmpdir = tempfile.gettempdir()
+    base = os.path.splitext(os.path.basename(img_path))[0]
+    out_path = os.path.join(tmpdir, f"{base}_preprocessed.png")
+    cv2.imwrite(out_path, out)
+    return out_path
+
+
+def preprocess_artifact(artifact, op: str = "threshold", target_width: int = 1600):
+    """Preprocess an ImageArtifact for OCR, memoised per (op, target_width)."""
+    key = f"ocr:{op}:{target_width}"
+    return artifact.variant(key, lambda: image_artifact.ImageArtifact.from_array(
+        preprocess_array(artifact.bgr, op, target_width),
+        handle=f"{artifact.handle}/{key}",
+    ))
+
+
+def preprocess_array(img: np.ndarray, op: str = "threshold", target_width: int = 1600) -> np.ndarray:
+    """Apply the OCR preprocessing to a decoded BGR image and return a 3-channel BGR array."""
     #Upscale small images to help ocr
     #since our target width is 1600, we upscale any image smaller than 1600px
     if target_width is not None and img.shape[1] < target_width:
@@ -147,19 +169,10 @@ def preprocess_image(
         (h, w) = img.shape[:2]
         M = cv2.getRotationMatrix2D((w // 2, h // 2), angle, 1.0)
         out = cv2.warpAffine(img, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+    else:
+        raise ValueError(f"Unknown preprocess op: {op!r}")
     
     #Ensure 3-channel PNG for the vision model (it accepts grayscale too ,but PNG-3 is universal)
     if out.ndim == 2:
         out = cv2.cvtColor(out, cv2.COLOR_GRAY2BGR)
-    
-    #Write to a temporary PNG and return the path
-    tmpdir = tempfile.gettempdir()
-    base = os.path.splitext(os.path.basename(img_path))[0]
-    out_path = os.path.join(tmpdir, f"{base}_preprocessed.png")
-    cv2.imwrite(out_path, out)
-    return out_path
-
-
-    
-
-    
+    return out
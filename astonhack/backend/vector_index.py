@@ -0,0 +1,490 @@
+import os
+import json
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:  # optional approximate-nearest-neighbour backend
+    hnswlib = None
+
+# in-memory top-k index over stored CLIP embeddings (one per collection).
+# vectors live in one contiguous float32 matrix so a query is a single matvec
+# + argpartition; above ANN_MIN_ITEMS an HNSW graph is used instead when hnswlib is installed.
+# the graph takes minutes to build at 100k items, so it is built on a background thread
+# once the index crosses ANN_MIN_ITEMS (or loads without a saved graph) and saved with the
+# index; searches keep using the exact matvec until it is ready.
+# each save writes a new INDEX_DIR/<collection>/v-<time>-<pid>/ directory and swaps the CURRENT
+# pointer to it, so processes sharing the directory never read a half-written or mixed snapshot.
+INDEX_DIR = Path(os.getenv("VECTOR_INDEX_DIR", str(Path(__file__).with_name(".cache") / "index")))
+ANN_MIN_ITEMS = int(os.getenv("ANN_MIN_ITEMS", "20000"))
+SAVE_INTERVAL_S = float(os.getenv("VECTOR_INDEX_SAVE_INTERVAL", "30"))
+#superseded snapshots are deleted once they are this old
+KEEP_OLD_S = float(os.getenv("VECTOR_INDEX_KEEP_OLD_S", "300"))
+#rows scored together by a filtered exact search
+SCAN_BLOCK = int(os.getenv("VECTOR_INDEX_SCAN_BLOCK", "4096"))
+MOVE_LOG_SIZE = 4096
+ANN_MAX_FETCH = 256
+
+
+class RowFilter(NamedTuple):
+    """Rows a search may return (see prefilter.allowed_rows).
+
+    A graph search only checks its own hits with `keep` (doc ids -> bool array). `rows()` builds
+    the mask over every row, as (generation it lines up with, mask or None); it costs O(n), so
+    it is only called when an exact scan needs it. Neither is called under the index's lock.
+    """
+    share: float        # fraction of the rows kept
+    keep: Callable
+    rows: Callable
+
+
+class VectorIndex:
+    def __init__(self, dim: int | None = None):
+        self.dim = dim
+        self.ids = []        # row -> doc id
+        self.meta = {}       # doc id -> small payload (content hash, label text)
+        self._rows = {}      # doc id -> row
+        self._matrix = np.zeros((0, dim or 0), dtype=np.float32)
+        self._size = 0
+        self.generation = 0  # bumped whenever rows are added, removed or moved
+        self._moves = []     # (generation, doc id) of recently added/moved rows, see rows_since
+        self._moves_base = 0
+        self._lock = threading.RLock()
+        self._ann = None
+        self._ann_labels = {}   # doc id -> hnsw label
+        self._ann_ids = {}      # hnsw label -> doc id
+        self._next_label = 0
+        self._ann_building = False
+        self._ann_journal = []  # doc ids added/deleted while the graph is being built
+        self.path = None        # where a finished graph is saved (set by get_index)
+        self.dirty = False
+        self._last_save = 0.0
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, doc_id):
+        return doc_id in self._rows
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._matrix[:self._size]
+
+    def _writable(self, need: int):
+        #a memory-mapped matrix is read-only: copy it into a growable buffer on first write
+        if self._matrix.flags.writeable and self._matrix.shape[0] >= need:
+            return
+        capacity = max(need, 2 * self._matrix.shape[0], 64)
+        grown = np.zeros((capacity, self.dim), dtype=np.float32)
+        grown[:self._size] = self._matrix[:self._size]
+        self._matrix = grown
+
+    def add(self, doc_id: str, vector, meta: dict | None = None):
+        """Insert or replace the vector for doc_id."""
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        with self._lock:
+            if self.dim is None or self._size == 0 and self.dim != vector.shape[0]:
+                self.dim = int(vector.shape[0])
+                self._matrix = np.zeros((0, self.dim), dtype=np.float32)
+            if vector.shape[0] != self.dim:
+                raise ValueError(f"Vector dim {vector.shape[0]} != index dim {self.dim}")
+            row = self._rows.get(doc_id)
+            if row is None:
+                self._writable(self._size + 1)
+                row = self._size
+                self._rows[doc_id] = row
+                self.ids.append(doc_id)
+                self._size += 1
+                self._moved(doc_id)
+            else:
+                self._writable(self._size)
+            self._matrix[row] = vector
+            self.meta[doc_id] = meta or {}
+            if self._ann is not None:
+                self._ann_add(doc_id, vector)
+            elif self._ann_building:
+                self._ann_journal.append(doc_id)
+            else:
+                self.ensure_ann()
+            self.dirty = True
+
+    update = add
+
+    def delete(self, doc_id: str) -> bool:
+        with self._lock:
+            row = self._rows.pop(doc_id, None)
+            if row is None:
+                return False
+            self._writable(self._size)
+            last = self._size - 1
+            #keep the matrix dense: move the last row into the hole
+            if row != last:
+                moved = self.ids[last]
+                self._matrix[row] = self._matrix[last]
+                self.ids[row] = moved
+                self._rows[moved] = row
+            self.ids.pop()
+            self._size -= 1
+            self._moved(moved if row != last else None)
+            self.meta.pop(doc_id, None)
+            if self._ann is not None and doc_id in self._ann_labels:
+                label = self._ann_labels.pop(doc_id)
+                self._ann_ids.pop(label, None)
+                self._ann.mark_deleted(label)
+            elif self._ann_building:
+                self._ann_journal.append(doc_id)
+            self.dirty = True
+            return True
+
+    def _moved(self, doc_id):
+        self.generation += 1
+        if doc_id is not None:
+            self._moves.append((self.generation, doc_id))
+        if len(self._moves) > MOVE_LOG_SIZE:
+            self._moves_base = self._moves[MOVE_LOG_SIZE // 2 - 1][0]
+            del self._moves[:MOVE_LOG_SIZE // 2]
+
+    def row_ids(self) -> tuple[int, list]:
+        """(generation, doc id of every row), read together."""
+        with self._lock:
+            return self.generation, list(self.ids)
+
+    def rows_since(self, generation: int, doc_ids=()):
+        """(generation, size, {doc id: row or None}) for the rows added or moved since `generation`
+        plus `doc_ids`; None when the log doesn't reach back that far."""
+        with self._lock:
+            if generation < self._moves_base:
+                return None
+            changed = {doc_id for g, doc_id in self._moves if g > generation}
+            changed.update(doc_ids)
+            return self.generation, self._size, {doc_id: self._rows.get(doc_id) for doc_id in changed}
+
+    def search(self, query, k: int = 3, allowed: RowFilter | None = None) -> list[tuple[str, float]]:
+        """Return the k (doc_id, cosine score) pairs with the highest score, best first.
+
+        allowed restricts the search to some rows (see prefilter); None searches everything.
+        """
+        query = np.asarray(query, dtype=np.float32).ravel()
+        if allowed is not None:
+            return self._search_filtered(query, k, allowed)
+        with self._lock:
+            n = self._size
+            if n == 0 or k <= 0:
+                return []
+            k = min(k, n)
+            if self._ann is not None and n >= ANN_MIN_ITEMS:
+                return self._ann_search(query, k)
+            scores = self.matrix @ query
+            if k < n:
+                top = np.argpartition(-scores, k - 1)[:k]
+            else:
+                top = np.arange(n)
+            top = top[np.argsort(-scores[top])]
+            return [(self.ids[i], float(scores[i])) for i in top]
+
+    def _search_filtered(self, query, k, allowed):
+        with self._lock:
+            n = self._size
+            if n == 0 or k <= 0:
+                return []
+            k = min(k, n)
+            #over-fetch from the graph by the share the filter drops and keep the allowed hits;
+            #the exact scan below runs if too few of them survive, or if the filter keeps so
+            #few rows that scanning them is cheaper anyway
+            fetch = min(n, int(2 * k / max(allowed.share, 1e-6)) + k)
+            hits = []
+            if self._ann is not None and n >= ANN_MIN_ITEMS and fetch <= ANN_MAX_FETCH:
+                try:
+                    hits = self._ann_search(query, fetch)
+                except RuntimeError:
+                    hits = []
+        if hits:
+            keep = allowed.keep([doc_id for doc_id, _ in hits])
+            hits = [hit for hit, ok in zip(hits, keep) if ok][:k]
+            if len(hits) == k:
+                return hits
+        generation, mask = allowed.rows()
+        with self._lock:
+            #a mask built before rows moved no longer lines up with them: search everything
+            if mask is None or generation != self.generation:
+                return self.search(query, k)
+            return self._scan(query, k, mask)
+
+    def _scan(self, query, k, mask):
+        #score block by block: blocks the filter drops are skipped, mostly-kept ones are scored
+        #whole (no copy) and sparse ones gathered, so the cost follows the rows kept as long as
+        #they sit together (see sort_rows)
+        n = self._size
+        scores = np.full(n, -np.inf, dtype=np.float32)
+        starts = np.arange(0, n, SCAN_BLOCK)
+        for start, count in zip(starts, np.add.reduceat(mask[:n], starts, dtype=np.int64)):
+            end = min(start + SCAN_BLOCK, n)
+            if count == 0:
+                continue
+            if 4 * count >= end - start:
+                scores[start:end] = self._matrix[start:end] @ query
+            else:
+                block = start + np.flatnonzero(mask[start:end])
+                scores[block] = self._matrix[block] @ query
+        scores[~mask[:n]] = -np.inf
+        top = np.argpartition(-scores, k - 1)[:k] if k < n else np.arange(n)
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[i], float(scores[i])) for i in top if scores[i] > -np.inf]
+
+    def sort_rows(self, generation: int, keys) -> bool:
+        """Reorder the rows by keys (one per row of `generation`), so rows a filter keeps sit together."""
+        keys = np.asarray(keys)
+        with self._lock:
+            if generation != self.generation or len(keys) != self._size:
+                return False
+            order = np.argsort(keys, kind="stable")
+            if (order == np.arange(self._size)).all():
+                return False
+            self._matrix = self._matrix[order]
+            self.ids = [self.ids[i] for i in order]
+            self._rows = {doc_id: i for i, doc_id in enumerate(self.ids)}
+            self.generation += 1
+            #every row moved: nobody can catch up from the log
+            self._moves, self._moves_base = [], self.generation
+            self.dirty = True
+            return True
+
+    def search_many(self, queries, k: int = 3, allowed=None) -> list[list[tuple[str, float]]]:
+        """search() for an (m, dim) batch of queries, scored with one matrix multiply.
+
+        allowed is None or one RowFilter (or None) per query.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        allowed = list(allowed) if allowed is not None else [None] * len(queries)
+        with self._lock:
+            graph = self._ann is not None and self._size >= ANN_MIN_ITEMS
+        if graph:
+            results = [self.search(q, k, a) if a is not None else None for q, a in zip(queries, allowed)]
+            full = [i for i, a in enumerate(allowed) if a is None]
+            with self._lock:
+                if full and self._size and k > 0:
+                    labels, distances = self._ann.knn_query(queries[full], k=min(k, self._size))
+                    for i, row_l, row_d in zip(full, labels, distances):
+                        results[i] = [(self._ann_ids[int(l)], float(1.0 - d)) for l, d in zip(row_l, row_d)]
+            return [r or [] for r in results]
+        #row masks are built before taking the lock (see RowFilter)
+        masks = [a.rows() if a is not None else None for a in allowed]
+        with self._lock:
+            n = self._size
+            if n == 0 or k <= 0:
+                return [[] for _ in range(len(queries))]
+            k = min(k, n)
+            scores = queries @ self.matrix.T
+            #filtered queries share the multiply; their excluded rows just can't win. a mask
+            #built before rows moved no longer lines up with them: that query searches everything
+            for r, m in enumerate(masks):
+                if m is not None and m[1] is not None and m[0] == self.generation:
+                    scores[r, ~m[1]] = -np.inf
+            if k < n:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                top = np.tile(np.arange(n), (len(queries), 1))
+            rows = np.arange(len(queries))[:, None]
+            top = np.take_along_axis(top, np.argsort(-scores[rows, top], axis=1), axis=1)
+            return [[(self.ids[i], float(scores[r, i])) for i in top[r] if scores[r, i] > -np.inf]
+                    for r in range(len(queries))]
+
+    # --- approximate backend ---
+
+    def _ann_add(self, doc_id, vector):
+        label = self._ann_labels.get(doc_id)
+        if label is None:
+            label = self._next_label
+            self._next_label += 1
+            self._ann_labels[doc_id] = label
+            self._ann_ids[label] = doc_id
+        if self._ann.get_current_count() >= self._ann.get_max_elements():
+            self._ann.resize_index(2 * self._ann.get_max_elements())
+        self._ann.add_items(vector[None, :], [label], replace_deleted=True)
+
+    def ensure_ann(self):
+        """Start building the HNSW graph in the background if the index needs one."""
+        with self._lock:
+            if hnswlib is None or self._ann is not None or self._ann_building or self._size < ANN_MIN_ITEMS:
+                return
+            self._ann_building = True
+            self._ann_journal = []
+            #a snapshot, so the build runs without the lock; changes meanwhile go to the journal
+            matrix, ids = np.array(self.matrix), list(self.ids)
+        threading.Thread(target=self._build_ann, args=(matrix, ids), name="ann-build", daemon=True).start()
+
+    def _build_ann(self, matrix, ids):
+        t0 = time.perf_counter()
+        try:
+            ann = hnswlib.Index(space="ip", dim=self.dim)
+            ann.init_index(max_elements=max(2 * len(ids), 1024), ef_construction=200, M=16,
+                           allow_replace_deleted=True)
+            ann.set_ef(64)
+            ann.add_items(matrix, np.arange(len(ids)))
+            labels, next_label = {doc_id: i for i, doc_id in enumerate(ids)}, len(ids)
+            #catch up on what changed during the build; the graph is still private, so big
+            #batches are applied outside the lock and only the last few under it
+            while True:
+                with self._lock:
+                    batch = [(doc_id, np.array(self._matrix[self._rows[doc_id]]) if doc_id in self._rows else None)
+                             for doc_id in dict.fromkeys(self._ann_journal)]
+                    self._ann_journal = []
+                    if len(batch) <= 1000:
+                        self._next_label = _apply(ann, labels, next_label, batch)
+                        self._ann = ann
+                        self._ann_labels = labels
+                        self._ann_ids = {l: doc_id for doc_id, l in labels.items()}
+                        self._ann_building = False
+                        self.dirty = True
+                        break
+                next_label = _apply(ann, labels, next_label, batch)
+        except Exception as e:
+            print("[vector_index] building the ANN graph failed:", e)
+            with self._lock:
+                self._ann_building = False
+            return
+        print(f"[vector_index] ANN graph over {len(ids)} items built in {time.perf_counter() - t0:.1f}s")
+        if self.path is not None:
+            self.save(self.path)
+
+    def _ann_search(self, query, k):
+        labels, distances = self._ann.knn_query(query[None, :], k=k)
+        #hnswlib's "ip" distance is 1 - dot product
+        return [(self._ann_ids[int(l)], float(1.0 - d)) for l, d in zip(labels[0], distances[0])]
+
+    # --- persistence ---
+
+    def save(self, path: Path):
+        """Write a snapshot into a new version directory, then atomically repoint CURRENT at it.
+
+        The API and the ingest worker can share VECTOR_INDEX_DIR, so nothing is rewritten in
+        place: each save has its own directory and a reader always sees one whole snapshot."""
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            version = f"v-{time.time_ns()}-{os.getpid()}"
+            target = path / version
+            target.mkdir()
+            np.save(target / "vectors.npy", np.ascontiguousarray(self.matrix))
+            info = {"dim": self.dim, "version": version, "ids": self.ids, "meta": self.meta}
+            if self._ann is not None:
+                #the HNSW graph is slow to build, so persist it alongside the matrix
+                self._ann.save_index(str(target / "ann.bin"))
+                info["ann_labels"] = self._ann_labels
+                info["ann_next_label"] = self._next_label
+            (target / "meta.json").write_text(json.dumps(info))
+            pointer = path / f"CURRENT.{version}.tmp"
+            pointer.write_text(version)
+            os.replace(pointer, path / "CURRENT")
+            self.dirty = False
+            self._last_save = time.monotonic()
+        _prune(path, version)
+
+    def save_if_due(self, path: Path):
+        if self.dirty and time.monotonic() - self._last_save >= SAVE_INTERVAL_S:
+            self.save(path)
+
+    @classmethod
+    def load(cls, path: Path, mmap: bool = True) -> "VectorIndex":
+        """Load a saved index; with mmap the matrix is paged in lazily instead of read up front."""
+        path = snapshot_dir(path)
+        if path is None:
+            raise FileNotFoundError("no saved index")
+        info = json.loads((path / "meta.json").read_text())
+        if info.get("version", path.name) != path.name:
+            raise ValueError(f"Corrupt index at {path}: meta.json is from {info['version']}")
+        index = cls(info["dim"])
+        matrix = np.load(path / "vectors.npy", mmap_mode="r" if mmap else None)
+        if matrix.shape[0] != len(info["ids"]):
+            raise ValueError(f"Corrupt index at {path}: {matrix.shape[0]} rows, {len(info['ids'])} ids")
+        index._matrix = matrix
+        index._size = matrix.shape[0]
+        index.ids = list(info["ids"])
+        index._rows = {doc_id: i for i, doc_id in enumerate(index.ids)}
+        index.meta = info["meta"]
+        if hnswlib is not None and "ann_labels" in info and (path / "ann.bin").exists():
+            ann = hnswlib.Index(space="ip", dim=index.dim)
+            ann.load_index(str(path / "ann.bin"), allow_replace_deleted=True)
+            ann.set_ef(64)
+            index._ann = ann
+            index._ann_labels = {doc_id: int(l) for doc_id, l in info["ann_labels"].items()}
+            index._ann_ids = {l: doc_id for doc_id, l in index._ann_labels.items()}
+            index._next_label = info["ann_next_label"]
+        index._last_save = time.monotonic()
+        return index
+
+
+def snapshot_dir(path: Path) -> Path | None:
+    """Directory holding the latest saved snapshot under path (or the pre-versioning layout)."""
+    path = Path(path)
+    try:
+        return path / (path / "CURRENT").read_text().strip()
+    except FileNotFoundError:
+        return path if (path / "meta.json").exists() else None
+
+
+def _prune(path: Path, current: str):
+    """Drop snapshots other than current once they are old enough that no reader can still be
+    opening them (or another process still writing one)."""
+    cutoff = time.time() - KEEP_OLD_S
+    for old in path.glob("v-*"):
+        try:
+            if old.name != current and old.stat().st_mtime < cutoff:
+                shutil.rmtree(old, ignore_errors=True)
+        except FileNotFoundError:
+            pass
+    #files from before snapshots were versioned
+    for name in ("vectors.npy", "meta.json", "ann.bin"):
+        (path / name).unlink(missing_ok=True)
+
+
+def _apply(ann, labels, next_label, batch):
+    """Apply (doc_id, vector or None for deleted) changes to a graph; returns the next free label."""
+    adds = [(doc_id, v) for doc_id, v in batch if v is not None]
+    for doc_id, v in batch:
+        if v is None and doc_id in labels:
+            ann.mark_deleted(labels.pop(doc_id))
+    if adds:
+        for doc_id, _ in adds:
+            if doc_id not in labels:
+                labels[doc_id] = next_label
+                next_label += 1
+        if ann.get_current_count() + len(adds) > ann.get_max_elements():
+            ann.resize_index(2 * (ann.get_current_count() + len(adds)))
+        ann.add_items(np.stack([v for _, v in adds]), [labels[d] for d, _ in adds], replace_deleted=True)
+    return next_label
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def index_path(collection: str) -> Path:
+    return INDEX_DIR / collection
+
+
+def get_index(collection: str) -> VectorIndex:
+    """Process-wide index for a collection, memory-mapped from disk when a saved copy exists."""
+    with _indexes_lock:
+        index = _indexes.get(collection)
+        if index is None:
+            path = index_path(collection)
+            index = None
+            if snapshot_dir(path) is not None:
+                try:
+                    index = VectorIndex.load(path)
+                except Exception as e:
+                    print(f"[vector_index] could not load {path}: {e}; rebuilding")
+            if index is None:
+                index = VectorIndex()
+            index.path = path
+            _indexes[collection] = index
+            #a loaded index above ANN_MIN_ITEMS without a saved graph gets one in the background
+            index.ensure_ann()
+        return index